@@ -4,11 +4,23 @@ from notifications_utils import logging
 from notifications_utils.celery import NotifyCelery
 from notifications_utils.clients.statsd.statsd_client import StatsdClient
 
+from app.admission import AdmissionController
+from app.files.pdf_cache import PdfCache
+from app.files.s3_client import S3Client
+from app.files.zip_checkpoints import ZipCheckpoints
+from app.files.zips_sent_index import ZipsSentIndex
+from app.files.zips_sent_ledger import ZipsSentLedger
 from app.sftp.ftp_client import FtpClient
 
 notify_celery = NotifyCelery()
 statsd_client = StatsdClient()
 ftp_client = FtpClient()
+s3_client = S3Client()
+zips_sent_ledger = ZipsSentLedger(s3_client)
+zips_sent_index = ZipsSentIndex(s3_client)
+pdf_cache = PdfCache(s3_client)
+zip_checkpoints = ZipCheckpoints()
+admission_controller = AdmissionController()
 
 
 def create_app(application):
@@ -22,5 +34,36 @@ def create_app(application):
     logging.init_app(application, statsd_client)
     notify_celery.init_app(application)
     ftp_client.init_app(application)
+    s3_client.init_app(application)
+    zips_sent_ledger.init_app(application)
+    zips_sent_index.init_app(application)
+    pdf_cache.init_app(application)
+    zip_checkpoints.init_app(application)
+    admission_controller.init_app(application)
 
     return application
+
+
+def init_worker(application, worker):
+    '''Sizes what the tasks in a worker process share for how many of them the worker runs at once - more than one
+    only on celery's threads pool, where every one of the worker's `concurrency` tasks runs in the one process.'''
+    # worker_init is sent before the worker has looked up its pool class, so pool_cls may still be its name
+    from celery.concurrency import get_implementation
+    from celery.concurrency.thread import TaskPool
+
+    if issubclass(get_implementation(worker.pool_cls), TaskPool):
+        s3_client.init_app(application, tasks_at_once=worker.concurrency)
+
+
+def warm_up(application):
+    '''Does the work that every worker process would otherwise repeat before it could start its first task, for
+    celery's parent process to do once before it forks them.'''
+    # imported lazily by the modules that use them, to keep them off the import path of the app
+    import sentry_sdk  # noqa: F401
+
+    s3_client.warm_up()
+    try:
+        ftp_client.warm_up()
+    except OSError:
+        # worker processes will resolve FTP_HOST themselves
+        application.logger.exception('Failed to resolve FTP_HOST before starting worker processes')
@@ -0,0 +1,49 @@
+import threading
+from contextlib import contextmanager
+
+from app.metrics import stage_timer
+
+
+class AdmissionController(object):
+    '''Limits how much memory the zip tasks running at once in a worker process can take up between them, so that a
+    worker running several tasks on threads can't run out of memory on a big day.
+
+    A task holds at most LETTER_PDF_DOWNLOAD_WINDOW_BYTES of letters waiting to be zipped, plus the zip itself -
+    which moves to disk once it's bigger than ZIP_MEMORY_BUDGET_BYTES, and isn't held at all when zips are streamed.
+    Tasks are admitted for that many bytes per zip they hold before they start downloading, and wait while the tasks
+    already admitted would take the total over MAX_IN_FLIGHT_ZIP_BYTES. A task that needs more than that on its own
+    is admitted once nothing else is running, and a limit of 0 admits everything straight away.
+
+    Tasks are admitted all at once rather than as their zips grow, so two tasks can never each be waiting for memory
+    the other holds. Concurrent SFTP sessions are limited separately, by the size of the ftp client's pool.'''
+
+    def init_app(self, app):
+        self.max_bytes = app.config.get('MAX_IN_FLIGHT_ZIP_BYTES', 0)
+        self.bytes_per_zip = app.config.get('LETTER_PDF_DOWNLOAD_WINDOW_BYTES')
+        if not app.config.get('ZIP_STREAMING_ENABLED'):
+            self.bytes_per_zip += app.config.get('ZIP_MEMORY_BUDGET_BYTES')
+        self.in_flight_bytes = 0
+        self.tasks = 0
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def admit(self, zips=1):
+        '''Waits until there is room for a task holding `zips` zips at once, and holds that room for the block.'''
+        if not self.max_bytes:
+            yield
+            return
+
+        task_bytes = self.bytes_per_zip * zips
+        with stage_timer('admission'), self.condition:
+            self.condition.wait_for(
+                lambda: self.tasks == 0 or self.in_flight_bytes + task_bytes <= self.max_bytes
+            )
+            self.in_flight_bytes += task_bytes
+            self.tasks += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_flight_bytes -= task_bytes
+                self.tasks -= 1
+                self.condition.notify_all()
@@ -0,0 +1,60 @@
+'''Soft time limits that tasks check for themselves between the stages of their work.
+
+Celery enforces soft_time_limit by signalling the process running the task, which it can't do on the threads pool,
+where tasks share their process. Raising the exception into a task's thread from outside would strike wherever the
+thread happened to be - including halfway through bookkeeping that has to be undone - so instead each task's
+deadline is kept for the thread running it, and check_soft_time_limit raises SoftTimeLimitExceeded once it has
+passed, at the points where the task calls it: between letters as they're downloaded and between chunks as they're
+uploaded.'''
+import threading
+import time
+from contextlib import contextmanager
+
+from celery.exceptions import SoftTimeLimitExceeded
+
+_deadlines = threading.local()
+
+
+def current_deadline():
+    '''Returns the time.monotonic() by which the task running in this thread is to finish, or None if it has no
+    soft time limit.'''
+    return getattr(_deadlines, 'deadline', None)
+
+
+@contextmanager
+def deadline_of_task(deadline):
+    '''Holds the current thread to the current_deadline() of the task it's doing work for, which is only known in the
+    task's own thread.'''
+    previous_deadline = current_deadline()
+    _deadlines.deadline = deadline
+    try:
+        yield
+    finally:
+        _deadlines.deadline = previous_deadline
+
+
+def check_soft_time_limit():
+    deadline = current_deadline()
+    if deadline is not None and time.monotonic() > deadline:
+        raise SoftTimeLimitExceeded()
+
+
+def start_soft_time_limit(soft_time_limit):
+    _deadlines.deadline = time.monotonic() + soft_time_limit if soft_time_limit else None
+
+
+def init_soft_time_limits():
+    '''Starts each task's soft time limit as it starts. On the prefork pool celery's own signal usually gets there
+    first, so this only matters on the threads pool - but checking doesn't depend on which pool the worker runs.'''
+    from celery.signals import task_postrun, task_prerun
+
+    def start(task, **_):
+        # a limit given when the task was sent overrides the task's own
+        time_limits = task.request.timelimit or (None, None)
+        start_soft_time_limit(time_limits[1] or task.soft_time_limit)
+
+    def stop(**_):
+        start_soft_time_limit(None)
+
+    task_prerun.connect(start, weak=False)
+    task_postrun.connect(stop, weak=False)
@@ -1,19 +1,46 @@
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 
 from botocore.exceptions import ClientError
 from celery.exceptions import SoftTimeLimitExceeded
 from flask import current_app
-from notifications_utils.s3 import s3upload as utils_s3upload
 
-from app import ftp_client, notify_celery
+from app import (
+    admission_controller,
+    ftp_client,
+    notify_celery,
+    zip_checkpoints,
+    zips_sent_index,
+    zips_sent_ledger,
+)
+from app.celery.soft_time_limits import current_deadline, deadline_of_task
 from app.files.file_utils import (
-    file_exists_on_s3,
+    get_encoded_letter_pdfs_from_s3,
     get_notification_references_from_s3_filenames,
+    get_size_of_zip_of_letter_pdfs_from_s3,
+    get_zip_date_time,
     get_zip_of_letter_pdfs_from_s3,
+    upload_to_s3,
 )
+from app.files.zips_sent_ledger import get_zips_sent_filename
+from app.metrics import stage_timer
 from app.sftp.ftp_client import FtpException
 
 NOTIFY_QUEUE = 'notify-internal-tasks'
+# SQS won't accept messages bigger than this
+SQS_MAX_MESSAGE_BYTES = 256 * 1024
+# room left in each message for the task's headers and kombu's envelope around its arguments
+MESSAGE_ENVELOPE_BYTES = 8 * 1024
+# celery JSON encodes a task's arguments, kombu base64 encodes them into its envelope and then the SQS transport
+# base64 encodes the envelope - each base64 encoding making it a third bigger
+MAX_REFERENCES_JSON_BYTES = (SQS_MAX_MESSAGE_BYTES * 3 // 4 - MESSAGE_ENVELOPE_BYTES) * 3 // 4
+
+# folder date -> when the build-zips-sent-index task this process last sent for that day is due to run
+zips_sent_index_builds_due = {}
+zips_sent_index_builds_lock = threading.Lock()
 
 
 def get_error_task_name_or_retry(task, upload_filename):
@@ -25,6 +52,22 @@ def get_error_task_name_or_retry(task, upload_filename):
         return "update-letter-notifications-to-error"
 
 
+def get_task_name_after_ftp_failure(task, filenames_to_zip, upload_filename, zip_data_len):
+    if zip_data_len is not None:
+        try:
+            # check if file exists with the right size.
+            # It has happened that an IOError occurs but the files are present on the remote server.
+            ftp_client.file_exists_with_correct_size(upload_filename, zip_data_len)
+        except FtpException:
+            pass
+        else:
+            record_zip_sent_after_ftp_failure(filenames_to_zip, upload_filename)
+            return "update-letter-notifications-to-sent"
+
+    current_app.logger.exception(f'FTP app failed to send letters for zip file: {upload_filename}')
+    return get_error_task_name_or_retry(task, upload_filename)
+
+
 @notify_celery.task(
     bind=True,
     name="zip-and-send-letter-pdfs",
@@ -35,7 +78,9 @@ def get_error_task_name_or_retry(task, upload_filename):
 )
 def zip_and_send_letter_pdfs(self, filenames_to_zip, upload_filename):
     folder_date = filenames_to_zip[0].split('/')[0]
-    zips_sent_filename = '{}/zips_sent/{}.TXT'.format(folder_date, upload_filename)
+    zips_sent_filename = get_zips_sent_filename(folder_date, upload_filename)
+
+    zip_data_len = None
 
     current_app.logger.info(
         f"Starting to zip {len(filenames_to_zip)} letter PDFs in memory from "
@@ -43,22 +88,18 @@ def zip_and_send_letter_pdfs(self, filenames_to_zip, upload_filename):
     )
 
     try:
-        if file_exists_on_s3(current_app.config['LETTERS_PDF_BUCKET_NAME'], zips_sent_filename):
+        if zip_already_sent(folder_date, upload_filename):
             current_app.logger.warning('{} already exists in S3, skipping DVLA upload'.format(zips_sent_filename))
             return
 
-        zip_data = get_zip_of_letter_pdfs_from_s3(filenames_to_zip)
+        with admission_controller.admit():
+            if not send_without_zip_data(filenames_to_zip, upload_filename):
+                zip_data = get_zip_data(filenames_to_zip, upload_filename)
+                zip_data_len = len(zip_data)
 
-        ftp_client.send_zip(zip_data, upload_filename)
+                send_zip(ftp_client, zip_data, filenames_to_zip, upload_filename)
 
-        # upload a record to s3 of each zip file we send to DVLA - this is just a list of letter filenames so we can
-        # match up their references with DVLA
-        utils_s3upload(
-            filedata=json.dumps(filenames_to_zip).encode(),
-            region=current_app.config['AWS_REGION'],
-            bucket_name=current_app.config['LETTERS_PDF_BUCKET_NAME'],
-            file_location=zips_sent_filename
-        )
+        record_zip_sent(filenames_to_zip, upload_filename)
     except ClientError:
         current_app.logger.exception(
             f'FTP app failed to download PDF from S3 bucket {folder_date} for zip file: {upload_filename}')
@@ -67,14 +108,11 @@ def zip_and_send_letter_pdfs(self, filenames_to_zip, upload_filename):
         current_app.logger.exception(f'FTP app timed out sending zip file: {upload_filename}')
         task_name = get_error_task_name_or_retry(self, upload_filename)
     except FtpException:
-        try:
-            # check if file exists with the right size.
-            # It has happened that an IOError occurs but the files are present on the remote server.
-            ftp_client.file_exists_with_correct_size(upload_filename, len(zip_data))
-            task_name = "update-letter-notifications-to-sent"
-        except FtpException:
-            current_app.logger.exception(f'FTP app failed to send letters for zip file: {upload_filename}')
-            task_name = get_error_task_name_or_retry(self, upload_filename)
+        task_name = get_task_name_after_ftp_failure(self, filenames_to_zip, upload_filename, zip_data_len)
+    except OSError:
+        # ftp errors are all FtpExceptions, so this is the local disk - say, full up with zips spilled out of memory
+        current_app.logger.exception(f'FTP app failed to build zip file on local disk: {upload_filename}')
+        task_name = get_error_task_name_or_retry(self, upload_filename)
     else:
         task_name = "update-letter-notifications-to-sent"
 
@@ -82,15 +120,243 @@ def zip_and_send_letter_pdfs(self, filenames_to_zip, upload_filename):
     update_notifications(task_name, refs)
 
 
-def update_notifications(task_name, references):
-    # split up references into 1000 item sublists to ensure we don't go over SQS's max item size of 256kb
-    for notification_references in chunk_list(references, 1000):
+@notify_celery.task(
+    bind=True,
+    name="zip-and-send-letter-pdfs-batch",
+    # long enough for a whole evening's zips. If it runs out, the zips it hasn't sent are handed over as above
+    soft_time_limit=1800
+)
+def zip_and_send_letter_pdfs_batch(self, zips):
+    '''Sends each (filenames_to_zip, upload_filename) pair in zips over a single SFTP connection, zipping the letters
+    for the next one while the current one uploads.
+
+    The batch is only a faster way of sending the zips: as soon as anything goes wrong, the zip that failed and all
+    the ones after it are handed over to zip-and-send-letter-pdfs one at a time, which retries them and marks their
+    letters as failed if it has to.'''
+    zips = [tuple(zip_to_send) for zip_to_send in zips]
+    zips_handled = 0
+
+    current_app.logger.info(f"Starting to send a batch of {len(zips)} zip files to DVLA")
+
+    try:
+        # prepare_zips holds the zip being sent and the next one
+        with admission_controller.admit(zips=2), ftp_client.session() as ftp_session, \
+                closing(prepare_zips(zips)) as prepared_zips:
+            for filenames_to_zip, upload_filename, zip_data in prepared_zips:
+                if zip_data is not None:
+                    send_zip(ftp_session, zip_data, filenames_to_zip, upload_filename)
+                    record_zip_sent(filenames_to_zip, upload_filename)
+                    update_notifications(
+                        "update-letter-notifications-to-sent",
+                        get_notification_references_from_s3_filenames(filenames_to_zip),
+                    )
+                zips_handled += 1
+    except (ClientError, SoftTimeLimitExceeded, FtpException, OSError):
+        current_app.logger.exception(
+            f'FTP app failed to send a batch of zip files, sending the last {len(zips) - zips_handled} individually')
+
+    for filenames_to_zip, upload_filename in zips[zips_handled:]:
         notify_celery.send_task(
-            name=task_name, args=(notification_references,), queue=NOTIFY_QUEUE
+            name="zip-and-send-letter-pdfs", args=(filenames_to_zip, upload_filename), queue='process-ftp-tasks'
         )
 
 
-def chunk_list(items, n):
-    # third parameter is step
-    for i in range(0, len(items), n):
-        yield items[i:i + n]
+@notify_celery.task(name="build-zips-sent-index")
+def build_zips_sent_index(folder_date):
+    '''Writes the index of which zip each letter sent on folder_date was in, from the day's zips_sent records.
+
+    This reads every record for the day, so rather than running for each zip it's sent by
+    send_zips_sent_index_build to run a little after a zip is sent, covering every zip sent before then.'''
+    with stage_timer('zips-sent-index') as index_build:
+        index_build.objects = zips_sent_index.rebuild(folder_date)
+
+
+def send_zips_sent_index_build(folder_date):
+    '''Sends build-zips-sent-index for folder_date to run in ZIPS_SENT_INDEX_BUILD_DELAY seconds, unless this process
+    has already sent one that hasn't run yet - which will list the day's zips_sent records after this zip's.
+
+    So however many zips a worker sends in a day, it rebuilds the day's index at most once a delay, and each zip is
+    in the index within a delay of being sent. Processes don't know about each other's builds, so a worker with
+    several processes may rebuild a day's index once a delay in each.'''
+    delay = current_app.config['ZIPS_SENT_INDEX_BUILD_DELAY']
+    now = time.time()
+    with zips_sent_index_builds_lock:
+        if zips_sent_index_builds_due.get(folder_date, 0) > now:
+            return
+        zips_sent_index_builds_due[folder_date] = now + delay
+
+    notify_celery.send_task(
+        name="build-zips-sent-index", args=(folder_date,), queue='process-ftp-tasks', countdown=delay
+    )
+
+
+def prepare_zips(zips):
+    '''Yields (filenames_to_zip, upload_filename, zip_data) for each zip, building the next zip on a background thread
+    while the caller sends this one - so at most two zips are held at once. zip_data is None if the zip has already
+    been sent.
+
+    Once the caller closes the generator - say, because sending a zip failed - the zip being built is abandoned
+    between letters on the background thread, rather than the caller waiting for it to be built and thrown away.'''
+    app = current_app._get_current_object()
+    stop = threading.Event()
+    deadline = current_deadline()
+
+    def prepare_zip(filenames_to_zip, upload_filename):
+        with app.app_context(), deadline_of_task(deadline):
+            folder_date = filenames_to_zip[0].split('/')[0]
+            if zip_already_sent(folder_date, upload_filename):
+                current_app.logger.warning('{} already exists in S3, skipping DVLA upload'.format(
+                    get_zips_sent_filename(folder_date, upload_filename)
+                ))
+                return None
+            return get_zip_data(filenames_to_zip, upload_filename, stop)
+
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='zip-prefetch')
+    try:
+        next_zip_data = executor.submit(prepare_zip, *zips[0]) if zips else None
+        for i, (filenames_to_zip, upload_filename) in enumerate(zips):
+            zip_data = next_zip_data
+            next_zip_data = executor.submit(prepare_zip, *zips[i + 1]) if i + 1 < len(zips) else None
+            yield filenames_to_zip, upload_filename, zip_data.result()
+    finally:
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def record_zip_sent(filenames_to_zip, upload_filename):
+    folder_date = filenames_to_zip[0].split('/')[0]
+    # upload a record to s3 of each zip file we send to DVLA - this is just a list of letter filenames so we can
+    # match up their references with DVLA
+    upload_to_s3(
+        bucket_name=current_app.config['LETTERS_PDF_BUCKET_NAME'],
+        filename=get_zips_sent_filename(folder_date, upload_filename),
+        filedata=json.dumps(filenames_to_zip).encode(),
+    )
+    zips_sent_ledger.record_sent(folder_date, upload_filename)
+    zip_checkpoints.delete(upload_filename)
+    send_zips_sent_index_build(folder_date)
+
+
+def record_zip_sent_after_ftp_failure(filenames_to_zip, upload_filename):
+    '''Records a zip that turned out to have been sent despite the ftp error, which also deletes the checkpoint that
+    send_zip made of it. The letters are with DVLA either way, so failing to record it doesn't fail the task - but the
+    checkpoint, which could be hundreds of MB, is still deleted.'''
+    try:
+        record_zip_sent(filenames_to_zip, upload_filename)
+    except ClientError:
+        current_app.logger.exception(f'FTP app failed to record that zip file {upload_filename} was sent')
+        zip_checkpoints.delete(upload_filename)
+
+
+def zip_already_sent(folder_date, upload_filename):
+    with stage_timer('zips-sent-check') as zips_sent_check:
+        already_sent = zips_sent_ledger.was_sent(folder_date, upload_filename)
+        zips_sent_check.outcome = 'already-sent' if already_sent else 'not-sent'
+    return already_sent
+
+
+def zip_already_uploaded(filenames_to_zip, upload_filename):
+    '''Whether a previous attempt uploaded the zip before failing, so that we don't have to download and zip the
+    letters to find out. A first attempt just costs a stat of the remote file, and a partial upload - the usual thing
+    to find after a failure - one more small read, since neither can be the whole zip.
+
+    A complete looking remote file is compared with the size of the checkpoint the previous attempt left, if it left
+    one, or else with the zip's size predicted from the letters' sizes on S3. Compressed zips' sizes can't be
+    predicted, so without a checkpoint they are always built and sent again - resuming the upload from where the
+    previous attempt got to.'''
+    remote_size = ftp_client.get_remote_zip_size(upload_filename)
+    if remote_size is None:
+        return False
+    checkpoint_size = zip_checkpoints.size(upload_filename, filenames_to_zip)
+    if checkpoint_size is not None:
+        return remote_size == checkpoint_size
+    if current_app.config['ZIP_COMPRESSION_LEVEL']:
+        return False
+    return remote_size == get_size_of_zip_of_letter_pdfs_from_s3(filenames_to_zip)
+
+
+def send_without_zip_data(filenames_to_zip, upload_filename):
+    '''Sends the zips that don't need building in memory - ones a previous attempt already uploaded, and all of them
+    when they're streamed - returning False for the rest.'''
+    if zip_already_uploaded(filenames_to_zip, upload_filename):
+        current_app.logger.info(f'{upload_filename} already exists on DVLA ftp with the expected size, skipping')
+        return True
+    if current_app.config['ZIP_STREAMING_ENABLED']:
+        with closing(get_encoded_letter_pdfs_from_s3(filenames_to_zip)) as letter_pdfs:
+            ftp_client.stream_zip(letter_pdfs, upload_filename, get_zip_date_time(filenames_to_zip))
+        return True
+    return False
+
+
+def get_zip_data(filenames_to_zip, upload_filename, stop=None):
+    # a previous attempt may have already zipped these letters before failing to send them
+    zip_data = zip_checkpoints.load(upload_filename, filenames_to_zip)
+    if zip_data is not None:
+        current_app.logger.info(f'Reusing checkpoint of zip file {upload_filename} from a previous attempt')
+        return zip_data
+
+    return get_zip_of_letter_pdfs_from_s3(filenames_to_zip, stop=stop)
+
+
+def send_zip(ftp, zip_data, filenames_to_zip, upload_filename):
+    '''Sends the zip with ftp - the ftp client or one of its sessions - checkpointing it if that fails so that the
+    retry doesn't have to download and zip its letters again. Zips that are sent first time never touch the disk.'''
+    try:
+        ftp.send_zip(zip_data, upload_filename)
+    except (FtpException, SoftTimeLimitExceeded):
+        zip_checkpoints.save(upload_filename, filenames_to_zip, zip_data)
+        raise
+
+
+def update_notifications(task_name, references):
+    '''Sends the references to notifications api in as few tasks as will fit in SQS messages, sending several at
+    once if there are too many references for one.'''
+    app = current_app._get_current_object()
+    statsd_client = app.statsd_client
+
+    with stage_timer('update-notifications') as notifications_update:
+        notifications_update.outcome = task_name
+        notifications_update.objects = len(references)
+        messages = list(chunk_by_json_size(references, MAX_REFERENCES_JSON_BYTES))
+        statsd_client.incr('zip-and-send.update-notifications.messages', len(messages))
+
+        def send_task(notification_references):
+            # spans are started from the stage's span explicitly, since the sending threads can't see the current one
+            span = notifications_update.span.start_child(op='zip-and-send.send-task', description=task_name)
+            span.set_data('objects', len(notification_references))
+            start = time.monotonic()
+            try:
+                with app.app_context():
+                    notify_celery.send_task(name=task_name, args=(notification_references,), queue=NOTIFY_QUEUE)
+            finally:
+                span.finish()
+            statsd_client.timing('zip-and-send.update-notifications.publish-time', time.monotonic() - start)
+
+        if len(messages) == 1:
+            send_task(messages[0])
+            return
+
+        with ThreadPoolExecutor(
+            max_workers=app.config['NOTIFICATION_UPDATE_CONCURRENCY'], thread_name_prefix='notification-update'
+        ) as executor:
+            for sent in [executor.submit(send_task, notification_references) for notification_references in messages]:
+                sent.result()
+
+
+def chunk_by_json_size(items, max_json_bytes):
+    '''Splits items into lists, in order, that each take up no more than max_json_bytes as JSON - unless a single
+    item is bigger than that on its own.'''
+    chunk = []
+    # the surrounding brackets
+    chunk_json_bytes = 2
+    for item in items:
+        # the item and the ', ' separating it from the next
+        item_json_bytes = len(json.dumps(item)) + 2
+        if chunk and chunk_json_bytes + item_json_bytes > max_json_bytes:
+            yield chunk
+            chunk = []
+            chunk_json_bytes = 2
+        chunk.append(item)
+        chunk_json_bytes += item_json_bytes
+    if chunk:
+        yield chunk
@@ -7,8 +7,21 @@ class Config(object):
     NOTIFICATION_QUEUE_PREFIX = os.getenv('NOTIFICATION_QUEUE_PREFIX')
 
     FTP_HOST = os.getenv('FTP_HOST')
+    FTP_PORT = int(os.getenv('FTP_PORT', 22))
+    # seconds worker processes connect to the address FTP_HOST was resolved to before they were forked, rather than
+    # resolving it again
+    FTP_HOST_RESOLUTION_TTL = int(os.getenv('FTP_HOST_RESOLUTION_TTL', 300))
     FTP_USERNAME = os.getenv('FTP_USERNAME')
     FTP_PASSWORD = os.getenv('FTP_PASSWORD')
+    # authenticated sftp connections kept open between tasks by each worker process
+    FTP_POOL_SIZE = int(os.getenv('FTP_POOL_SIZE', 2))
+    FTP_POOL_IDLE_TIMEOUT = int(os.getenv('FTP_POOL_IDLE_TIMEOUT', 300))
+    FTP_KEEPALIVE_INTERVAL = int(os.getenv('FTP_KEEPALIVE_INTERVAL', 30))
+    # zips are uploaded in ranges of FTP_UPLOAD_CHUNK_SIZE bytes written concurrently over this many sftp channels
+    FTP_UPLOAD_CHANNELS = int(os.getenv('FTP_UPLOAD_CHANNELS', 1))
+    FTP_UPLOAD_CHUNK_SIZE = int(os.getenv('FTP_UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))
+    # seconds a listing of the remote directory is reused for when sending a batch of zips over one connection
+    FTP_DIRECTORY_CACHE_TTL = int(os.getenv('FTP_DIRECTORY_CACHE_TTL', 60))
 
     # Logging
     DEBUG = False
@@ -47,11 +60,57 @@ class Config(object):
 
     LOCAL_FILE_STORAGE_PATH = "~/dvla-file-storage"
 
+    # write zips straight into the remote file on the DVLA ftp server as the letters are downloaded, rather than
+    # building the whole zip in memory first
+    ZIP_STREAMING_ENABLED = os.getenv('ZIP_STREAMING_ENABLED') == '1'
+    # number of letter PDFs downloaded from S3 at once, which also sizes the S3 connection pool
+    S3_DOWNLOAD_CONCURRENCY = int(os.getenv('S3_DOWNLOAD_CONCURRENCY', 5))
+    # 'threads' downloads with a fixed S3_DOWNLOAD_CONCURRENCY, 'asyncio' starts there and adapts between the
+    # min and max below - growing while throughput improves and backing off when S3 throttles us
+    S3_DOWNLOAD_ENGINE = os.getenv('S3_DOWNLOAD_ENGINE', 'threads')
+    S3_ASYNC_MIN_CONCURRENCY = int(os.getenv('S3_ASYNC_MIN_CONCURRENCY', 2))
+    S3_ASYNC_MAX_CONCURRENCY = int(os.getenv('S3_ASYNC_MAX_CONCURRENCY', 64))
+    # letter PDFs bigger than the threshold are downloaded as S3_RANGED_GET_CONCURRENCY byte ranges at once, each of
+    # S3_RANGED_GET_PART_SIZE bytes, rather than over a single connection. A threshold of 0 turns this off
+    S3_RANGED_GET_THRESHOLD = int(os.getenv('S3_RANGED_GET_THRESHOLD', 8 * 1024 * 1024))
+    S3_RANGED_GET_PART_SIZE = int(os.getenv('S3_RANGED_GET_PART_SIZE', 8 * 1024 * 1024))
+    S3_RANGED_GET_CONCURRENCY = int(os.getenv('S3_RANGED_GET_CONCURRENCY', 4))
+    # maximum number of letter PDFs being downloaded or waiting to be zipped at any one time
+    LETTER_PDF_DOWNLOAD_WINDOW = int(os.getenv('LETTER_PDF_DOWNLOAD_WINDOW', 50))
+    # no more letter PDFs start downloading while the ones downloaded ahead of the zip take up this many bytes
+    LETTER_PDF_DOWNLOAD_WINDOW_BYTES = int(os.getenv('LETTER_PDF_DOWNLOAD_WINDOW_BYTES', 64 * 1024 * 1024))
+    # zips bigger than this are moved out of memory into a temporary file under LOCAL_FILE_STORAGE_PATH
+    ZIP_MEMORY_BUDGET_BYTES = int(os.getenv('ZIP_MEMORY_BUDGET_BYTES', 256 * 1024 * 1024))
+    # deflate level from 1 to 9 that letters are compressed at in zips, trading CPU time for fewer bytes sent to DVLA.
+    # 0 stores them uncompressed. Letters that don't get any smaller are stored either way
+    ZIP_COMPRESSION_LEVEL = int(os.getenv('ZIP_COMPRESSION_LEVEL', 0))
+    # letters compressed at once, on threads
+    ZIP_COMPRESSION_CONCURRENCY = int(os.getenv('ZIP_COMPRESSION_CONCURRENCY', 4))
+    # letter PDFs downloaded from S3 are kept under LOCAL_FILE_STORAGE_PATH up to this many bytes, so that retries
+    # don't download them again. It shares the app's disk quota (1GB by default on PaaS) with spilled zips and zip
+    # checkpoints, so it's off (0) unless the quota has been raised to make room for it
+    PDF_CACHE_MAX_BYTES = int(os.getenv('PDF_CACHE_MAX_BYTES', 0))
+    # seconds a zip that failed to send is kept under LOCAL_FILE_STORAGE_PATH for the task's retries to reuse. This
+    # must be longer than all of the task's retries put together
+    ZIP_CHECKPOINT_TTL = int(os.getenv('ZIP_CHECKPOINT_TTL', 24 * 60 * 60))
+    # when the worker runs several tasks at once on threads, the most memory their letters and zips may take up
+    # between them - see AdmissionController. 0 doesn't limit it, which is fine for a worker running one task at a time
+    MAX_IN_FLIGHT_ZIP_BYTES = int(os.getenv('MAX_IN_FLIGHT_ZIP_BYTES', 0))
+    # tasks sent to notifications api at once when a zip's references need more than one SQS message
+    NOTIFICATION_UPDATE_CONCURRENCY = int(os.getenv('NOTIFICATION_UPDATE_CONCURRENCY', 4))
+
     DVLA_JOB_BUCKET_NAME = None
     DVLA_API_BUCKET_NAME = None
 
     LETTERS_PDF_BUCKET_NAME = None
 
+    # seconds a listing of a day's zips_sent records is reused for when checking whether a zip has already been
+    # sent. This must stay well below the task's retry delay.
+    ZIPS_SENT_LEDGER_TTL = int(os.getenv('ZIPS_SENT_LEDGER_TTL', 60))
+    # seconds after a zip is sent that its day's zips sent index is rebuilt, so that the rebuild covers every zip sent
+    # in the meantime. SQS won't delay messages for more than 15 minutes
+    ZIPS_SENT_INDEX_BUILD_DELAY = int(os.getenv('ZIPS_SENT_INDEX_BUILD_DELAY', 300))
+
 ######################
 # Config overrides ###
 ######################
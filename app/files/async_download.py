@@ -0,0 +1,241 @@
+import asyncio
+import math
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from botocore.exceptions import ClientError
+
+THROTTLING_ERROR_CODES = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', '503'}
+MAX_ATTEMPTS = 4
+THROTTLING_BACKOFF_SECONDS = 0.5
+# throughput has to improve by at least this much between rounds before we add more concurrency
+THROUGHPUT_IMPROVEMENT = 0.05
+
+
+class AdaptiveConcurrencyLimit(object):
+    '''Limits how many downloads run at once, adjusting the limit as downloads complete.
+
+    Throughput is measured over rounds of `limit` completed downloads. While each round is faster than the last the
+    limit grows by a quarter, and whenever S3 throttles us it is halved.'''
+
+    def __init__(self, initial, minimum, maximum):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = min(max(initial, minimum), maximum)
+        self.in_flight = 0
+        self.previous_throughput = 0
+        self._start_round(time.monotonic())
+
+    @asynccontextmanager
+    async def slot(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+    def record_download(self, size, now):
+        self.round_bytes += size
+        self.round_downloads += 1
+        if self.round_downloads < self.limit:
+            return
+
+        throughput = self.round_bytes / max(now - self.round_start, 1e-6)
+        if throughput > self.previous_throughput * (1 + THROUGHPUT_IMPROVEMENT):
+            self.limit = min(self.limit + math.ceil(self.limit / 4), self.maximum)
+        self.previous_throughput = throughput
+        self._start_round(now)
+
+    def record_throttling(self, now):
+        self.limit = max(self.limit // 2, self.minimum)
+        self.previous_throughput = 0
+        self._start_round(now)
+
+    def _start_round(self, now):
+        self.round_start = now
+        self.round_bytes = 0
+        self.round_downloads = 0
+
+    async def __aenter__(self):
+        # the condition has to be created by the event loop that waits on it
+        self.condition = asyncio.Condition()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class DownloadWindow(object):
+    '''Admits files one at a time, in order, while fewer than max_files are downloading or waiting to be consumed, and
+    only lets a download start while the files that have been downloaded but not consumed take up less than
+    max_bytes - unless it's the next file the consumer needs, which would otherwise never arrive.
+
+    Only the event loop's thread changes the counts, so they don't need a lock.'''
+
+    def __init__(self, max_files, max_bytes):
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.files = 0
+        self.bytes = 0
+        self.next_index = 0
+
+    async def admit(self):
+        await self._wait_for(lambda: self.files < self.max_files)
+        self.files += 1
+
+    async def start(self, index):
+        await self._wait_for(lambda: index <= self.next_index or self.bytes < self.max_bytes)
+
+    def downloaded(self, size):
+        self.bytes += size
+
+    def consumed(self, size):
+        self.files -= 1
+        self.bytes -= size
+        self.next_index += 1
+        self.changed.set()
+
+    async def _wait_for(self, predicate):
+        while not predicate():
+            self.changed.clear()
+            await self.changed.wait()
+
+    async def __aenter__(self):
+        # the event has to be created by the event loop that waits on it
+        self.changed = asyncio.Event()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class AsyncDownloader(object):
+    '''Downloads files concurrently with an asyncio event loop running on a background thread.
+
+    `download(filename)` is a blocking call returning the file's contents, run on a thread pool big enough for
+    max_concurrency downloads, while an AdaptiveConcurrencyLimit decides how many actually run at once. Files are
+    handed over in the order they were given, and a DownloadWindow of `window` files and `window_bytes` bytes limits
+    how far ahead of the consumer the downloads get.'''
+
+    def __init__(self, download, window, window_bytes, initial_concurrency, min_concurrency, max_concurrency):
+        self.download = download
+        self.window_files = window
+        self.window_bytes = window_bytes
+        self.initial_concurrency = initial_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+
+    def __call__(self, filenames):
+        '''Yields (filename, data) for each filename, in order, as soon as it and every filename before it have been
+        downloaded.'''
+        results = queue.Queue()
+        loop = asyncio.new_event_loop()
+        downloader = threading.Thread(
+            target=self._run, args=(loop, filenames, results), name='async-s3-download', daemon=True
+        )
+        downloader.start()
+        try:
+            yield from self._in_order(loop, results)
+        finally:
+            _call_soon_threadsafe(loop, _cancel_all_tasks, loop)
+            downloader.join()
+
+    def _in_order(self, loop, results):
+        downloaded = {}
+        next_index = 0
+        while True:
+            index, filename, data, error = results.get()
+            if error is not None:
+                raise error
+            if index is None:
+                return
+            downloaded[index] = (filename, data)
+            while next_index in downloaded:
+                filename, data = downloaded.pop(next_index)
+                next_index += 1
+                _call_soon_threadsafe(loop, self.window.consumed, len(data))
+                yield filename, data
+
+    def _run(self, loop, filenames, results):
+        try:
+            loop.run_until_complete(self._download_all(filenames, results))
+            results.put((None, None, None, None))
+        except BaseException as e:
+            results.put((None, None, None, e))
+        finally:
+            loop.close()
+
+    async def _download_all(self, filenames, results):
+        # asyncio primitives have to be created by the event loop that waits on them
+        self.window = DownloadWindow(self.window_files, self.window_bytes)
+        limit = AdaptiveConcurrencyLimit(self.initial_concurrency, self.min_concurrency, self.max_concurrency)
+        async with self.window, limit, _executor(self.max_concurrency) as executor:
+            downloads = []
+            try:
+                # files are admitted to the window in order, so the next file the consumer needs is always in it
+                for index, filename in enumerate(filenames):
+                    await self.window.admit()
+                    downloads.append(asyncio.ensure_future(
+                        self._download_into_window(index, filename, limit, executor, results)
+                    ))
+                await asyncio.gather(*downloads)
+            except BaseException:
+                for download in downloads:
+                    download.cancel()
+                await asyncio.gather(*downloads, return_exceptions=True)
+                raise
+
+    async def _download_into_window(self, index, filename, limit, executor, results):
+        await self.window.start(index)
+        try:
+            data = await self._download_with_backoff(filename, limit, executor)
+        except Exception as e:
+            # hand the error over straight away, rather than once every file has been admitted to the window
+            results.put((None, None, None, e))
+            raise
+        self.window.downloaded(len(data))
+        results.put((index, filename, data, None))
+
+    async def _download_with_backoff(self, filename, limit, executor):
+        loop = asyncio.get_running_loop()
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            async with limit.slot():
+                try:
+                    data = await loop.run_in_executor(executor, self.download, filename)
+                except ClientError as e:
+                    if e.response['Error']['Code'] not in THROTTLING_ERROR_CODES or attempt == MAX_ATTEMPTS:
+                        raise
+                    limit.record_throttling(time.monotonic())
+                else:
+                    limit.record_download(len(data), time.monotonic())
+                    return data
+            await asyncio.sleep(THROTTLING_BACKOFF_SECONDS * 2 ** (attempt - 1))
+
+
+@asynccontextmanager
+async def _executor(max_workers):
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='async-s3-download')
+    try:
+        yield executor
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _call_soon_threadsafe(loop, callback, *args):
+    try:
+        loop.call_soon_threadsafe(callback, *args)
+    except RuntimeError:
+        # the event loop has already finished
+        pass
+
+
+def _cancel_all_tasks(loop):
+    for task in asyncio.all_tasks(loop):
+        task.cancel()
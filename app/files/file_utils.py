@@ -1,26 +1,256 @@
+import collections
 import concurrent.futures
+import itertools
+import threading
+import time
+from contextlib import closing
 
-import boto3
 from botocore.exceptions import ClientError
 from flask import current_app
 
+from app import pdf_cache, s3_client
+from app.celery.soft_time_limits import check_soft_time_limit
+from app.files.async_download import AsyncDownloader
 from app.files.in_memory_zip import InMemoryZip
+from app.files.zip_writer import encode_member, stored_zip_size
+from app.metrics import SlowestDownloads, Stage, timed_downloads
 
+# zips can't hold a time before the start of 1980
+EARLIEST_ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
 
-def get_zip_of_letter_pdfs_from_s3(filenames):
+
+def get_zip_of_letter_pdfs_from_s3(filenames, stop=None):
+    '''Returns the zip of the letters, or None if the stop Event is set before they have all been zipped - which
+    stops their downloads too.'''
+    imz = InMemoryZip(
+        memory_budget=current_app.config['ZIP_MEMORY_BUDGET_BYTES'],
+        spill_directory=current_app.config['LOCAL_FILE_STORAGE_PATH'],
+        date_time=get_zip_date_time(filenames),
+    )
+    zip_assembly = Stage('zip-assembly')
+    try:
+        with closing(get_encoded_letter_pdfs_from_s3(filenames)) as letter_pdfs:
+            for pdf_filename, member in letter_pdfs:
+                if stop is not None and stop.is_set():
+                    zip_assembly.outcome = 'abandoned'
+                    return None
+                with zip_assembly.timing():
+                    imz.append_member(pdf_filename, member)
+
+        with zip_assembly.timing():
+            zip_data = imz.read()
+        zip_assembly.objects = len(filenames)
+        zip_assembly.bytes = len(zip_data)
+        return zip_data
+    except BaseException:
+        zip_assembly.outcome = 'failure'
+        raise
+    finally:
+        zip_assembly.record()
+
+
+def get_zip_date_time(filenames):
+    '''The time the letters' zip gives as its members' modification time - midnight on the day the letters are from,
+    rather than when the zip is built, so that building the zip again makes exactly the same bytes and a retry can
+    resume uploading it. Letters that aren't in a folder named for their day get the earliest time a zip can hold.'''
+    folder = filenames[0].split('/')[0]
+    try:
+        return time.strptime(folder, '%Y-%m-%d')[:6]
+    except ValueError:
+        current_app.logger.warning('Letters folder {} is not a date, zipping them as of {}'.format(
+            folder, EARLIEST_ZIP_DATE_TIME
+        ))
+        return EARLIEST_ZIP_DATE_TIME
+
+
+def get_size_of_zip_of_letter_pdfs_from_s3(filenames):
+    '''Returns the size that get_zip_of_letter_pdfs_from_s3 would return a zip of, from the size of each letter on
+    S3 rather than by downloading them.'''
     bucket_name = current_app.config['LETTERS_PDF_BUCKET_NAME']
-    imz = InMemoryZip()
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-        future_files_from_s3 = {
-            executor.submit(_get_file_from_s3_in_memory, bucket_name, filename): filename for filename in filenames
-        }
-        for completed_file in concurrent.futures.as_completed(future_files_from_s3):
-            filename = future_files_from_s3[completed_file]
-            pdf_filename = filename.split('/')[-1]
-            imz.append(pdf_filename, completed_file.result())
+    with concurrent.futures.ThreadPoolExecutor(max_workers=current_app.config['S3_DOWNLOAD_CONCURRENCY']) as executor:
+        file_sizes = executor.map(lambda filename: _get_file_size_from_s3(bucket_name, filename), filenames)
+        return stored_zip_size(zip([filename.split('/')[-1] for filename in filenames], file_sizes))
+
+
+def get_letter_pdfs_from_s3(filenames):
+    '''Yields (pdf_filename, pdf_data) for each letter in the order of filenames, so that the same letters always
+    make the same zip.
+
+    Letters are downloaded ahead of the consumer while fewer than LETTER_PDF_DOWNLOAD_WINDOW are downloading or
+    waiting to be consumed, and the ones waiting take up less than LETTER_PDF_DOWNLOAD_WINDOW_BYTES - so memory use
+    is bounded by the window rather than by the number of filenames. S3_DOWNLOAD_ENGINE picks whether they are
+    downloaded by a fixed size thread pool or by an asyncio event loop that adapts its concurrency.'''
+    bucket_name = current_app.config['LETTERS_PDF_BUCKET_NAME']
+    download = SlowestDownloads(lambda filename: _get_file_from_s3_in_memory(bucket_name, filename))
+    if current_app.config['S3_DOWNLOAD_ENGINE'] == 'asyncio':
+        letter_pdfs = _get_letter_pdfs_from_s3_with_asyncio(filenames, download)
+    else:
+        letter_pdfs = _get_letter_pdfs_from_s3_with_threads(filenames, download)
+    return _reporting_pdf_cache(timed_downloads(letter_pdfs, download))
+
+
+def _reporting_pdf_cache(letter_pdfs):
+    try:
+        for letter_pdf in letter_pdfs:
+            # between letters is as far as a task gets through its zip after its soft time limit
+            check_soft_time_limit()
+            yield letter_pdf
+    finally:
+        letter_pdfs.close()
+        pdf_cache.report()
+
+
+def get_encoded_letter_pdfs_from_s3(filenames):
+    '''Yields (pdf_filename, EncodedMember) for each letter in the order of filenames, ready to be written to a zip -
+    deflated at ZIP_COMPRESSION_LEVEL as the letters are downloaded, if that isn't 0.'''
+    return encode_letter_pdfs(
+        get_letter_pdfs_from_s3(filenames),
+        current_app.config['ZIP_COMPRESSION_LEVEL'],
+        current_app.config['ZIP_COMPRESSION_CONCURRENCY'],
+    )
+
+
+def encode_letter_pdfs(letter_pdfs, compression_level, concurrency):
+    '''Yields (pdf_filename, EncodedMember) for each of the (pdf_filename, pdf_data) from letter_pdfs, in order.
+
+    Letters are compressed on `concurrency` threads - zlib doesn't hold the GIL while it compresses - while the ones
+    before them are being zipped, and at most `concurrency` letters are waiting to be compressed at once. The CPU time
+    spent compressing is recorded as the 'compression' stage, along with the bytes compressed.'''
+    if not compression_level:
+        return _store_letter_pdfs(letter_pdfs)
+    return _compress_letter_pdfs(letter_pdfs, compression_level, concurrency)
+
 
-    return imz.read()
+def _store_letter_pdfs(letter_pdfs):
+    with closing(letter_pdfs):
+        for pdf_filename, pdf_data in letter_pdfs:
+            yield pdf_filename, encode_member(pdf_data)
+
+
+def _compress_letter_pdfs(letter_pdfs, compression_level, concurrency):
+    stage = Stage('compression')
+    stage.bytes = stage.objects = 0
+    try:
+        with closing(_compress_in_order(letter_pdfs, compression_level, concurrency)) as members:
+            for pdf_filename, member, cpu_time in members:
+                stage.elapsed_time += cpu_time
+                stage.objects += 1
+                stage.bytes += member.file_size
+                yield pdf_filename, member
+    except GeneratorExit:
+        # whatever was zipping the letters has given up on them
+        stage.outcome = 'abandoned'
+        raise
+    except BaseException:
+        stage.outcome = 'failure'
+        raise
+    finally:
+        stage.record()
+
+
+def _compress_in_order(letter_pdfs, compression_level, concurrency):
+    '''Yields (pdf_filename, EncodedMember, seconds of CPU time spent compressing it) for each letter, in order.'''
+    def compress(pdf_data):
+        start = time.thread_time()
+        member = encode_member(pdf_data, compression_level)
+        return member, time.thread_time() - start
+
+    # (pdf_filename, future) for each letter being compressed, in the order of letter_pdfs
+    compressions = collections.deque()
+    with closing(letter_pdfs), concurrent.futures.ThreadPoolExecutor(
+        max_workers=concurrency, thread_name_prefix='zip-compression'
+    ) as executor:
+        try:
+            for pdf_filename, pdf_data in letter_pdfs:
+                compressions.append((pdf_filename, executor.submit(compress, pdf_data)))
+                if len(compressions) > concurrency:
+                    pdf_filename, compressed = compressions.popleft()
+                    yield (pdf_filename, *compressed.result())
+            while compressions:
+                pdf_filename, compressed = compressions.popleft()
+                yield (pdf_filename, *compressed.result())
+        finally:
+            for _, compressed in compressions:
+                compressed.cancel()
+
+
+def _get_letter_pdfs_from_s3_with_asyncio(filenames, download_letter_pdf):
+    download = AsyncDownloader(
+        download=download_letter_pdf,
+        window=current_app.config['LETTER_PDF_DOWNLOAD_WINDOW'],
+        window_bytes=current_app.config['LETTER_PDF_DOWNLOAD_WINDOW_BYTES'],
+        initial_concurrency=current_app.config['S3_DOWNLOAD_CONCURRENCY'],
+        min_concurrency=current_app.config['S3_ASYNC_MIN_CONCURRENCY'],
+        max_concurrency=current_app.config['S3_ASYNC_MAX_CONCURRENCY'],
+    )
+    for filename, pdf_data in download(filenames):
+        yield filename.split('/')[-1], pdf_data
+
+
+def _get_letter_pdfs_from_s3_with_threads(filenames, download_letter_pdf):
+    concurrency = current_app.config['S3_DOWNLOAD_CONCURRENCY']
+    window = current_app.config['LETTER_PDF_DOWNLOAD_WINDOW']
+    byte_window = _ByteWindow(current_app.config['LETTER_PDF_DOWNLOAD_WINDOW_BYTES'])
+    remaining_filenames = enumerate(filenames)
+    # (filename, future) for each letter downloading or waiting to be consumed, in the order of filenames
+    downloads = collections.deque()
+
+    def download(index, filename):
+        if not byte_window.wait_to_start(index):
+            return None
+        pdf_data = download_letter_pdf(filename)
+        byte_window.downloaded(len(pdf_data))
+        return pdf_data
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        try:
+            for index, filename in itertools.islice(remaining_filenames, window):
+                downloads.append((filename, executor.submit(download, index, filename)))
+            while downloads:
+                filename, downloaded = downloads.popleft()
+                pdf_data = downloaded.result()
+                byte_window.consumed(len(pdf_data))
+                for index, filename_to_download in itertools.islice(remaining_filenames, 1):
+                    downloads.append((filename_to_download, executor.submit(download, index, filename_to_download)))
+                yield filename.split('/')[-1], pdf_data
+        finally:
+            byte_window.close()
+            for _, downloaded in downloads:
+                downloaded.cancel()
+
+
+class _ByteWindow(object):
+    '''Holds back downloads while the letters downloaded but not yet consumed take up max_bytes - unless it's the
+    next letter the consumer needs, which would otherwise never arrive.'''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.next_index = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def wait_to_start(self, index):
+        '''Returns once the download of the letter at index can start, or False if nobody wants it any more.'''
+        with self.condition:
+            self.condition.wait_for(lambda: self.closed or index <= self.next_index or self.bytes < self.max_bytes)
+            return not self.closed
+
+    def downloaded(self, size):
+        with self.condition:
+            self.bytes += size
+
+    def consumed(self, size):
+        with self.condition:
+            self.bytes -= size
+            self.next_index += 1
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
 
 
 def get_notification_references_from_s3_filenames(filenames):
@@ -29,22 +259,22 @@ def get_notification_references_from_s3_filenames(filenames):
 
 
 def _get_file_from_s3_in_memory(bucket_name, filename):
-    s3 = boto3.resource('s3')
-    obj = s3.Object(
-        bucket_name=bucket_name,
-        key=filename
-    )
-    return obj.get()["Body"].read()
+    return pdf_cache.get(bucket_name, filename)
+
+
+def _get_file_size_from_s3(bucket_name, filename):
+    return s3_client.client.head_object(Bucket=bucket_name, Key=filename)['ContentLength']
 
 
-def file_exists_on_s3(bucket_name, filename):
-    s3 = boto3.resource('s3')
+def upload_to_s3(bucket_name, filename, filedata):
     try:
-        s3.Object(bucket_name, filename).get()
-    except ClientError as e:
-        if e.response['Error']['Code'] == 'NoSuchKey':
-            return False
-        else:
-            current_app.logger.exception('Error checking to see if {}/{} exists'.format(bucket_name, filename))
-            raise
-    return True
+        s3_client.client.put_object(
+            Bucket=bucket_name,
+            Key=filename,
+            Body=filedata,
+            ServerSideEncryption='AES256',
+            ContentType='binary/octet-stream',
+        )
+    except ClientError:
+        current_app.logger.error('Unable to upload file to S3 bucket {}'.format(bucket_name))
+        raise
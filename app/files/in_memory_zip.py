@@ -1,28 +1,65 @@
-import zipfile
+import mmap
+import os
+import tempfile
 from io import BytesIO
 
+from app.files.zip_writer import ZipWriter
+
 
 class InMemoryZip(object):
-    def __init__(self):
-        # Create the in-memory file-like object
-        self.in_memory_zip = BytesIO()
+    def __init__(self, memory_budget=None, spill_directory=None, date_time=None):
+        # Create the in-memory file-like object, which moves to disk if the zip grows past memory_budget bytes
+        if memory_budget is None:
+            self.in_memory_zip = BytesIO()
+        else:
+            self.in_memory_zip = SpillingBuffer(memory_budget, spill_directory)
+        self.zip_writer = ZipWriter(self.in_memory_zip, date_time)
 
     def append(self, filename_in_zip, file_contents):
         '''Appends a file with name filename_in_zip and contents of
         file_contents to the in-memory zip.'''
-        # Get a handle to the in-memory zip in append mode
-        with zipfile.ZipFile(self.in_memory_zip, "a", zipfile.ZIP_STORED, False) as zf:
-            # Write the file to the in-memory zip
-            zf.writestr(filename_in_zip, file_contents)
+        self.zip_writer.write(filename_in_zip, file_contents)
+
+        return self
 
-            # Mark the files as having been created on Windows so that
-            # Unix permissions are not inferred as 0000
-            for zfile in zf.filelist:
-                zfile.create_system = 0
+    def append_member(self, filename_in_zip, member):
+        '''Appends an EncodedMember, which may be compressed, with name filename_in_zip.'''
+        self.zip_writer.write_member(filename_in_zip, *member)
 
         return self
 
     def read(self):
-        '''Returns a string with the contents of the in-memory zip.'''
-        self.in_memory_zip.seek(0)
-        return self.in_memory_zip.read()
+        '''Finishes the zip and returns a read-only view of its contents,
+        without copying them out of the in-memory buffer or spill file.'''
+        self.zip_writer.close()
+        return self.in_memory_zip.getbuffer().toreadonly()
+
+
+class SpillingBuffer(object):
+    '''A write-only buffer that keeps its contents in memory until they would grow past max_size bytes, then moves
+    them to an anonymous temporary file in spill_directory.'''
+
+    def __init__(self, max_size, spill_directory):
+        self.max_size = max_size
+        self.spill_directory = os.path.expanduser(spill_directory)
+        self.buffer = BytesIO()
+        self.spilled = False
+
+    def write(self, data):
+        if not self.spilled and self.buffer.tell() + len(data) > self.max_size:
+            self._spill()
+        return self.buffer.write(data)
+
+    def getbuffer(self):
+        if not self.spilled:
+            return self.buffer.getbuffer()
+        # map the file rather than reading it back, so the kernel pages it in as it is uploaded
+        self.buffer.flush()
+        return memoryview(mmap.mmap(self.buffer.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def _spill(self):
+        os.makedirs(self.spill_directory, exist_ok=True)
+        spill_file = tempfile.TemporaryFile(dir=self.spill_directory)
+        spill_file.write(self.buffer.getbuffer())
+        self.buffer = spill_file
+        self.spilled = True
@@ -0,0 +1,135 @@
+import hashlib
+import os
+import tempfile
+import threading
+
+from botocore.exceptions import ClientError
+from flask import current_app
+
+# once the cache is over its size cap, least recently used letters are deleted until it's back under this fraction
+# of the cap, so that we don't have to look through the whole cache every time a letter is added
+EVICTION_TARGET = 0.9
+
+
+class PdfCache():
+    '''Keeps a copy on local disk of each letter PDF downloaded from S3, so a task that retries after a failed upload
+    doesn't have to download every letter again.
+
+    Copies are stored by bucket and key along with the object's ETag, and are only used once a conditional GET has
+    confirmed that the object hasn't changed since - which costs a request but not the download. The cache is capped
+    at PDF_CACHE_MAX_BYTES, deleting the least recently used letters first, and a cap of 0 turns it off.
+
+    Hits and misses are counted as letters are downloaded, and sent to statsd by `report` after each zip's letters.'''
+
+    def __init__(self, s3_client):
+        self.s3_client = s3_client
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        self.directory = os.path.join(os.path.expanduser(app.config.get('LOCAL_FILE_STORAGE_PATH')), 'pdf-cache')
+        self.max_bytes = app.config.get('PDF_CACHE_MAX_BYTES')
+        # bytes cached, counted from disk when we first add to the cache
+        self.size = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, bucket_name, key):
+        if not self.max_bytes:
+            return self.s3_client.get_object_data(bucket_name, key)[1]
+
+        path = os.path.join(self.directory, _cache_filename(bucket_name, key))
+        cached_etag, cached_data = _read(path)
+        try:
+            if cached_etag is None:
+                etag, data = self.s3_client.get_object_data(bucket_name, key)
+            else:
+                etag, data = self.s3_client.get_object_data(bucket_name, key, IfNoneMatch=cached_etag)
+        except ClientError as e:
+            if e.response['Error']['Code'] != '304':
+                raise
+            self._record_hit(path)
+            return cached_data
+
+        self._record_miss(path, etag, data)
+        return data
+
+    def report(self):
+        '''Sends the hits and misses since the last report to statsd. Tasks running at once on threads share the
+        counts, so each one reports whatever has built up - which still reports every hit and miss exactly once.'''
+        with self.lock:
+            hits, misses = self.hits, self.misses
+            self.hits = self.misses = 0
+        if hits or misses:
+            current_app.statsd_client.incr('zip-and-send.pdf-cache.hit.objects', hits)
+            current_app.statsd_client.incr('zip-and-send.pdf-cache.miss.objects', misses)
+
+    def _record_hit(self, path):
+        with self.lock:
+            self.hits += 1
+        try:
+            # the file's modified time is when it was last used, for eviction
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _record_miss(self, path, etag, data):
+        with self.lock:
+            self.misses += 1
+        try:
+            self._store(path, etag, data)
+        except OSError:
+            # the cache only saves downloads, so running out of disk space mustn't fail the task
+            pass
+
+    def _store(self, path, etag, data):
+        os.makedirs(self.directory, exist_ok=True)
+        # write to a temporary file first, so other processes sharing the cache never read a partly written letter
+        with tempfile.NamedTemporaryFile(dir=self.directory, prefix='.', delete=False) as cache_file:
+            cache_file.write(etag.encode() + b'\n')
+            cache_file.write(data)
+        os.replace(cache_file.name, path)
+
+        with self.lock:
+            if self.size is None:
+                self.size = sum(size for _, size, _ in self._cached_files())
+            else:
+                self.size += len(etag) + 1 + len(data)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        cached_files = sorted(self._cached_files())
+        self.size = sum(size for _, size, _ in cached_files)
+        for _, size, path in cached_files:
+            if self.size <= self.max_bytes * EVICTION_TARGET:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+    def _cached_files(self):
+        '''Returns (last used, size, path) for each file in the cache, which other processes may be changing.'''
+        cached_files = []
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            cached_files.append((stat.st_mtime, stat.st_size, entry.path))
+        return cached_files
+
+
+def _cache_filename(bucket_name, key):
+    return hashlib.sha256('{}/{}'.format(bucket_name, key).encode()).hexdigest()
+
+
+def _read(path):
+    '''Returns the ETag and contents of a cached letter, or (None, None) if it isn't cached.'''
+    try:
+        with open(path, 'rb') as cache_file:
+            etag = cache_file.readline()[:-1].decode()
+            return etag, cache_file.read()
+    except FileNotFoundError:
+        return None, None
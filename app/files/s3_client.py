@@ -0,0 +1,102 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError, IncompleteReadError
+
+# bytes read from a response at a time when copying it into a download's buffer
+READ_CHUNK_SIZE = 1024 * 1024
+WARM_UP_OPERATIONS = ('GetObject', 'HeadObject', 'PutObject', 'ListObjectsV2')
+
+
+class S3Client():
+    '''A single boto3 S3 client shared by every thread in the worker process.
+
+    boto3 clients are thread safe, and sharing one means each download reuses a pooled, already authenticated
+    connection instead of building a new session and TLS connection for every letter.'''
+
+    def init_app(self, app, tasks_at_once=1):
+        # imported here to keep it off the import path of the app
+        import boto3
+        from botocore.config import Config
+
+        max_pool_connections = app.config.get('S3_DOWNLOAD_CONCURRENCY')
+        if app.config.get('S3_DOWNLOAD_ENGINE') == 'asyncio':
+            max_pool_connections = app.config.get('S3_ASYNC_MAX_CONCURRENCY')
+        # every task running at once in the process downloads its letters at once over this one client
+        max_pool_connections *= tasks_at_once
+
+        self.ranged_get_threshold = app.config.get('S3_RANGED_GET_THRESHOLD', 0)
+        self.ranged_get_part_size = app.config.get('S3_RANGED_GET_PART_SIZE')
+        ranged_get_concurrency = app.config.get('S3_RANGED_GET_CONCURRENCY', 0)
+        # parts get their own threads, so a download waiting on its parts can never hold up the parts themselves.
+        # They're shared by every task in the process, so only need the one set of connections between them
+        self.ranged_get_executor = ThreadPoolExecutor(
+            max_workers=max(ranged_get_concurrency, 1), thread_name_prefix='s3-ranged-get'
+        )
+
+        self.client = boto3.client(
+            's3',
+            region_name=app.config.get('AWS_REGION'),
+            config=Config(max_pool_connections=max_pool_connections + ranged_get_concurrency),
+        )
+
+    def warm_up(self):
+        '''Loads the models of the S3 operations we use, which boto3 only loads on their first call.'''
+        for operation_name in WARM_UP_OPERATIONS:
+            self.client.meta.service_model.operation_model(operation_name)
+        self.client.get_paginator('list_objects_v2')
+
+    def get_object_data(self, bucket_name, key, **conditions):
+        '''Returns the ETag and contents of an object, passing conditions such as IfNoneMatch on to the first GET.
+
+        Objects bigger than S3_RANGED_GET_THRESHOLD are downloaded as several concurrent byte range GETs of
+        S3_RANGED_GET_PART_SIZE bytes, so that a large letter isn't limited to a single TCP stream. Every part is read
+        straight into its place in one buffer the size of the object.'''
+        if not self.ranged_get_threshold:
+            response = self.client.get_object(Bucket=bucket_name, Key=key, **conditions)
+            return response['ETag'], response['Body'].read()
+
+        try:
+            # the first GET is all that objects up to the threshold need, and tells us the size of bigger ones
+            response = self.client.get_object(
+                Bucket=bucket_name, Key=key, Range='bytes=0-{}'.format(self.ranged_get_threshold - 1), **conditions
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidRange':
+                raise
+            # S3 won't return a range of an empty object
+            response = self.client.get_object(Bucket=bucket_name, Key=key, **conditions)
+            return response['ETag'], response['Body'].read()
+
+        etag = response['ETag']
+        data = bytearray(int(response['ContentRange'].split('/')[-1]))
+        _read_into(response['Body'], memoryview(data)[:response['ContentLength']])
+
+        parts = [
+            self.ranged_get_executor.submit(self._get_part, bucket_name, key, etag, data, start)
+            for start in range(response['ContentLength'], len(data), self.ranged_get_part_size)
+        ]
+        try:
+            for part in parts:
+                part.result()
+        finally:
+            for part in parts:
+                part.cancel()
+        return etag, data
+
+    def _get_part(self, bucket_name, key, etag, data, start):
+        end = min(start + self.ranged_get_part_size, len(data))
+        # IfMatch makes sure every part comes from the same version of the object as the first
+        response = self.client.get_object(
+            Bucket=bucket_name, Key=key, Range='bytes={}-{}'.format(start, end - 1), IfMatch=etag
+        )
+        _read_into(response['Body'], memoryview(data)[start:end])
+
+
+def _read_into(body, buffer):
+    offset = 0
+    while offset < len(buffer):
+        chunk = body.read(min(READ_CHUNK_SIZE, len(buffer) - offset))
+        if not chunk:
+            raise IncompleteReadError(actual_bytes=offset, expected_bytes=len(buffer))
+        buffer[offset:offset + len(chunk)] = chunk
+        offset += len(chunk)
@@ -0,0 +1,111 @@
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+import time
+
+from flask import current_app
+
+
+class ZipCheckpoints():
+    '''Keeps zips that failed to upload on local disk, so that a task retrying the upload can go straight back to it
+    rather than downloading and zipping its letters again.
+
+    A checkpoint is the zip plus a sidecar recording its size, its sha256 and which letters are in it, and is only
+    reused if all three still match. Checkpoints are deleted once their zip has been sent, and any left behind by
+    tasks that gave up are deleted ZIP_CHECKPOINT_TTL seconds after they were written.'''
+
+    def init_app(self, app):
+        self.directory = os.path.join(os.path.expanduser(app.config.get('LOCAL_FILE_STORAGE_PATH')), 'zip-checkpoints')
+        self.ttl = app.config.get('ZIP_CHECKPOINT_TTL')
+
+    def load(self, upload_filename, filenames_to_zip):
+        '''Returns the checkpointed zip of filenames_to_zip, or None if there isn't a complete one.'''
+        zip_path, sidecar_path = self._paths(upload_filename)
+        try:
+            with open(sidecar_path) as sidecar_file:
+                sidecar = json.load(sidecar_file)
+            with open(zip_path, 'rb') as zip_file:
+                zip_data = memoryview(mmap.mmap(zip_file.fileno(), 0, access=mmap.ACCESS_READ))
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if sidecar != _sidecar(zip_data, filenames_to_zip):
+            current_app.logger.warning('Checkpoint of {} does not match its sidecar, discarding it'.format(
+                upload_filename
+            ))
+            self.delete(upload_filename)
+            return None
+        return zip_data
+
+    def size(self, upload_filename, filenames_to_zip):
+        '''Returns the size of the checkpointed zip of filenames_to_zip from its sidecar, without reading or hashing
+        the zip, or None if there isn't one.'''
+        _, sidecar_path = self._paths(upload_filename)
+        try:
+            with open(sidecar_path) as sidecar_file:
+                sidecar = json.load(sidecar_file)
+        except (FileNotFoundError, ValueError):
+            return None
+        if sidecar.get('letters_sha256') != _letters_sha256(filenames_to_zip):
+            return None
+        return sidecar.get('size')
+
+    def save(self, upload_filename, filenames_to_zip, zip_data):
+        self.collect_garbage()
+        zip_path, sidecar_path = self._paths(upload_filename)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # the sidecar is written last, so a checkpoint is only ever loaded once the zip is all there
+            _write_atomically(zip_path, zip_data)
+            _write_atomically(sidecar_path, json.dumps(_sidecar(zip_data, filenames_to_zip)).encode())
+        except OSError:
+            # the zip can still be sent without a checkpoint, it just won't survive a retry
+            current_app.logger.exception('Failed to checkpoint {}'.format(upload_filename))
+
+    def delete(self, upload_filename):
+        for path in self._paths(upload_filename):
+            _remove(path)
+
+    def collect_garbage(self):
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return
+        expired_before = time.time() - self.ttl
+        for entry in entries:
+            try:
+                if entry.stat().st_mtime < expired_before:
+                    _remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def _paths(self, upload_filename):
+        zip_path = os.path.join(self.directory, upload_filename)
+        return zip_path, zip_path + '.json'
+
+
+def _sidecar(zip_data, filenames_to_zip):
+    return {
+        'size': len(zip_data),
+        'sha256': hashlib.sha256(zip_data).hexdigest(),
+        'letters_sha256': _letters_sha256(filenames_to_zip),
+    }
+
+
+def _letters_sha256(filenames_to_zip):
+    return hashlib.sha256(json.dumps(filenames_to_zip).encode()).hexdigest()
+
+
+def _write_atomically(path, data):
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix='.', delete=False) as temporary_file:
+        temporary_file.write(data)
+    os.replace(temporary_file.name, path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
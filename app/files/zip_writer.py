@@ -0,0 +1,131 @@
+import struct
+import time
+import zlib
+from collections import namedtuple
+from zipfile import (
+    ZIP_DEFLATED,
+    ZIP_FILECOUNT_LIMIT,
+    ZIP_STORED,
+    LargeZipFile,
+    sizeCentralDir,
+    sizeEndCentDir,
+    sizeFileHeader,
+    stringCentralDir,
+    stringEndArchive,
+    stringFileHeader,
+    structCentralDir,
+    structEndArchive,
+    structFileHeader,
+)
+
+ZIP_VERSION = 20
+ZIP_OFFSET_LIMIT = (1 << 32) - 1
+# mark the files as having been created on Windows (create_system 0) so that unix permissions are not inferred as
+# 0000, but still record rw------- in the high bytes for unzip tools that do look at them
+EXTERNAL_ATTR = 0o600 << 16
+UTF8_FLAG = 0x800
+
+# a member's data as it goes in the zip, and what ZipWriter.write_member needs to know about it
+EncodedMember = namedtuple('EncodedMember', ['data', 'crc', 'file_size', 'compress_type'])
+
+
+class ZipWriter(object):
+    '''Writes a zip archive to any writable file-like object in a single forward pass.
+
+    Each member's CRC and size are known before it is written, so the local header and data are written once and
+    never revisited, and the central directory is written once when the archive is closed. The target only needs a
+    `write` method - it is never seeked or read.'''
+
+    def __init__(self, fileobj, date_time=None):
+        self.fileobj = fileobj
+        self.dos_time, self.dos_date = _dos_date_time(date_time or time.localtime(time.time())[:6])
+        self.central_directory = []
+        self.size = 0
+        self.closed = False
+
+    def write(self, filename_in_zip, file_contents):
+        '''Writes file_contents uncompressed as a member called filename_in_zip.'''
+        return self.write_member(filename_in_zip, *encode_member(file_contents))
+
+    def write_member(self, filename_in_zip, data, crc, file_size, compress_type):
+        '''Writes a member whose data has already been encoded with compress_type.'''
+        if self.closed:
+            raise ValueError('Attempt to write to a closed ZipWriter')
+        if len(self.central_directory) >= ZIP_FILECOUNT_LIMIT:
+            raise LargeZipFile('Files count would require ZIP64 extensions')
+
+        filename, flag_bits = _encode_filename(filename_in_zip)
+        compress_size = len(data)
+        header_offset = self.size
+        if header_offset + sizeFileHeader + len(filename) + compress_size > ZIP_OFFSET_LIMIT:
+            raise LargeZipFile('Zipfile size would require ZIP64 extensions')
+
+        fields = (flag_bits, compress_type, self.dos_time, self.dos_date, crc, compress_size, file_size)
+        self._write(struct.pack(
+            structFileHeader, stringFileHeader, ZIP_VERSION, 0, *fields, len(filename), 0
+        ) + filename)
+        self._write(data)
+        self.central_directory.append((filename, fields, header_offset))
+        return self
+
+    def close(self):
+        '''Writes the central directory and end record, and returns the total size of the archive.'''
+        if self.closed:
+            return self.size
+        self.closed = True
+
+        start_of_central_directory = self.size
+        self._write(b''.join(
+            struct.pack(
+                structCentralDir, stringCentralDir, ZIP_VERSION, 0, ZIP_VERSION, 0, *fields,
+                len(filename), 0, 0, 0, 0, EXTERNAL_ATTR, header_offset
+            ) + filename
+            for filename, fields, header_offset in self.central_directory
+        ))
+        entries = len(self.central_directory)
+        self._write(struct.pack(
+            structEndArchive, stringEndArchive, 0, 0, entries, entries,
+            self.size - start_of_central_directory, start_of_central_directory, 0
+        ))
+        return self.size
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.size += len(data)
+
+
+def encode_member(file_contents, compression_level=0):
+    '''Returns file_contents as an EncodedMember, deflated at compression_level - unless that's 0, or deflating
+    doesn't make it any smaller, in which case it's stored as it is.'''
+    crc = zlib.crc32(file_contents)
+    if compression_level:
+        # zip members are raw deflate streams, without zlib's header and checksum
+        compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        compressed = compressor.compress(file_contents) + compressor.flush()
+        if len(compressed) < len(file_contents):
+            return EncodedMember(compressed, crc, len(file_contents), ZIP_DEFLATED)
+    return EncodedMember(file_contents, crc, len(file_contents), ZIP_STORED)
+
+
+def stored_zip_size(members):
+    '''Returns the size of the zip ZipWriter.write would produce from (filename_in_zip, file_size) members.
+
+    Stored members take up exactly their own size, and every header has a fixed size plus the filename, so we don't
+    need the members' contents to know the size of the archive.'''
+    size = sizeEndCentDir
+    for filename_in_zip, file_size in members:
+        filename, _ = _encode_filename(filename_in_zip)
+        size += sizeFileHeader + sizeCentralDir + 2 * len(filename) + file_size
+    return size
+
+
+def _encode_filename(filename_in_zip):
+    try:
+        return filename_in_zip.encode('ascii'), 0
+    except UnicodeEncodeError:
+        return filename_in_zip.encode('utf-8'), UTF8_FLAG
+
+
+def _dos_date_time(date_time):
+    year, month, day, hour, minute, second = date_time
+    return (hour << 11) | (minute << 5) | (second // 2), ((year - 1980) << 9) | (month << 5) | day
@@ -0,0 +1,128 @@
+import concurrent.futures
+import gzip
+import json
+import zlib
+
+from botocore.exceptions import ClientError
+from flask import current_app
+
+from app.files.zips_sent_ledger import get_zips_sent_prefix
+
+# references are spread over this many objects a day. Changing it makes lookups miss days indexed before the change,
+# until they are rebuilt
+INDEX_BUCKETS = 16
+
+
+class ZipsSentIndex():
+    '''Answers which zip sent to DVLA a letter was in, from its notification reference, with a single object read.
+
+    Each day's index is split into INDEX_BUCKETS gzipped JSON objects by a hash of the reference, each mapping upload
+    filenames to the references in them that fall in that bucket. Tasks don't write to the index - each zip's
+    zips_sent record is all they write, and S3 couldn't stop several workers rewriting the same bucket at once from
+    losing each other's updates. Instead `rebuild` writes the whole of a day's index from its zips_sent records, in a
+    build-zips-sent-index task sent a few minutes after zips are sent.
+
+    A reference that isn't in the index may be in a zip sent since it was built, so lookups that miss fall back to
+    reading the day's zips_sent records.'''
+
+    def __init__(self, s3_client):
+        self.s3_client = s3_client
+
+    def init_app(self, app):
+        self.bucket_name = app.config.get('LETTERS_PDF_BUCKET_NAME')
+        self.concurrency = app.config.get('S3_DOWNLOAD_CONCURRENCY')
+
+    def lookup(self, folder_date, references):
+        '''Returns {reference: upload filename} for the zips sent on folder_date that references were in, with None
+        for references that weren't in any.'''
+        zips_by_reference = dict.fromkeys(references)
+        for bucket in {get_index_bucket(reference) for reference in references}:
+            _find(zips_by_reference, self._get_bucket(folder_date, bucket))
+
+        if None in zips_by_reference.values():
+            current_app.logger.info('Not all references are in the zips sent index for {}, reading zips_sent'.format(
+                folder_date
+            ))
+            _find(zips_by_reference, self._read_zips_sent(folder_date))
+        return zips_by_reference
+
+    def rebuild(self, folder_date):
+        '''Writes the day's index from its zips_sent records, returning how many zips were in them.'''
+        references_by_zip = self._read_zips_sent(folder_date)
+        references_by_bucket = _by_bucket(references_by_zip)
+        for bucket in range(INDEX_BUCKETS):
+            self._put_bucket(folder_date, bucket, references_by_bucket.get(bucket, {}))
+        return len(references_by_zip)
+
+    def _read_zips_sent(self, folder_date):
+        '''Returns {upload_filename: references} from every zips_sent record for the day.'''
+        # imported here because file_utils imports the app, which creates this index
+        from app.files.file_utils import (
+            get_notification_references_from_s3_filenames,
+        )
+
+        prefix = get_zips_sent_prefix(folder_date)
+        paginator = self.s3_client.client.get_paginator('list_objects_v2')
+        keys = [
+            obj['Key']
+            for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix)
+            for obj in page.get('Contents', [])
+        ]
+
+        def read_references(key):
+            response = self.s3_client.client.get_object(Bucket=self.bucket_name, Key=key)
+            return get_notification_references_from_s3_filenames(json.loads(response['Body'].read()))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return {
+                key[len(prefix):-len('.TXT')]: references
+                for key, references in zip(keys, executor.map(read_references, keys))
+            }
+
+    def _get_bucket(self, folder_date, bucket):
+        try:
+            response = self.s3_client.client.get_object(
+                Bucket=self.bucket_name, Key=get_zips_sent_index_filename(folder_date, bucket)
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] in {'404', 'NoSuchKey'}:
+                return {}
+            raise
+        return json.loads(gzip.decompress(response['Body'].read()))
+
+    def _put_bucket(self, folder_date, bucket, index):
+        self.s3_client.client.put_object(
+            Bucket=self.bucket_name,
+            Key=get_zips_sent_index_filename(folder_date, bucket),
+            Body=gzip.compress(json.dumps(index, separators=(',', ':'), sort_keys=True).encode()),
+            ContentType='application/gzip',
+            ServerSideEncryption='AES256',
+        )
+
+
+def get_index_bucket(reference):
+    return zlib.crc32(reference.encode()) % INDEX_BUCKETS
+
+
+def get_zips_sent_index_filename(folder_date, bucket):
+    # kept out of the zips_sent prefix, which should only hold one record per zip
+    return '{}/zips_sent_index/{:02}.json.gz'.format(folder_date, bucket)
+
+
+def _find(zips_by_reference, references_by_zip):
+    '''Fills in the upload filenames in zips_by_reference that are missing, from {upload_filename: references}.'''
+    for upload_filename, references in references_by_zip.items():
+        for reference in references:
+            if reference in zips_by_reference and zips_by_reference[reference] is None:
+                zips_by_reference[reference] = upload_filename
+
+
+def _by_bucket(references_by_zip):
+    '''Splits {upload_filename: references} into {bucket: {upload_filename: references in that bucket}}.'''
+    references_by_bucket = {}
+    for upload_filename, references in references_by_zip.items():
+        for reference in references:
+            references_by_bucket.setdefault(get_index_bucket(reference), {}).setdefault(
+                upload_filename, []
+            ).append(reference)
+    return references_by_bucket
@@ -0,0 +1,50 @@
+import threading
+import time
+
+
+class ZipsSentLedger():
+    '''Answers whether a zip has already been sent to DVLA, from a single listing of that day's zips_sent records.
+
+    The listing for each day is reused for ZIPS_SENT_LEDGER_TTL seconds, and zips this worker sends are added to it
+    as they go, so a busy day costs one request per ttl rather than one per zip. Only another worker sending the same
+    zip within the ttl could be missed, and each zip is only sent by one task - which doesn't retry within the ttl.'''
+
+    def __init__(self, s3_client):
+        self.s3_client = s3_client
+        self.days = {}
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        self.bucket_name = app.config.get('LETTERS_PDF_BUCKET_NAME')
+        self.ttl = app.config.get('ZIPS_SENT_LEDGER_TTL')
+        self.days = {}
+
+    def was_sent(self, folder_date, upload_filename):
+        with self.lock:
+            listed_at, upload_filenames = self.days.get(folder_date, (None, None))
+            if listed_at is None or time.monotonic() - listed_at > self.ttl:
+                upload_filenames = self._list_zips_sent(folder_date)
+                self.days[folder_date] = (time.monotonic(), upload_filenames)
+            return upload_filename in upload_filenames
+
+    def record_sent(self, folder_date, upload_filename):
+        with self.lock:
+            if folder_date in self.days:
+                self.days[folder_date][1].add(upload_filename)
+
+    def _list_zips_sent(self, folder_date):
+        prefix = get_zips_sent_prefix(folder_date)
+        paginator = self.s3_client.client.get_paginator('list_objects_v2')
+        return {
+            obj['Key'][len(prefix):-len('.TXT')]
+            for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix)
+            for obj in page.get('Contents', [])
+        }
+
+
+def get_zips_sent_prefix(folder_date):
+    return '{}/zips_sent/'.format(folder_date)
+
+
+def get_zips_sent_filename(folder_date, upload_filename):
+    return '{}{}.TXT'.format(get_zips_sent_prefix(folder_date), upload_filename)
@@ -0,0 +1,138 @@
+import heapq
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from flask import current_app
+
+# downloads given spans of their own in a task's sentry transaction, which only accepts so many spans
+SLOWEST_DOWNLOADS_TRACED = 20
+
+
+class Stage(object):
+    '''A stage of zipping and sending letters, reported to statsd under the stage's name and how it ended.
+
+    The outcome starts as 'success' and can be set to something more specific, like 'skipped'. Stages that move
+    data can set bytes and objects to report those too, along with the rate they were handled at.
+
+    Each stage is also a sentry span, from when it's created until it's recorded, which is sent as part of the
+    task's transaction if that is sampled.'''
+
+    def __init__(self, name):
+        # imported here to keep it off the import path of the app - worker processes are forked after it's imported
+        import sentry_sdk
+
+        self.name = name
+        self.outcome = 'success'
+        self.bytes = None
+        self.objects = None
+        self.elapsed_time = 0
+        self.span = sentry_sdk.start_span(op='zip-and-send.{}'.format(name))
+
+    @contextmanager
+    def timing(self):
+        '''Adds the time spent in the block to the stage, so a stage can be timed in several pieces.'''
+        start = time.monotonic()
+        try:
+            yield self
+        finally:
+            self.elapsed_time += time.monotonic() - start
+
+    def record(self):
+        self.span.set_tag('outcome', self.outcome)
+        if self.objects is not None:
+            self.span.set_data('objects', self.objects)
+        if self.bytes is not None:
+            self.span.set_data('bytes', self.bytes)
+        self.span.finish()
+
+        statsd_client = current_app.statsd_client
+        stat = 'zip-and-send.{}.{}'.format(self.name, self.outcome)
+        statsd_client.incr(stat)
+        statsd_client.timing(stat + '.elapsed-time', self.elapsed_time)
+        if self.objects is not None:
+            statsd_client.incr(stat + '.objects', self.objects)
+        if self.bytes is not None:
+            statsd_client.incr(stat + '.bytes', self.bytes)
+            statsd_client.gauge(stat + '.bytes-per-second', self.bytes / max(self.elapsed_time, 1e-6))
+
+
+@contextmanager
+def stage_timer(name):
+    '''Times the block as a Stage, which is recorded as a 'failure' if the block raises. The stage's span is the
+    current span in the block, so stages started within it are nested under it.'''
+    stage = Stage(name)
+    try:
+        with stage.span, stage.timing():
+            yield stage
+    except BaseException:
+        stage.outcome = 'failure'
+        raise
+    finally:
+        stage.record()
+
+
+def timed_downloads(letter_pdfs, slowest_downloads=None):
+    '''Yields (pdf_filename, pdf_data) from the letter_pdfs generator, recording the time spent waiting for them as
+    the 'download' stage - so that downloads can be told apart from the zipping and uploading they overlap with.
+
+    If the downloads were timed by slowest_downloads, the slowest ones are added to the stage's span.'''
+    stage = Stage('download')
+    stage.bytes = stage.objects = 0
+    try:
+        while True:
+            with stage.timing():
+                letter_pdf = next(letter_pdfs, None)
+            if letter_pdf is None:
+                return
+            stage.objects += 1
+            stage.bytes += len(letter_pdf[1])
+            yield letter_pdf
+    except GeneratorExit:
+        # whatever was using the letters has given up on them
+        stage.outcome = 'abandoned'
+        raise
+    except BaseException:
+        stage.outcome = 'failure'
+        raise
+    finally:
+        letter_pdfs.close()
+        if slowest_downloads is not None:
+            slowest_downloads.add_spans(stage.span)
+        stage.record()
+
+
+class SlowestDownloads(object):
+    '''Times downloads, which may be running on several threads, keeping the `keep` slowest - so that they can be
+    traced without a span for every letter.'''
+
+    def __init__(self, download, keep=SLOWEST_DOWNLOADS_TRACED):
+        self.download = download
+        self.keep = keep
+        # (duration, start, end, filename, size) as a min-heap, so the quickest of the slowest is popped first
+        self.slowest = []
+        self.lock = threading.Lock()
+
+    def __call__(self, filename):
+        start = time.time()
+        data = self.download(filename)
+        end = time.time()
+        with self.lock:
+            record = (end - start, start, end, filename, len(data))
+            if len(self.slowest) < self.keep:
+                heapq.heappush(self.slowest, record)
+            else:
+                heapq.heappushpop(self.slowest, record)
+        return data
+
+    def add_spans(self, parent_span):
+        with self.lock:
+            slowest = sorted(self.slowest, key=lambda record: record[1])
+        for _, start, end, filename, size in slowest:
+            span = parent_span.start_child(
+                op='zip-and-send.download.s3-get', description=filename,
+                start_timestamp=datetime.utcfromtimestamp(start),
+            )
+            span.set_data('bytes', size)
+            span.finish(end_timestamp=datetime.utcfromtimestamp(end))
@@ -1,4 +1,7 @@
 import os
+import random
+import threading
+import time
 from functools import partial
 
 
@@ -42,3 +45,126 @@ def init_performance_monitoring():
             traces_sampler=traces_sampler,
             release=release,
         )
+
+
+class TaskProfiler:
+    """Profiles celery tasks with cProfile and tracemalloc, writing a .prof file and a report of the biggest
+    allocations for each profiled task to directory.
+
+    Tasks are profiled if their name is in task_names and either one of the zips they send is in upload_filenames or
+    they are picked at random, sample_rate of the time. cProfile only sees the task's own thread, so time it spends
+    waiting for downloads on other threads shows up as waiting, while tracemalloc sees allocations from every thread -
+    including those of other tasks running at the same time on the threads pool.
+
+    Profiling slows tasks down considerably, so it should only ever be turned on for a handful of them."""
+
+    def __init__(
+        self,
+        directory: str,
+        task_names: set,
+        sample_rate: float = 0.0,
+        upload_filenames: set = frozenset(),
+        top_allocations: int = 25,
+        traceback_frames: int = 10,
+    ):
+        self.directory = directory
+        self.task_names = task_names
+        self.sample_rate = sample_rate
+        self.upload_filenames = upload_filenames
+        self.top_allocations = top_allocations
+        self.traceback_frames = traceback_frames
+        # guards profiles and starting and stopping tracemalloc, which tasks on the threads pool share
+        self.lock = threading.Lock()
+        # task id -> (profile, when it started) for the tasks being profiled in this process
+        self.profiles = {}
+
+    def should_profile(self, task_name: str, args: tuple, kwargs: dict) -> bool:
+        if task_name not in self.task_names:
+            return False
+        if self.upload_filenames & set(get_upload_filenames(task_name, args, kwargs)):
+            return True
+        return random.random() < self.sample_rate
+
+    def start(self, task_id: str, task_name: str, args: tuple, kwargs: dict):
+        if not self.should_profile(task_name, args, kwargs):
+            return
+
+        import cProfile
+        import tracemalloc
+
+        profile = cProfile.Profile()
+        with self.lock:
+            # tracing is started for the first of the tasks being profiled at once and stopped after the last of them
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.traceback_frames)
+            self.profiles[task_id] = (profile, time.time())
+        profile.enable()
+
+    def stop(self, task_id: str, task_name: str, args: tuple, kwargs: dict):
+        import tracemalloc
+
+        with self.lock:
+            if task_id not in self.profiles:
+                return
+            profile, started_at = self.profiles.pop(task_id)
+            profile.disable()
+            snapshot = tracemalloc.take_snapshot()
+            _, peak_traced = tracemalloc.get_traced_memory()
+            if not self.profiles:
+                tracemalloc.stop()
+
+        upload_filenames = get_upload_filenames(task_name, args, kwargs)
+        name = "{}-{}-{}".format(
+            time.strftime("%Y%m%dT%H%M%S", time.gmtime(started_at)),
+            task_name,
+            upload_filenames[0] if len(upload_filenames) == 1 else task_id,
+        )
+        os.makedirs(self.directory, exist_ok=True)
+        profile.dump_stats(os.path.join(self.directory, name + ".prof"))
+        with open(os.path.join(self.directory, name + ".allocations.txt"), "w") as report:
+            report.write("{} {} for {}\n".format(task_name, task_id, ", ".join(upload_filenames)))
+            report.write("peak traced memory: {:,} bytes\n\n".format(peak_traced))
+            for statistic in snapshot.statistics("traceback")[: self.top_allocations]:
+                report.write("{:,} bytes in {:,} blocks\n".format(statistic.size, statistic.count))
+                report.writelines("    {}\n".format(line) for line in statistic.traceback.format())
+
+
+def get_upload_filenames(task_name: str, args: tuple, kwargs: dict) -> list:
+    """The names of the zips a zip-and-send task is sending."""
+    if task_name == "zip-and-send-letter-pdfs":
+        return [kwargs["upload_filename"] if "upload_filename" in kwargs else args[1]]
+    if task_name == "zip-and-send-letter-pdfs-batch":
+        zips = kwargs["zips"] if "zips" in kwargs else args[0]
+        return [upload_filename for _, upload_filename in zips]
+    return []
+
+
+def init_task_profiling():
+    if not bool(int(os.getenv("PROFILING_ENABLED", "0"))):
+        return None
+
+    from celery.signals import task_postrun, task_prerun
+
+    task_profiler = TaskProfiler(
+        directory=os.getenv("PROFILING_DIRECTORY", "/tmp/notify-ftp-profiles"),
+        task_names=_split(
+            os.getenv("PROFILING_TASKS", "zip-and-send-letter-pdfs,zip-and-send-letter-pdfs-batch")
+        ),
+        sample_rate=float(os.getenv("PROFILING_SAMPLE_RATE", 0.0)),
+        upload_filenames=_split(os.getenv("PROFILING_UPLOAD_FILENAMES", "")),
+        top_allocations=int(os.getenv("PROFILING_TOP_ALLOCATIONS", 25)),
+    )
+
+    def start_profiling(task_id, task, args, kwargs, **_):
+        task_profiler.start(task_id, task.name, args, kwargs)
+
+    def stop_profiling(task_id, task, args, kwargs, **_):
+        task_profiler.stop(task_id, task.name, args, kwargs)
+
+    task_prerun.connect(start_profiling, weak=False)
+    task_postrun.connect(stop_profiling, weak=False)
+    return task_profiler
+
+
+def _split(names: str) -> set:
+    return {name.strip() for name in names.split(",") if name.strip()}
@@ -0,0 +1,106 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+class SftpConnectionPool(object):
+    '''Keeps authenticated SFTP connections open between tasks, so each upload doesn't pay for an SSH handshake.
+
+    `connect` opens a new pysftp connection. Connections are checked before being handed out, closed once they have
+    been idle for idle_timeout seconds, and replaced transparently if they have dropped. A connection that was in
+    use when an exception was raised is closed rather than returned to the pool. At most max_size connections are
+    open at once - callers wait for one to be returned when they are all in use.
+
+    Connections are only opened on first use, so a pool created before celery forks its workers stays empty in the
+    parent and each worker process gets its own connections.'''
+
+    def __init__(self, connect, max_size, idle_timeout, keepalive_interval):
+        self.connect = connect
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.keepalive_interval = keepalive_interval
+        # (connection, time it was returned to the pool), most recently used last
+        self.idle_connections = deque()
+        self.connections_in_use = 0
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def connection(self):
+        sftp = self._acquire()
+        try:
+            yield sftp
+        except BaseException:
+            self._discard(sftp)
+            raise
+        self._release(sftp)
+
+    def close_all(self):
+        with self.condition:
+            while self.idle_connections:
+                _close(self.idle_connections.popleft()[0])
+
+    def _acquire(self):
+        with self.condition:
+            self._close_expired_connections()
+            self.condition.wait_for(lambda: self.idle_connections or self.connections_in_use < self.max_size)
+            self.connections_in_use += 1
+            sftp = self.idle_connections.pop()[0] if self.idle_connections else None
+
+        try:
+            if sftp is not None and _is_healthy(sftp):
+                return sftp
+            if sftp is not None:
+                _close(sftp)
+            return self._open()
+        except BaseException:
+            self._discard(None)
+            raise
+
+    def _open(self):
+        sftp = self.connect()
+        if self.keepalive_interval:
+            _transport(sftp).set_keepalive(self.keepalive_interval)
+        return sftp
+
+    def _release(self, sftp):
+        with self.condition:
+            self.connections_in_use -= 1
+            self.idle_connections.append((sftp, time.monotonic()))
+            self.condition.notify()
+
+    def _discard(self, sftp):
+        if sftp is not None:
+            _close(sftp)
+        with self.condition:
+            self.connections_in_use -= 1
+            self.condition.notify()
+
+    def _close_expired_connections(self):
+        now = time.monotonic()
+        while self.idle_connections and now - self.idle_connections[0][1] > self.idle_timeout:
+            _close(self.idle_connections.popleft()[0])
+
+
+def _transport(sftp):
+    return sftp.sftp_client.get_channel().get_transport()
+
+
+def _is_healthy(sftp):
+    try:
+        if not _transport(sftp).is_active():
+            return False
+        # go back to the home directory, which is where a new connection would start, and make sure the server is
+        # still answering
+        sftp.chdir(None)
+        sftp.normalize('.')
+        return True
+    except Exception:
+        return False
+
+
+def _close(sftp):
+    try:
+        sftp.close()
+    except Exception:
+        pass
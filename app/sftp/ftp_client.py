@@ -1,10 +1,28 @@
+import socket
+import struct
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from zipfile import sizeEndCentDir, stringEndArchive, structEndArchive
 
-import pysftp
+from botocore.exceptions import ClientError
 from flask import current_app
 
+from app.celery.soft_time_limits import (
+    check_soft_time_limit,
+    current_deadline,
+    deadline_of_task,
+)
+from app.files.zip_writer import ZipWriter
+from app.metrics import stage_timer
+from app.sftp.connection_pool import SftpConnectionPool
+
 NOTIFY_SUBFOLDER = 'notify'
+# paramiko copies everything passed to write into its write buffer, so hand it the zip a chunk at a time
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# bytes of a partially uploaded file compared with the zip at each sampled offset before resuming the upload
+RESUME_SAMPLE_SIZE = 4096
 
 
 class FtpException(Exception):
@@ -14,18 +32,56 @@ class FtpException(Exception):
 class FtpClient():
     def init_app(self, app):
         self.host = app.config.get('FTP_HOST')
+        self.port = app.config.get('FTP_PORT', 22)
+        self.host_resolution_ttl = app.config.get('FTP_HOST_RESOLUTION_TTL', 0)
+        # (address, when it was resolved) for FTP_HOST, if warm_up has resolved it
+        self.resolved_host = None
         self.username = app.config.get('FTP_USERNAME')
         self.password = app.config.get('FTP_PASSWORD')
+        self.pool = SftpConnectionPool(
+            self._connect,
+            max_size=app.config.get('FTP_POOL_SIZE'),
+            idle_timeout=app.config.get('FTP_POOL_IDLE_TIMEOUT'),
+            keepalive_interval=app.config.get('FTP_KEEPALIVE_INTERVAL'),
+        )
+
+    def warm_up(self):
+        '''Imports pysftp and resolves FTP_HOST, so that worker processes forked afterwards don't each have to.'''
+        import pysftp  # noqa: F401
+
+        if self.host:
+            # only IPv4, since we connect to the one address rather than trying each in turn as pysftp does
+            address = socket.getaddrinfo(self.host, self.port, family=socket.AF_INET, type=socket.SOCK_STREAM)[0][4][0]
+            self.resolved_host = (address, time.monotonic())
+
+    def _connect(self):
+        import pysftp
+
+        cnopts = pysftp.CnOpts()
+        cnopts.hostkeys = None
+        current_app.logger.info("opening connection to {}".format(self.host))
+        with stage_timer('sftp-connect'):
+            sftp = pysftp.Connection(
+                self._host_address(), port=self.port, username=self.username, password=self.password, cnopts=cnopts
+            )
+        sftp.timeout = 30
+        return sftp
+
+    def _host_address(self):
+        '''The address warm_up resolved FTP_HOST to, while it's recent enough to trust, or else FTP_HOST itself to be
+        resolved when connecting.'''
+        if self.resolved_host is not None and time.monotonic() - self.resolved_host[1] < self.host_resolution_ttl:
+            return self.resolved_host[0]
+        return self.host
 
     @contextmanager
     def _sftp(self):
         try:
-            cnopts = pysftp.CnOpts()
-            cnopts.hostkeys = None
-            current_app.logger.info("opening connection to {}".format(self.host))
-            with pysftp.Connection(self.host, username=self.username, password=self.password, cnopts=cnopts) as sftp:
-                sftp.timeout = 30
+            with self.pool.connection() as sftp:
                 yield sftp
+        except ClientError:
+            # letters that fail to download from S3 while being streamed to the ftp server aren't an FTP failure
+            raise
         except Exception as e:
             # reraise all exceptions as FtpException to ensure we can handle them down the line
             current_app.logger.exception(e)
@@ -35,12 +91,73 @@ class FtpClient():
         with self._sftp() as sftp:
             upload_zip(sftp, zip_data, filename)
 
+    def stream_zip(self, letter_pdfs, filename, date_time=None):
+        with self._sftp() as sftp:
+            return stream_zip(sftp, letter_pdfs, filename, date_time)
+
+    @contextmanager
+    def session(self):
+        '''An FtpSession for sending several zips over the same connection.'''
+        with self._sftp() as sftp:
+            yield FtpSession(sftp, current_app.config['FTP_DIRECTORY_CACHE_TTL'])
+
+    def get_remote_zip_size(self, filename):
+        '''Returns the size of filename on the DVLA ftp server, or None if it isn't there or is clearly only part of a
+        zip - see is_complete_zip.'''
+        with self._sftp() as sftp:
+            sftp.chdir(NOTIFY_SUBFOLDER)
+            remote_size = get_remote_size(sftp, filename)
+            if remote_size is None or not is_complete_zip(sftp, filename, remote_size):
+                return None
+            return remote_size
+
     def file_exists_with_correct_size(self, filename, zip_data_len):
         with self._sftp() as sftp:
+            sftp.chdir(NOTIFY_SUBFOLDER)
             check_file_exist_and_is_right_size(sftp, filename, zip_data_len)
 
 
-def upload_zip(sftp, zip_data, filename):
+class FtpSession(object):
+    '''Sends zips one after another over a single connection, checking for files already on the server against one
+    listing of the remote directory rather than a stat for each zip.'''
+
+    def __init__(self, sftp, directory_cache_ttl):
+        self.sftp = sftp
+        self.remote_directory = RemoteDirectoryCache(sftp, directory_cache_ttl)
+
+    def send_zip(self, zip_data, filename):
+        # go back to the home directory, which is where each upload expects to start
+        self.sftp.chdir(None)
+        upload_zip(self.sftp, zip_data, filename, self.remote_directory)
+
+
+class RemoteDirectoryCache(object):
+    '''The sizes of the files in the current remote directory, from a single listing that is reused for ttl seconds.
+
+    This lets a task answer pre-upload and post-upload checks for many files without a round trip for each one.
+    Call refresh() after uploading files to see them.'''
+
+    def __init__(self, sftp, ttl):
+        self.sftp = sftp
+        self.ttl = ttl
+        self.sizes = None
+        self.listed_at = None
+
+    def size(self, filename):
+        if self.sizes is None or time.monotonic() - self.listed_at > self.ttl:
+            self.refresh()
+        return self.sizes.get(filename)
+
+    def refresh(self):
+        self.sizes = {attributes.filename: attributes.st_size for attributes in self.sftp.listdir_attr()}
+        self.listed_at = time.monotonic()
+
+    def record(self, filename, size):
+        if self.sizes is not None:
+            self.sizes[filename] = size
+
+
+def upload_zip(sftp, zip_data, filename, remote_directory=None):
     sftp.chdir(NOTIFY_SUBFOLDER)
     zip_data_len = len(zip_data)
 
@@ -48,42 +165,209 @@ def upload_zip(sftp, zip_data, filename):
 
     start_time = time.monotonic()
 
-    if sftp.exists('{}/{}'.format(sftp.pwd, filename)):
-        stats = sftp.lstat('{}/{}'.format(sftp.pwd, filename))
-        if stats.st_size == zip_data_len:
-            current_app.logger.info('{} already exists on DVLA ftp with matching filesize {}, skipping'.format(
-                filename, stats.st_size
-            ))
-            return
-        else:
-            current_app.logger.info('{} already exists on DVLA ftp with different filesize {}, overwriting'.format(
-                filename, stats.st_size
-            ))
+    remote_path = '{}/{}'.format(sftp.getcwd(), filename)
+    chunk_size = current_app.config['FTP_UPLOAD_CHUNK_SIZE']
+    zip_data = memoryview(zip_data)
+
+    resume_from = get_resume_offset(sftp, remote_path, filename, zip_data, chunk_size, remote_directory)
+    if resume_from is None:
+        return
 
     upload_start_time = time.monotonic()
 
-    with sftp.open('{}/{}'.format(sftp.pwd, filename), mode='w') as remote_file:
-        remote_file.set_pipelined()
-        zip_data = memoryview(zip_data)
-        remote_file.write(zip_data)
+    channels = current_app.config['FTP_UPLOAD_CHANNELS']
+    with stage_timer('upload') as upload:
+        upload.bytes = zip_data_len - resume_from
+        if channels > 1 and zip_data_len - resume_from > chunk_size:
+            write_in_parallel(sftp, remote_path, zip_data, resume_from, chunk_size, channels)
+        else:
+            channels = 1
+            with sftp.open(remote_path, mode='r+' if resume_from else 'w') as remote_file:
+                remote_file.set_pipelined()
+                remote_file.seek(resume_from)
+                write_in_chunks(remote_file, zip_data[resume_from:])
 
     upload_duration = time.monotonic() - upload_start_time
+    uploaded_len = zip_data_len - resume_from
 
-    current_app.logger.info("uploaded file {} of total size {} bytes in {} seconds".format(
-        filename, zip_data_len, upload_duration))
+    current_app.logger.info(
+        "uploaded {} bytes of file {} of total size {} bytes in {} seconds ({:.2f} MB/s over {} channels)".format(
+            uploaded_len, filename, zip_data_len, upload_duration, uploaded_len / max(upload_duration, 1e-6) / 1e6,
+            channels
+        )
+    )
 
     check_file_exist_and_is_right_size(sftp, filename, zip_data_len)
+    if remote_directory is not None:
+        remote_directory.record(filename, zip_data_len)
 
     current_app.logger.info("Data {} uploaded to DVLA".format(filename))
     current_app.logger.info("Total duration for {} {} seconds".format(filename, time.monotonic() - start_time))
 
 
-def check_file_exist_and_is_right_size(sftp, filename, zip_data_len):
-    if filename in sftp.listdir():
-        stats = sftp.lstat('{}/{}'.format(sftp.pwd, filename))
-        if stats.st_size != zip_data_len:
+def get_resume_offset(sftp, remote_path, filename, zip_data, chunk_size, remote_directory=None):
+    '''Returns the offset to start uploading zip_data from - 0 to write the whole file, the size of a partially
+    uploaded copy of zip_data to carry on where it stopped, or None if the whole file has already been uploaded.'''
+    remote_size = get_remote_size(sftp, filename, remote_directory)
+    if remote_size is None:
+        return 0
+
+    if remote_size == len(zip_data):
+        current_app.logger.info('{} already exists on DVLA ftp with matching filesize {}, skipping'.format(
+            filename, remote_size
+        ))
+        return None
+
+    if 0 < remote_size < len(zip_data) and remote_prefix_matches(sftp, remote_path, zip_data, remote_size, chunk_size):
+        current_app.logger.info('{} already exists on DVLA ftp with the first {} bytes uploaded, resuming'.format(
+            filename, remote_size
+        ))
+        return remote_size
+
+    current_app.logger.info('{} already exists on DVLA ftp with different filesize {}, overwriting'.format(
+        filename, remote_size
+    ))
+    return 0
+
+
+def remote_prefix_matches(sftp, remote_path, zip_data, prefix_len, chunk_size):
+    '''Checks a sample of the first prefix_len bytes of the remote file against zip_data.
+
+    We compare the start of the file, which holds the first letter's name and so differs between different zips
+    uploaded under the same name, and the end of the prefix. Uploads write each chunk_size range in order but a
+    parallel upload writes several ranges at once, so we also compare the end of every range to catch ranges that were
+    never finished.'''
+    range_ends = list(range(chunk_size, prefix_len, chunk_size)) + [prefix_len]
+    sample_offsets = sorted({0} | {max(end - RESUME_SAMPLE_SIZE, 0) for end in range_ends})
+    samples = [(offset, min(RESUME_SAMPLE_SIZE, prefix_len - offset)) for offset in sample_offsets]
+
+    with sftp.open(remote_path, mode='r') as remote_file:
+        return all(
+            remote_sample == zip_data[offset:offset + length]
+            for (offset, length), remote_sample in zip(samples, remote_file.readv(samples))
+        )
+
+
+def write_in_chunks(remote_file, data):
+    for offset in range(0, len(data), UPLOAD_CHUNK_SIZE):
+        check_soft_time_limit()
+        remote_file.write(data[offset:offset + UPLOAD_CHUNK_SIZE])
+
+
+def write_in_parallel(sftp, remote_path, zip_data, start, chunk_size, channels):
+    '''Splits zip_data from start onwards into ranges ending on multiples of chunk_size, and writes them
+    concurrently over several SFTP channels.
+
+    A single channel can only have so much data unacknowledged at once, which caps its throughput on a high latency
+    link. Each extra channel on the same SSH connection has its own window, so together they keep more data in
+    flight.
+
+    Ranges can finish in any order, so the last range is only written once all the others have been - otherwise a
+    failed upload could leave a file of the right size with holes in it, which the size checks after a failure and
+    before a retry would take for the finished zip.'''
+    from paramiko import SFTPClient
+
+    if not start:
+        with sftp.open(remote_path, mode='w'):
+            # create or truncate the file, so that each channel can write its ranges into it
+            pass
+
+    transport = sftp.sftp_client.get_channel().get_transport()
+    *first_ranges, (last_range_start, last_range_end) = _ranges(start, len(zip_data), chunk_size)
+    ranges = iter(first_ranges)
+    ranges_lock = threading.Lock()
+    deadline = current_deadline()
+
+    def write_ranges():
+        with deadline_of_task(deadline), SFTPClient.from_transport(transport) as channel, \
+                channel.open(remote_path, mode='r+') as remote_file:
+            remote_file.set_pipelined()
+            while True:
+                with ranges_lock:
+                    range_start, range_end = next(ranges, (None, None))
+                if range_start is None:
+                    return
+                remote_file.seek(range_start)
+                write_in_chunks(remote_file, zip_data[range_start:range_end])
+
+    with ThreadPoolExecutor(max_workers=channels, thread_name_prefix='sftp-upload') as executor:
+        for written in [executor.submit(write_ranges) for _ in range(channels)]:
+            written.result()
+
+    with sftp.open(remote_path, mode='r+') as remote_file:
+        remote_file.set_pipelined()
+        remote_file.seek(last_range_start)
+        write_in_chunks(remote_file, zip_data[last_range_start:last_range_end])
+
+
+def _ranges(start, end, chunk_size):
+    # ranges end on multiples of chunk_size, so that when resuming we know where each one should have finished
+    while start < end:
+        range_end = min((start // chunk_size + 1) * chunk_size, end)
+        yield start, range_end
+        start = range_end
+
+
+def stream_zip(sftp, letter_pdfs, filename, date_time=None):
+    '''Zips (pdf_filename, EncodedMember) pairs straight into the remote file as they arrive, so the upload overlaps
+    with the downloads and the zip is never held in memory. Returns the size of the uploaded zip.'''
+    sftp.chdir(NOTIFY_SUBFOLDER)
+
+    current_app.logger.info("streaming zip {}".format(filename))
+
+    start_time = time.monotonic()
+
+    with stage_timer('stream-upload') as stream, \
+            sftp.open('{}/{}'.format(sftp.getcwd(), filename), mode='w') as remote_file:
+        remote_file.set_pipelined()
+        zip_writer = ZipWriter(remote_file, date_time)
+        for pdf_filename, member in letter_pdfs:
+            zip_writer.write_member(pdf_filename, *member)
+        zip_data_len = stream.bytes = zip_writer.close()
+
+    stream_duration = time.monotonic() - start_time
+    current_app.logger.info("streamed file {} of total size {} bytes in {} seconds ({:.2f} MB/s)".format(
+        filename, zip_data_len, stream_duration, zip_data_len / max(stream_duration, 1e-6) / 1e6))
+
+    check_file_exist_and_is_right_size(sftp, filename, zip_data_len)
+
+    current_app.logger.info("Data {} uploaded to DVLA".format(filename))
+
+    return zip_data_len
+
+
+def get_remote_size(sftp, filename, remote_directory=None):
+    '''Returns the size of filename in the current remote directory, or None if it isn't there, using
+    remote_directory's listing if one is given or a single stat otherwise.'''
+    if remote_directory is not None:
+        return remote_directory.size(filename)
+    try:
+        return sftp.lstat('{}/{}'.format(sftp.getcwd(), filename)).st_size
+    except FileNotFoundError:
+        return None
+
+
+def is_complete_zip(sftp, filename, remote_size):
+    '''Whether the remote file ends with a zip's end of central directory record, pointing back at a central
+    directory that ends just before it. Zips are uploaded front to back, and parallel uploads write their last range
+    once the others have finished, so a partial upload never ends with one.'''
+    if remote_size < sizeEndCentDir:
+        return False
+    with sftp.open('{}/{}'.format(sftp.getcwd(), filename), mode='r') as remote_file:
+        remote_file.seek(remote_size - sizeEndCentDir)
+        end_record = remote_file.read(sizeEndCentDir)
+    if len(end_record) != sizeEndCentDir or not end_record.startswith(stringEndArchive):
+        return False
+    *_, central_directory_size, central_directory_offset, comment_length = struct.unpack(structEndArchive, end_record)
+    return central_directory_offset + central_directory_size + sizeEndCentDir == remote_size and not comment_length
+
+
+def check_file_exist_and_is_right_size(sftp, filename, zip_data_len, remote_directory=None):
+    with stage_timer('verify'):
+        remote_size = get_remote_size(sftp, filename, remote_directory)
+        if remote_size is None:
+            raise FtpException("Zip file {} not uploaded".format(filename))
+        if remote_size != zip_data_len:
             raise FtpException(
                 "Zip file {} uploaded but size is incorrect: is {}, expected {}".format(
-                    filename, stats.st_size, zip_data_len))
-    else:
-        raise FtpException("Zip file {} not uploaded".format(filename))
+                    filename, remote_size, zip_data_len))
@@ -0,0 +1,89 @@
+'''Benchmarks downloading letter PDFs with a new boto3 resource per file against the shared, pooled S3Client.
+
+By default this runs against moto's in-process S3 mock, which measures the session and client construction overhead
+but not TLS handshakes. Pass --bucket (and real AWS credentials) to measure against S3, where the saving is larger.
+
+    python -m benchmarks.s3_client --letters 1000
+    python -m benchmarks.s3_client --letters 1000 --bucket development-letters-pdf --prefix 2017-12-06/
+'''
+import argparse
+import concurrent.futures
+import os
+import time
+from types import SimpleNamespace
+
+import boto3
+
+from app.files.s3_client import S3Client
+
+
+def download_with_new_resource(bucket_name, key):
+    return boto3.resource('s3').Object(bucket_name=bucket_name, key=key).get()['Body'].read()
+
+
+def download_with_shared_client(s3_client, bucket_name, key):
+    return s3_client.client.get_object(Bucket=bucket_name, Key=key)['Body'].read()
+
+
+def time_downloads(download, bucket_name, keys, concurrency):
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(lambda key: download(bucket_name, key), keys))
+    return time.perf_counter() - start
+
+
+def create_synthetic_letters(client, bucket_name, letters, pdf_size):
+    client.create_bucket(Bucket=bucket_name, CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+    contents = os.urandom(pdf_size)
+    keys = ['2017-12-06/NOTIFY.REF{:016}.D.2.C.20171206184702.PDF'.format(i) for i in range(letters)]
+    for key in keys:
+        client.put_object(Bucket=bucket_name, Key=key, Body=contents)
+    return keys
+
+
+def run(args):
+    s3_client = S3Client()
+    s3_client.init_app(SimpleNamespace(config={'AWS_REGION': 'eu-west-1', 'S3_DOWNLOAD_CONCURRENCY': args.concurrency}))
+
+    if args.bucket:
+        bucket_name = args.bucket
+        listing = s3_client.client.list_objects_v2(Bucket=bucket_name, Prefix=args.prefix, MaxKeys=args.letters)
+        keys = [obj['Key'] for obj in listing.get('Contents', [])]
+    else:
+        bucket_name = 'benchmark-letters-pdf'
+        keys = create_synthetic_letters(s3_client.client, bucket_name, args.letters, args.pdf_size)
+
+    new_resource_duration = time_downloads(download_with_new_resource, bucket_name, keys, args.concurrency)
+    shared_client_duration = time_downloads(
+        lambda bucket_name, key: download_with_shared_client(s3_client, bucket_name, key),
+        bucket_name, keys, args.concurrency
+    )
+
+    per_thousand = 1000 / len(keys)
+    print(f'letters downloaded:       {len(keys)}')
+    print(f'resource per file:        {new_resource_duration * per_thousand:.3f}s per 1,000 PDFs')
+    print(f'shared client:            {shared_client_duration * per_thousand:.3f}s per 1,000 PDFs')
+    print(f'saved:                    {(new_resource_duration - shared_client_duration) * per_thousand:.3f}s '
+          f'per 1,000 PDFs')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--letters', type=int, default=1000)
+    parser.add_argument('--pdf-size', type=int, default=20000, help='bytes per synthetic letter PDF')
+    parser.add_argument('--concurrency', type=int, default=5)
+    parser.add_argument('--bucket', help='download existing letters from this bucket instead of a mock')
+    parser.add_argument('--prefix', default='', help='key prefix to pick letters from when using --bucket')
+    args = parser.parse_args()
+
+    if args.bucket:
+        run(args)
+    else:
+        from moto import mock_s3
+
+        with mock_s3():
+            run(args)
+
+
+if __name__ == '__main__':
+    main()
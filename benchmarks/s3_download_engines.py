@@ -0,0 +1,46 @@
+'''Compares the thread pool and asyncio engines for downloading letter PDFs, side by side against moto's in-process
+S3 mock, through the same get_letter_pdfs_from_s3 interface the task uses.
+
+moto answers instantly, so --latency adds a delay to every GetObject to stand in for the round trip to S3.
+
+    python -m benchmarks.s3_download_engines --letter-counts 100 1000 5000 --latency 0.02
+'''
+import argparse
+import time
+
+from app.files.file_utils import get_letter_pdfs_from_s3
+from benchmarks.support import (
+    add_s3_latency,
+    benchmark_app,
+    create_synthetic_letters,
+)
+
+
+def time_engine(engine, filenames, config):
+    config['S3_DOWNLOAD_ENGINE'] = engine
+    start = time.perf_counter()
+    total_bytes = sum(len(pdf_data) for _, pdf_data in get_letter_pdfs_from_s3(filenames))
+    return time.perf_counter() - start, total_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--letter-counts', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--pdf-size', type=int, default=20000, help='bytes per synthetic letter PDF')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds added to every GetObject')
+    parser.add_argument('--max-concurrency', type=int, default=64)
+    args = parser.parse_args()
+
+    with benchmark_app(S3_ASYNC_MAX_CONCURRENCY=args.max_concurrency, S3_DOWNLOAD_ENGINE='asyncio') as app:
+        add_s3_latency(args.latency)
+        print(f"{'letters':>8} {'engine':>8} {'seconds':>9} {'letters/s':>10} {'MB/s':>8}")
+        for count in args.letter_counts:
+            filenames = create_synthetic_letters(count, args.pdf_size)
+            for engine in ('threads', 'asyncio'):
+                duration, total_bytes = time_engine(engine, filenames, app.config)
+                print(f'{count:>8} {engine:>8} {duration:>9.3f} {count / duration:>10.1f} '
+                      f'{total_bytes / duration / 1e6:>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
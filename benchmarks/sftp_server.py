@@ -0,0 +1,128 @@
+'''A minimal SFTP server on a background thread, serving a local directory to anyone, for benchmarks to upload to.
+
+It implements only what uploading zips needs - listing, stat, open, read, write and remove - on top of paramiko's
+server classes, and accepts any username and password.'''
+import os
+import socket
+import threading
+from contextlib import contextmanager
+
+import paramiko
+from paramiko import (
+    AUTH_SUCCESSFUL,
+    OPEN_SUCCEEDED,
+    SFTP_OK,
+    ServerInterface,
+    SFTPAttributes,
+    SFTPHandle,
+    SFTPServer,
+    SFTPServerInterface,
+)
+
+
+class _Handle(SFTPHandle):
+    def stat(self):
+        return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+class _LocalDirectory(SFTPServerInterface):
+    def __init__(self, server, root):
+        super().__init__(server)
+        self.root = root
+
+    def canonicalize(self, path):
+        return os.path.normpath(path if path.startswith('/') else '/' + path)
+
+    def _local_path(self, path):
+        return os.path.join(self.root, self.canonicalize(path).lstrip('/'))
+
+    def list_folder(self, path):
+        local_path = self._local_path(path)
+        try:
+            filenames = os.listdir(local_path)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        attributes = []
+        for filename in filenames:
+            file_attributes = SFTPAttributes.from_stat(os.stat(os.path.join(local_path, filename)))
+            file_attributes.filename = filename
+            attributes.append(file_attributes)
+        return attributes
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self._local_path(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        local_path = self._local_path(path)
+        try:
+            fd = os.open(local_path, flags, 0o666)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = _Handle(flags)
+        handle.filename = local_path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(self._local_path(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+
+class _AcceptEveryone(ServerInterface):
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        return AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return OPEN_SUCCEEDED
+
+
+@contextmanager
+def sftp_server(root):
+    '''Serves the directory root over SFTP on a free port on localhost, yielding the port.'''
+    host_key = paramiko.RSAKey.generate(2048)
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+    transports = []
+
+    def accept_connections():
+        while True:
+            try:
+                connection, _ = listener.accept()
+            except OSError:
+                # the listener has been closed
+                return
+            transport = paramiko.Transport(connection)
+            transport.add_server_key(host_key)
+            transport.set_subsystem_handler('sftp', SFTPServer, _LocalDirectory, root)
+            transport.start_server(server=_AcceptEveryone())
+            transports.append(transport)
+
+    acceptor = threading.Thread(target=accept_connections, name='benchmark-sftp-server', daemon=True)
+    acceptor.start()
+    try:
+        yield listener.getsockname()[1]
+    finally:
+        # shutting the listener down wakes up the thread waiting in accept
+        listener.shutdown(socket.SHUT_RDWR)
+        listener.close()
+        acceptor.join()
+        for transport in transports:
+            transport.close()
@@ -0,0 +1,140 @@
+'''Measures how quickly a celery worker process gets going: how long importing the app takes, and how much longer a
+worker process's first zip-and-send-letter-pdfs task takes than its second.
+
+Celery forks its worker processes from a parent process that has already created the app, and replaces each one
+after worker_max_tasks_per_child tasks - so the first task's extra time is paid over and over. The first task is
+timed in a process forked the same way, both with and without the parent calling app.warm_up first. Letters come
+from moto's in-process S3 mock and zips are sent to a local SFTP server.
+
+    python -m benchmarks.startup --repeat 5 --output startup.json
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
+
+from app import notify_celery, warm_up
+from app.celery.tasks import zip_and_send_letter_pdfs
+from app.sftp.ftp_client import NOTIFY_SUBFOLDER
+from benchmarks.support import (
+    benchmark_app,
+    create_synthetic_letters,
+    run_in_new_process,
+)
+
+# packages that take a while to import, which shouldn't be imported just by importing the app
+HEAVY_PACKAGES = ('boto3', 'paramiko', 'pysftp', 'sentry_sdk')
+
+IMPORT_APP = '''
+import json, sys, time
+start = time.perf_counter()
+import app
+imported_app = time.perf_counter()
+import app.celery.tasks
+imported_tasks = time.perf_counter()
+print(json.dumps({
+    'app': imported_app - start,
+    'app.celery.tasks': imported_tasks - start,
+    'heavy_packages_imported': [package for package in %r if package in sys.modules],
+}))
+''' % (HEAVY_PACKAGES,)
+
+
+def time_imports():
+    output = subprocess.run([sys.executable, '-c', IMPORT_APP], check=True, capture_output=True, text=True).stdout
+    return json.loads(output)
+
+
+def time_first_tasks(sftp_port, letters, pdf_size, warm):
+    '''Times the first two tasks of a worker process forked from this one, after warming the app up if `warm`. Meant
+    to be run in a process of its own.'''
+    with tempfile.TemporaryDirectory() as local_storage, benchmark_app(
+        FTP_HOST='localhost', FTP_PORT=sftp_port, FTP_USERNAME='benchmark', FTP_PASSWORD='benchmark',
+        LOCAL_FILE_STORAGE_PATH=local_storage,
+    ) as app:
+        app.logger.disabled = True
+        filenames = create_synthetic_letters(letters, pdf_size)
+
+        start = time.perf_counter()
+        if warm:
+            warm_up(app)
+        warm_up_time = time.perf_counter() - start
+
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(read_fd)
+                task_times = [time_task(filenames, 'NOTIFY.{}{:02}.ZIP'.format(os.getpid(), i)) for i in range(2)]
+                os.write(write_fd, json.dumps(task_times).encode())
+            finally:
+                os._exit(0)
+
+        os.close(write_fd)
+        with os.fdopen(read_fd) as worker_output:
+            first_task, second_task = json.loads(worker_output.read())
+        os.waitpid(pid, 0)
+
+    return {
+        'warm_up': warm,
+        'warm_up_time': warm_up_time,
+        'first_task': first_task,
+        'second_task': second_task,
+        'first_task_overhead': first_task - second_task,
+    }
+
+
+def time_task(filenames, upload_filename):
+    with mock.patch.object(notify_celery, 'send_task'):
+        start = time.perf_counter()
+        zip_and_send_letter_pdfs(filenames, upload_filename)
+        return time.perf_counter() - start
+
+
+def median(runs, key):
+    return statistics.median(run[key] for run in runs)
+
+
+def main():
+    # paramiko is imported here, so that the processes timing tasks only import it if the app does
+    from benchmarks.sftp_server import sftp_server
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--letters', type=int, default=20, help='letters in each zip')
+    parser.add_argument('--pdf-size', type=int, default=20000, help='bytes per synthetic letter PDF')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each measurement, reported by their median')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    imports = [time_imports() for _ in range(args.repeat)]
+    print(f"import app:               {median(imports, 'app') * 1000:>8.1f}ms")
+    print(f"import app.celery.tasks:  {median(imports, 'app.celery.tasks') * 1000:>8.1f}ms")
+    print(f"heavy packages imported:  {', '.join(imports[0]['heavy_packages_imported']) or 'none'}")
+
+    first_tasks = []
+    with tempfile.TemporaryDirectory() as sftp_root:
+        os.makedirs(os.path.join(sftp_root, NOTIFY_SUBFOLDER))
+        with sftp_server(sftp_root) as sftp_port:
+            for warm in (False, True):
+                runs = [
+                    run_in_new_process(time_first_tasks, sftp_port, args.letters, args.pdf_size, warm)
+                    for _ in range(args.repeat)
+                ]
+                first_tasks.extend(runs)
+                print(f"{'warmed up' if warm else 'cold':>9}: warm up {median(runs, 'warm_up_time') * 1000:>7.1f}ms, "
+                      f"first task {median(runs, 'first_task') * 1000:>7.1f}ms, "
+                      f"second task {median(runs, 'second_task') * 1000:>7.1f}ms, "
+                      f"first task overhead {median(runs, 'first_task_overhead') * 1000:>7.1f}ms")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'benchmark': 'startup', 'imports': imports, 'first_tasks': first_tasks}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
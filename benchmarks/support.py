@@ -0,0 +1,127 @@
+import os
+import random
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import get_context
+
+from flask import Flask
+
+from app import (
+    admission_controller,
+    ftp_client,
+    pdf_cache,
+    s3_client,
+    zip_checkpoints,
+    zips_sent_index,
+    zips_sent_ledger,
+)
+from app.config import configs
+
+BUCKET_NAME = 'benchmark-letters-pdf'
+# words the compressible part of synthetic letters is made of, which deflates about as well as English text
+SYNTHETIC_PDF_WORDS = (
+    b'BT ET Tf Td Tj TJ /F1 /F2 11 12 72 712 0 1 q Q cm re f ( ) Dear resident your council tax reference is due '
+    b'payment account balance please contact us on by the of to and for we have'
+).split()
+
+
+@contextmanager
+def benchmark_app(**config):
+    '''Pushes an app context configured like the test environment, plus any overrides, and points the shared S3
+    client at moto's in-process S3 mock. The PDF cache is off unless it's turned on by an override, so that repeated
+    runs measure downloads from S3. The app's statsd client is a StageRecorder.'''
+    from moto import mock_s3
+
+    app = Flask('benchmark')
+    app.config.from_object(configs['test'])
+    app.config.update(LETTERS_PDF_BUCKET_NAME=BUCKET_NAME, PDF_CACHE_MAX_BYTES=0)
+    app.config.update(**config)
+
+    app.statsd_client = StageRecorder()
+
+    with mock_s3(), app.app_context():
+        s3_client.init_app(app)
+        pdf_cache.init_app(app)
+        ftp_client.init_app(app)
+        zips_sent_ledger.init_app(app)
+        zips_sent_index.init_app(app)
+        zip_checkpoints.init_app(app)
+        admission_controller.init_app(app)
+        s3_client.client.create_bucket(
+            Bucket=BUCKET_NAME, CreateBucketConfiguration={'LocationConstraint': app.config['AWS_REGION']}
+        )
+        yield app
+
+
+def create_synthetic_letters(letters, pdf_size, folder_date='2017-12-06', compressible_fraction=0):
+    '''Uploads `letters` PDFs of pdf_size bytes to the benchmark bucket and returns their filenames. The first
+    compressible_fraction of each is repeated PDF text operators, which deflate well, and the rest random bytes, which
+    don't deflate at all - like the fonts and images already compressed inside real letters.'''
+    compressible_size = int(pdf_size * compressible_fraction)
+    words = random.Random(0).choices(SYNTHETIC_PDF_WORDS, k=compressible_size // 2 + 1)
+    contents = b' '.join(words)[:compressible_size] + os.urandom(pdf_size - compressible_size)
+    filenames = [
+        '{}/NOTIFY.REF{:016}.D.2.C.20171206184702.PDF'.format(folder_date, i) for i in range(letters)
+    ]
+    for filename in filenames:
+        s3_client.client.put_object(Bucket=BUCKET_NAME, Key=filename, Body=contents)
+    return filenames
+
+
+def run_in_new_process(function, *args):
+    '''Calls function(*args) in a new python process, so that it starts from a clean slate - nothing imported by an
+    earlier measurement, and a peak RSS of its own.'''
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+        return executor.submit(function, *args).result()
+
+
+def add_s3_latency(seconds):
+    '''Makes every S3 GetObject call through the shared client take at least `seconds` longer, to stand in for the
+    round trip to S3 that moto doesn't have.'''
+    s3_client.client.meta.events.register('after-call.s3.GetObject', lambda **kwargs: time.sleep(seconds))
+
+
+class StageRecorder(object):
+    '''Stands in for the app's statsd client, adding up what each stage of zipping and sending reports, so that a
+    benchmark can break its time down by stage.'''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.stages = defaultdict(lambda: {'count': 0, 'elapsed_time': 0, 'bytes': None, 'objects': None})
+
+    def incr(self, stat, count=1, rate=1):
+        stage, measurement = self._parse(stat)
+        if stage is None:
+            return
+        key = measurement or 'count'
+        stage[key] = (stage[key] or 0) + count
+
+    def timing(self, stat, delta, rate=1):
+        stage, measurement = self._parse(stat)
+        if stage is not None and measurement == 'elapsed-time':
+            stage['elapsed_time'] += delta
+
+    def gauge(self, stat, count):
+        # rates are worked out from the totals instead
+        pass
+
+    def summary(self):
+        '''Returns {"<stage>.<outcome>": {count, elapsed_time, bytes, objects, bytes_per_second}}.'''
+        return {
+            name: dict(stage, bytes_per_second=(
+                stage['bytes'] / max(stage['elapsed_time'], 1e-6) if stage['bytes'] is not None else None
+            ))
+            for name, stage in sorted(self.stages.items())
+        }
+
+    def _parse(self, stat):
+        # stats look like zip-and-send.<stage>.<outcome>[.<measurement>]
+        prefix, _, rest = stat.partition('.')
+        if prefix != 'zip-and-send':
+            return None, None
+        stage, outcome, *measurement = rest.split('.')
+        return self.stages['{}.{}'.format(stage, outcome)], ''.join(measurement)
@@ -0,0 +1,234 @@
+'''Runs the zip-and-send-letter-pdfs task end to end over a matrix of letter counts and PDF sizes, against moto's
+in-process S3 mock and a local SFTP server, and records the wall time, peak RSS and the time and throughput of each
+stage of zipping and sending.
+
+Each run happens in a new process, so that its peak RSS is its own. --latency adds a delay to every GetObject to
+stand in for the round trip to S3, and --config overrides app config for every run, e.g. to compare the streaming
+and in-memory paths:
+
+    python -m benchmarks.zip_and_send --letter-counts 100 1000 --pdf-sizes 20000 200000 --output before.json
+    python -m benchmarks.zip_and_send --config ZIP_STREAMING_ENABLED=true --output after.json --compare before.json
+
+--tasks-at-once runs several tasks at once on threads, each sending a zip of its own, as celery's threads pool does.
+
+Synthetic letters are random bytes, which don't compress, apart from the --compressible-fraction of each that is
+made of words. With ZIP_COMPRESSION_LEVEL set, the bytes compression saves are reported against the CPU time it
+took, as the link speed below which sending fewer bytes wins back more time than compressing them costs:
+
+    python -m benchmarks.zip_and_send --compressible-fraction 0.3 --config ZIP_COMPRESSION_LEVEL=6
+
+Results are written as JSON, along with the commit they were run against, so that runs on different commits can be
+compared.
+'''
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from unittest import mock
+
+from app import ftp_client, notify_celery
+from app.celery.tasks import zip_and_send_letter_pdfs
+from app.files.zip_writer import stored_zip_size
+from app.sftp.ftp_client import NOTIFY_SUBFOLDER
+from benchmarks.sftp_server import sftp_server
+from benchmarks.support import (
+    add_s3_latency,
+    benchmark_app,
+    create_synthetic_letters,
+    run_in_new_process,
+)
+
+FOLDER_DATE = '2017-12-06'
+UPLOAD_FILENAME = 'NOTIFY.20171206{:06}.ZIP'
+
+
+def run_case(letters, pdf_size, latency, config, tasks_at_once=1, compressible_fraction=0):
+    '''Sends tasks_at_once zips of `letters` PDFs of pdf_size bytes at once. Meant to be run in a process of its
+    own.'''
+    with tempfile.TemporaryDirectory() as root:
+        sftp_root = os.path.join(root, 'sftp')
+        os.makedirs(os.path.join(sftp_root, NOTIFY_SUBFOLDER))
+
+        with sftp_server(sftp_root) as port, benchmark_app(
+            FTP_HOST='127.0.0.1', FTP_PORT=port, FTP_USERNAME='benchmark', FTP_PASSWORD='benchmark',
+            LOCAL_FILE_STORAGE_PATH=os.path.join(root, 'local'), **config
+        ) as app:
+            app.logger.setLevel(logging.WARNING)
+            add_s3_latency(latency)
+            filenames = create_synthetic_letters(letters, pdf_size, FOLDER_DATE, compressible_fraction)
+            setup_peak_rss = peak_rss()
+
+            # the task hands its outcome over to the notifications api through celery, which isn't being measured
+            def send_zip(upload_filename):
+                with app.app_context():
+                    zip_and_send_letter_pdfs(filenames, upload_filename)
+
+            upload_filenames = [UPLOAD_FILENAME.format(i) for i in range(tasks_at_once)]
+            # as a worker does before running any tasks, rather than leaving the first tasks to race to do it
+            notify_celery.finalize()
+            with mock.patch.object(notify_celery, 'send_task') as send_task, \
+                    ThreadPoolExecutor(max_workers=tasks_at_once) as executor:
+                start = time.perf_counter()
+                start_cpu_time = time.process_time()
+                list(executor.map(send_zip, upload_filenames))
+                wall_time = time.perf_counter() - start
+                cpu_time = time.process_time() - start_cpu_time
+            ftp_client.pool.close_all()
+
+            # sending a zip also sends a rebuild of its day's zips sent index, which isn't part of the task's outcome
+            task_names = [
+                call.kwargs['name'] for call in send_task.call_args_list
+                if call.kwargs['name'] != 'build-zips-sent-index'
+            ]
+            if set(task_names) != {'update-letter-notifications-to-sent'} or len(task_names) != tasks_at_once:
+                raise RuntimeError('zip-and-send-letter-pdfs did not send every zip: {}'.format(task_names))
+
+            zip_size = os.path.getsize(os.path.join(sftp_root, NOTIFY_SUBFOLDER, upload_filenames[0]))
+            stored_size = stored_zip_size((filename.split('/')[-1], pdf_size) for filename in filenames)
+            return {
+                'letters': letters,
+                'pdf_size': pdf_size,
+                'tasks_at_once': tasks_at_once,
+                'compressible_fraction': compressible_fraction,
+                'zip_size': zip_size,
+                'bytes_saved': tasks_at_once * (stored_size - zip_size),
+                'wall_time': wall_time,
+                # of the whole process, including moto and the SFTP server
+                'cpu_time': cpu_time,
+                'letters_per_second': tasks_at_once * letters / wall_time,
+                'bytes_per_second': tasks_at_once * letters * pdf_size / wall_time,
+                'peak_rss': peak_rss(),
+                # most of this is moto holding the synthetic letters
+                'setup_peak_rss': setup_peak_rss,
+                'stages': app.statsd_client.summary(),
+            }
+
+
+def peak_rss():
+    '''The peak resident set size of this process so far, in bytes.'''
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS bytes
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], check=True, capture_output=True, text=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_config(overrides):
+    config = {}
+    for override in overrides:
+        key, _, value = override.partition('=')
+        try:
+            config[key] = json.loads(value)
+        except ValueError:
+            config[key] = value
+    return config
+
+
+def runs_by_case(results):
+    runs = {}
+    for result in results:
+        runs.setdefault((result['letters'], result['pdf_size'], result.get('tasks_at_once', 1)), []).append(result)
+    return runs
+
+
+def median_wall_time(runs):
+    return statistics.median(run['wall_time'] for run in runs)
+
+
+def compression_break_even(runs):
+    '''The link speed in MB/s below which the time saved sending fewer bytes is more than the CPU time spent
+    compressing them, or None if nothing was compressed.'''
+    compression = [run['stages'].get('compression.success') for run in runs]
+    if not all(compression):
+        return None
+    cpu_time = statistics.median(stage['elapsed_time'] for stage in compression)
+    return statistics.median(run['bytes_saved'] for run in runs) / max(cpu_time, 1e-6) / 1e6
+
+
+def print_results(results, baseline):
+    baseline_wall_times = {
+        case: median_wall_time(runs) for case, runs in runs_by_case(baseline['results'] if baseline else []).items()
+    }
+    print(f"{'letters':>8} {'pdf size':>9} {'tasks':>6} {'seconds':>9} {'letters/s':>10} {'MB/s':>8} "
+          f"{'peak RSS MB':>12} {'vs baseline':>12} {'MB saved':>9} {'CPU s':>7} {'wins below MB/s':>16}")
+    for (letters, pdf_size, tasks_at_once), runs in runs_by_case(results).items():
+        wall_time = median_wall_time(runs)
+        peak = max(run['peak_rss'] for run in runs)
+        baseline_wall_time = baseline_wall_times.get((letters, pdf_size, tasks_at_once))
+        change = f'{wall_time / baseline_wall_time - 1:>+12.1%}' if baseline_wall_time else f"{'-':>12}"
+        letters_sent = tasks_at_once * letters
+        bytes_saved = statistics.median(run.get('bytes_saved', 0) for run in runs)
+        cpu_time = statistics.median(run.get('cpu_time', 0) for run in runs)
+        break_even = compression_break_even(runs)
+        break_even = f'{break_even:>16.2f}' if break_even is not None else f"{'-':>16}"
+        print(f'{letters:>8} {pdf_size:>9} {tasks_at_once:>6} {wall_time:>9.3f} {letters_sent / wall_time:>10.1f} '
+              f'{letters_sent * pdf_size / wall_time / 1e6:>8.2f} {peak / 1e6:>12.1f} {change} '
+              f'{bytes_saved / 1e6:>9.2f} {cpu_time:>7.3f} {break_even}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--letter-counts', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--pdf-sizes', type=int, nargs='+', default=[20000, 200000],
+                        help='bytes per synthetic letter PDF')
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds added to every GetObject')
+    parser.add_argument('--tasks-at-once', type=int, default=1, help='tasks run at once on threads')
+    parser.add_argument('--compressible-fraction', type=float, default=0,
+                        help='fraction of each synthetic letter PDF that deflates, rather than being random bytes')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each case, reported by their median')
+    parser.add_argument('--config', nargs='*', default=[], metavar='KEY=VALUE',
+                        help='app config overrides, with values parsed as JSON where possible')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='a JSON file from an earlier run to compare wall times with')
+    args = parser.parse_args()
+
+    config = parse_config(args.config)
+    results = [
+        run_in_new_process(
+            run_case, letters, pdf_size, args.latency, config, args.tasks_at_once, args.compressible_fraction
+        )
+        for letters in args.letter_counts
+        for pdf_size in args.pdf_sizes
+        for _ in range(args.repeat)
+    ]
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'benchmark': 'zip_and_send',
+                'commit': git_commit(),
+                'created_at': datetime.now(timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'latency': args.latency,
+                'compressible_fraction': args.compressible_fraction,
+                'config': config,
+                'results': results,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
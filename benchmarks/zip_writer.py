@@ -0,0 +1,66 @@
+'''Benchmarks building a DVLA zip from synthetic letter PDFs.
+
+Compares InMemoryZip with the previous implementation, which reopened the archive in append mode for every letter.
+The time per letter should stay flat as the letter count grows; for the legacy implementation it grows with the
+number of letters already in the archive.
+
+    python -m benchmarks.zip_writer --letter-counts 100 1000 5000 20000 --pdf-size 20000
+'''
+import argparse
+import os
+import time
+import zipfile
+from io import BytesIO
+
+from app.files.in_memory_zip import InMemoryZip
+
+
+def build_legacy_zip(pdfs):
+    in_memory_zip = BytesIO()
+    for filename, contents in pdfs:
+        with zipfile.ZipFile(in_memory_zip, "a", zipfile.ZIP_STORED, False) as zf:
+            zf.writestr(filename, contents)
+            for zfile in zf.filelist:
+                zfile.create_system = 0
+    in_memory_zip.seek(0)
+    return in_memory_zip.read()
+
+
+def build_zip(pdfs):
+    imz = InMemoryZip()
+    for filename, contents in pdfs:
+        imz.append(filename, contents)
+    return imz.read()
+
+
+def time_build(build, pdfs):
+    start = time.perf_counter()
+    zip_data = build(pdfs)
+    return time.perf_counter() - start, len(zip_data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--letter-counts', type=int, nargs='+', default=[100, 1000, 5000, 10000, 20000])
+    parser.add_argument('--pdf-size', type=int, default=20000, help='bytes per synthetic letter PDF')
+    parser.add_argument(
+        '--legacy-max', type=int, default=2000,
+        help='largest letter count to run the quadratic legacy implementation for'
+    )
+    args = parser.parse_args()
+
+    contents = os.urandom(args.pdf_size)
+    print(f"{'letters':>8} {'impl':>8} {'seconds':>9} {'us/letter':>10} {'MB/s':>8}")
+    for count in args.letter_counts:
+        pdfs = [(f'NOTIFY.REF{i:016}.D.2.C.20171206184702.PDF', contents) for i in range(count)]
+        implementations = [('single', build_zip)]
+        if count <= args.legacy_max:
+            implementations.append(('legacy', build_legacy_zip))
+        for name, build in implementations:
+            duration, size = time_build(build, pdfs)
+            per_letter = duration / count * 1e6
+            print(f'{count:>8} {name:>8} {duration:>9.3f} {per_letter:>10.1f} {size / duration / 1e6:>8.1f}')
+
+
+if __name__ == '__main__':
+    main()
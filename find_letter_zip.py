@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+'''Finds which zip sent to DVLA on a day contained each of the letters with the given notification references, from
+the day's zips sent index - or from its zips_sent records, for letters sent since the index was built.
+
+    python find_letter_zip.py 2017-12-06 ABCDEFG1234567890 HIJKLMN1234567890
+
+--rebuild builds the day's index again from its zips_sent records first.
+'''
+import argparse
+
+from flask import Flask
+
+from app import create_app, zips_sent_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('folder_date', help='the day the letters were sent, as YYYY-MM-DD')
+    parser.add_argument('references', nargs='+', help='notification references of the letters')
+    parser.add_argument('--rebuild', action='store_true', help="rebuild the day's index before looking them up")
+    args = parser.parse_args()
+
+    application = Flask('notify-ftp')
+    create_app(application)
+    with application.app_context():
+        if args.rebuild:
+            zips = zips_sent_index.rebuild(args.folder_date)
+            print(f'Rebuilt the index for {args.folder_date} from {zips} zips')
+
+        for reference, upload_filename in zips_sent_index.lookup(args.folder_date, args.references).items():
+            print(f'{reference}: {upload_filename or "not found"}')
+
+
+if __name__ == '__main__':
+    main()
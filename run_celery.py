@@ -1,13 +1,24 @@
 #!/usr/bin/env python
 
-from app.performance import init_performance_monitoring
+from app.performance import init_performance_monitoring, init_task_profiling
 
 init_performance_monitoring()
+init_task_profiling()
 
+from celery.signals import worker_init  # noqa
 from flask import Flask  # noqa
 
-from app import notify_celery, create_app  # noqa: notify_celery required to get celery running
+from app import notify_celery, create_app, init_worker, warm_up  # noqa: notify_celery required to get celery running
+from app.celery.soft_time_limits import init_soft_time_limits  # noqa
 
 application = Flask('notify-ftp')
 create_app(application)
 application.app_context().push()
+init_soft_time_limits()
+
+
+@worker_init.connect
+def warm_up_worker(sender, **kwargs):
+    # worker_init is sent in the parent process, before it forks the worker processes that run tasks
+    init_worker(application, sender)
+    warm_up(application)
@@ -0,0 +1,94 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+from celery.exceptions import SoftTimeLimitExceeded
+
+from app.celery.soft_time_limits import (
+    check_soft_time_limit,
+    current_deadline,
+    deadline_of_task,
+    init_soft_time_limits,
+    start_soft_time_limit,
+)
+
+
+@pytest.fixture(autouse=True)
+def no_soft_time_limit():
+    yield
+    start_soft_time_limit(None)
+
+
+def test_check_soft_time_limit_raises_once_soft_time_limit_has_passed():
+    start_soft_time_limit(0.05)
+    check_soft_time_limit()
+
+    time.sleep(0.1)
+
+    with pytest.raises(SoftTimeLimitExceeded):
+        check_soft_time_limit()
+
+
+def test_check_soft_time_limit_does_not_raise_without_a_limit():
+    start_soft_time_limit(None)
+    time.sleep(0.01)
+
+    check_soft_time_limit()
+
+
+def test_soft_time_limit_only_applies_to_the_thread_running_the_task():
+    start_soft_time_limit(0.01)
+    time.sleep(0.02)
+    raised = []
+
+    def other_task():
+        try:
+            check_soft_time_limit()
+        except SoftTimeLimitExceeded as e:
+            raised.append(e)
+
+    thread = threading.Thread(target=other_task)
+    thread.start()
+    thread.join()
+
+    assert raised == []
+
+
+def test_deadline_of_task_holds_other_threads_to_the_tasks_deadline():
+    start_soft_time_limit(0.01)
+    deadline = current_deadline()
+    time.sleep(0.02)
+    raised = []
+
+    def work_for_task():
+        with deadline_of_task(deadline):
+            try:
+                check_soft_time_limit()
+            except SoftTimeLimitExceeded as e:
+                raised.append(e)
+        assert current_deadline() is None
+
+    thread = threading.Thread(target=work_for_task)
+    thread.start()
+    thread.join()
+
+    assert len(raised) == 1
+
+
+@pytest.mark.parametrize('timelimit, expected_soft_time_limit', [(None, 180), ((None, None), 180), ((300, 60), 60)])
+def test_init_soft_time_limits_starts_tasks_soft_time_limits_as_they_start(
+    mocker, timelimit, expected_soft_time_limit
+):
+    task_prerun = mocker.patch('celery.signals.task_prerun')
+    task_postrun = mocker.patch('celery.signals.task_postrun')
+    mocker.patch('app.celery.soft_time_limits.time.monotonic', return_value=1000)
+    init_soft_time_limits()
+    start = task_prerun.connect.call_args[0][0]
+    stop = task_postrun.connect.call_args[0][0]
+
+    start(task_id='task-id', task=SimpleNamespace(request=SimpleNamespace(timelimit=timelimit), soft_time_limit=180))
+    assert current_deadline() == 1000 + expected_soft_time_limit
+
+    stop(task_id='task-id', task=None)
+    assert current_deadline() is None
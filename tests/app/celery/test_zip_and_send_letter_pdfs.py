@@ -1,3 +1,4 @@
+import json
 from unittest.mock import call
 
 import pytest
@@ -9,7 +10,13 @@ from celery.exceptions import (
 )
 from flask import current_app
 
-from app.celery.tasks import zip_and_send_letter_pdfs
+from app import zip_checkpoints
+from app.celery.tasks import (
+    MAX_REFERENCES_JSON_BYTES,
+    chunk_by_json_size,
+    send_zips_sent_index_build,
+    zip_and_send_letter_pdfs,
+)
 from app.sftp.ftp_client import FtpException
 
 
@@ -20,21 +27,25 @@ def mocks(mocker, client):
             'app.celery.tasks.get_zip_of_letter_pdfs_from_s3',
             return_value=b'\x00\x01'
         )
-        upload_to_s3 = mocker.patch('app.celery.tasks.utils_s3upload')
+        upload_to_s3 = mocker.patch('app.celery.tasks.upload_to_s3')
         send_zip = mocker.patch('app.celery.tasks.ftp_client.send_zip')
         file_exists_with_correct_size = mocker.patch(
             'app.celery.tasks.ftp_client.file_exists_with_correct_size'
         )
-        file_exists_on_s3 = mocker.patch(
-            'app.celery.tasks.file_exists_on_s3',
-            return_value=False
+        get_remote_zip_size = mocker.patch('app.celery.tasks.ftp_client.get_remote_zip_size', return_value=None)
+        get_size_of_zip_of_letter_pdfs_from_s3 = mocker.patch(
+            'app.celery.tasks.get_size_of_zip_of_letter_pdfs_from_s3',
+            return_value=2
         )
+        was_sent = mocker.patch('app.celery.tasks.zips_sent_ledger.was_sent', return_value=False)
+        record_sent = mocker.patch('app.celery.tasks.zips_sent_ledger.record_sent')
         send_task = mocker.patch('app.notify_celery.send_task')
         get_notification_references_from_s3_filenames = mocker.patch(
             'app.celery.tasks.get_notification_references_from_s3_filenames',
             return_value=['1', '2', '3']
         )
         zip_and_send_retry = mocker.patch('app.celery.tasks.zip_and_send_letter_pdfs.retry', side_effect=Retry)
+        send_zips_sent_index_build = mocker.patch('app.celery.tasks.send_zips_sent_index_build')
 
     yield ZipAndSendLetterPDFsMocks
 
@@ -44,7 +55,7 @@ def test_should_get_zip_of_letter_pdfs_from_s3(mocks):
 
     zip_and_send_letter_pdfs(filenames, 'foo.zip')
 
-    mocks.get_zip_of_letter_pdfs_from_s3.assert_called_once_with(filenames)
+    mocks.get_zip_of_letter_pdfs_from_s3.assert_called_once_with(filenames, stop=None)
 
 
 def test_should_upload_record_of_zipfile_contents_to_s3(notify_ftp, mocks):
@@ -55,11 +66,11 @@ def test_should_upload_record_of_zipfile_contents_to_s3(notify_ftp, mocks):
     assert mocks.upload_to_s3.call_args_list == [
         call(
             bucket_name=current_app.config['LETTERS_PDF_BUCKET_NAME'],
-            file_location='2017-01-01/zips_sent/foo.zip.TXT',
+            filename='2017-01-01/zips_sent/foo.zip.TXT',
             filedata=b'["2017-01-01/TEST1.PDF"]',
-            region='eu-west-1'
         )
     ]
+    mocks.record_sent.assert_called_once_with('2017-01-01', 'foo.zip')
 
 
 def test_should_send_zip_file(mocks):
@@ -114,6 +125,29 @@ def test_zip_and_send_should_update_notification_if_max_retries_when_s3_client_e
     )
 
 
+def test_zip_and_send_should_retry_if_local_disk_is_full(mocks):
+    mocks.get_zip_of_letter_pdfs_from_s3.side_effect = OSError(28, 'No space left on device')
+    filenames = ['2017-01-01/TEST1.PDF']
+    with pytest.raises(Retry):
+        zip_and_send_letter_pdfs(filenames, 'foo.zip')
+
+    mocks.zip_and_send_retry.assert_called_once_with(queue='process-ftp-tasks')
+    assert not mocks.send_zip.called
+
+
+def test_zip_and_send_should_update_notification_if_max_retries_when_local_disk_is_full(mocks):
+    mocks.get_zip_of_letter_pdfs_from_s3.side_effect = OSError(28, 'No space left on device')
+    mocks.zip_and_send_retry.side_effect = MaxRetriesExceededError
+
+    zip_and_send_letter_pdfs(['2017-01-01/TEST1.PDF'], 'foo.zip')
+
+    mocks.send_task.assert_called_once_with(
+        name='update-letter-notifications-to-error',
+        args=(['1', '2', '3'],),
+        queue='notify-internal-tasks'
+    )
+
+
 def test_zip_and_send_should_retry_if_send_zip_fails_and_files_did_not_upload(mocks):
     mocks.send_zip.side_effect = FtpException
     mocks.file_exists_with_correct_size.side_effect = FtpException
@@ -158,30 +192,131 @@ def test_zip_and_send_should_update_notifications_to_success_if_send_zip_fails_b
     )
 
 
-def test_zip_and_send_should_update_notifications_to_success_in_1k_batches(mocker, mocks):
-    mocker.patch(
-        'app.celery.tasks.get_notification_references_from_s3_filenames',
-        return_value=list(range(10000))
-    )
+def test_zip_and_send_should_record_zip_and_delete_checkpoint_if_send_zip_fails_but_files_uploaded(mocks):
+    mocks.send_zip.side_effect = FtpException
+    filenames = ['2017-01-01/TEST1.PDF']
+
+    zip_and_send_letter_pdfs(filenames, 'foo.zip')
+
+    assert mocks.upload_to_s3.call_args[1]['filename'] == '2017-01-01/zips_sent/foo.zip.TXT'
+    mocks.record_sent.assert_called_once_with('2017-01-01', 'foo.zip')
+    assert zip_checkpoints.load('foo.zip', filenames) is None
+
+
+def test_zip_and_send_should_delete_checkpoint_if_files_uploaded_but_zip_cant_be_recorded(mocks):
+    mocks.send_zip.side_effect = FtpException
+    mocks.upload_to_s3.side_effect = ClientError({}, 'operation')
+    filenames = ['2017-01-01/TEST1.PDF']
+
+    zip_and_send_letter_pdfs(filenames, 'foo.zip')
+
+    assert zip_checkpoints.load('foo.zip', filenames) is None
+    assert mocks.send_task.call_args[1]['name'] == 'update-letter-notifications-to-sent'
+
+
+def test_zip_and_send_should_update_notifications_in_as_few_messages_as_fit_in_sqs(notify_ftp, mocker, mocks):
+    statsd_client = mocker.patch.object(notify_ftp, 'statsd_client')
+    references = ['REF{:013}'.format(i) for i in range(20000)]
+    mocker.patch('app.celery.tasks.get_notification_references_from_s3_filenames', return_value=references)
+    filenames = ['2017-01-01/TEST1.PDF']
+    zip_and_send_letter_pdfs(filenames, 'foo.zip')
+
+    # each reference takes up 20 bytes of JSON, so 7,065 fit in a message
+    assert mocks.send_task.call_count == 3
+    messages = sorted((task[2]['args'][0] for task in mocks.send_task.mock_calls), key=lambda message: message[0])
+    assert [len(message) for message in messages] == [7065, 7065, 5870]
+    assert sum(messages, []) == references
+    assert all(len(json.dumps(message)) <= MAX_REFERENCES_JSON_BYTES for message in messages)
+    assert all(task[2]['name'] == 'update-letter-notifications-to-sent' for task in mocks.send_task.mock_calls)
+    statsd_client.incr.assert_any_call('zip-and-send.update-notifications.messages', 3)
+    assert [
+        timing[0][0] for timing in statsd_client.timing.call_args_list
+    ].count('zip-and-send.update-notifications.publish-time') == 3
+
+
+@pytest.mark.parametrize('items, max_json_bytes, expected_chunks', [
+    ([], 10, []),
+    (['ab', 'cd', 'ef'], 14, [['ab', 'cd'], ['ef']]),
+    (['ab', 'cd', 'ef'], 20, [['ab', 'cd', 'ef']]),
+    # too big for a chunk on its own
+    (['ab', 'a very long reference', 'cd'], 14, [['ab'], ['a very long reference'], ['cd']]),
+])
+def test_chunk_by_json_size(items, max_json_bytes, expected_chunks):
+    assert list(chunk_by_json_size(items, max_json_bytes)) == expected_chunks
+
+
+def test_zip_and_send_should_not_predict_zip_size_if_nothing_uploaded(mocks):
+    zip_and_send_letter_pdfs(['2017-01-01/TEST1.PDF'], 'foo.zip')
+
+    mocks.get_remote_zip_size.assert_called_once_with('foo.zip')
+    assert not mocks.get_size_of_zip_of_letter_pdfs_from_s3.called
+    mocks.send_zip.assert_called_once_with(b'\x00\x01', 'foo.zip')
+
+
+def test_zip_and_send_should_skip_zipping_if_uploaded_zip_has_predicted_size(mocks):
+    mocks.get_remote_zip_size.return_value = 2
+    filenames = ['2017-01-01/TEST1.PDF']
+
+    zip_and_send_letter_pdfs(filenames, 'foo.zip')
+
+    mocks.get_size_of_zip_of_letter_pdfs_from_s3.assert_called_once_with(filenames)
+    assert not mocks.get_zip_of_letter_pdfs_from_s3.called
+    assert not mocks.send_zip.called
+    assert mocks.upload_to_s3.call_args[1]['filename'] == '2017-01-01/zips_sent/foo.zip.TXT'
+    assert mocks.send_task.call_args[1]['name'] == 'update-letter-notifications-to-sent'
+
+
+def test_zip_and_send_should_not_predict_zip_size_if_zips_are_compressed(mocker, mocks):
+    mocker.patch.dict(current_app.config, {'ZIP_COMPRESSION_LEVEL': 6})
+    mocks.get_remote_zip_size.return_value = 2
+
+    zip_and_send_letter_pdfs(['2017-01-01/TEST1.PDF'], 'foo.zip')
+
+    assert not mocks.get_size_of_zip_of_letter_pdfs_from_s3.called
+    mocks.send_zip.assert_called_once_with(b'\x00\x01', 'foo.zip')
+
+
+@pytest.mark.parametrize('compression_level', [0, 6])
+def test_zip_and_send_should_skip_zipping_if_uploaded_zip_has_checkpoints_size(mocker, mocks, compression_level):
+    mocker.patch.dict(current_app.config, {'ZIP_COMPRESSION_LEVEL': compression_level})
+    filenames = ['2017-01-01/TEST1.PDF']
+    zip_checkpoints.save('foo.zip', filenames, b'\x00\x01\x02')
+    mocks.get_remote_zip_size.return_value = 3
+
+    zip_and_send_letter_pdfs(filenames, 'foo.zip')
+
+    assert not mocks.get_size_of_zip_of_letter_pdfs_from_s3.called
+    assert not mocks.send_zip.called
+    assert mocks.send_task.call_args[1]['name'] == 'update-letter-notifications-to-sent'
+    assert zip_checkpoints.load('foo.zip', filenames) is None
+
+
+def test_zip_and_send_should_send_checkpoint_if_uploaded_zip_has_a_different_size(mocks):
     filenames = ['2017-01-01/TEST1.PDF']
+    zip_checkpoints.save('foo.zip', filenames, b'\x00\x01\x02')
+    mocks.get_remote_zip_size.return_value = 2
+
     zip_and_send_letter_pdfs(filenames, 'foo.zip')
 
-    assert mocks.send_task.call_count == 10
-    assert mocks.send_task.mock_calls[0][2]['args'] == (list(range(1000)),)
-    assert mocks.send_task.mock_calls[1][2]['args'] == (list(range(1000, 2000)),)
-    assert mocks.send_task.mock_calls[2][2]['args'] == (list(range(2000, 3000)),)
+    assert not mocks.get_size_of_zip_of_letter_pdfs_from_s3.called
+    assert bytes(mocks.send_zip.call_args[0][0]) == b'\x00\x01\x02'
+
+
+def test_zip_and_send_should_send_zip_if_uploaded_zip_has_different_size(mocks):
+    mocks.get_remote_zip_size.return_value = 3
+
+    zip_and_send_letter_pdfs(['2017-01-01/TEST1.PDF'], 'foo.zip')
+
+    mocks.send_zip.assert_called_once_with(b'\x00\x01', 'foo.zip')
 
 
 def test_zip_and_send_should_skip_if_record_already_in_zips_sent(mocks, caplog):
-    mocks.file_exists_on_s3.return_value = True
+    mocks.was_sent.return_value = True
 
     filenames = ['2017-01-01/TEST1.PDF']
     zip_and_send_letter_pdfs(filenames, 'foo.zip')
 
-    mocks.file_exists_on_s3.assert_called_once_with(
-        current_app.config['LETTERS_PDF_BUCKET_NAME'],
-        '2017-01-01/zips_sent/foo.zip.TXT',
-    )
+    mocks.was_sent.assert_called_once_with('2017-01-01', 'foo.zip')
     # no update notification tasks should be triggered
     assert mocks.send_task.call_count == 0
     assert any(
@@ -191,7 +326,7 @@ def test_zip_and_send_should_skip_if_record_already_in_zips_sent(mocks, caplog):
 
 
 def test_zip_and_send_should_retry_if_cant_check_zips_sent(mocks):
-    mocks.file_exists_on_s3.side_effect = ClientError({}, 'operation')
+    mocks.was_sent.side_effect = ClientError({}, 'operation')
     mocks.zip_and_send_retry.side_effect = Retry
 
     filenames = ['2017-01-01/TEST1.PDF']
@@ -202,7 +337,7 @@ def test_zip_and_send_should_retry_if_cant_check_zips_sent(mocks):
 
 
 def test_zip_and_send_should_set_to_error_after_max_retries_if_cant_check_zips_sent(mocks):
-    mocks.file_exists_on_s3.side_effect = ClientError({}, 'operation')
+    mocks.was_sent.side_effect = ClientError({}, 'operation')
     mocks.zip_and_send_retry.side_effect = MaxRetriesExceededError
 
     filenames = ['2017-01-01/TEST1.PDF']
@@ -217,7 +352,7 @@ def test_zip_and_send_should_set_to_error_after_max_retries_if_cant_check_zips_s
 
 
 def test_zip_and_send_should_retry_if_celery_hits_soft_time_limit(mocks):
-    mocks.file_exists_on_s3.side_effect = SoftTimeLimitExceeded
+    mocks.was_sent.side_effect = SoftTimeLimitExceeded
     mocks.zip_and_send_retry.side_effect = Retry
 
     filenames = ['2017-01-01/TEST1.PDF']
@@ -228,7 +363,7 @@ def test_zip_and_send_should_retry_if_celery_hits_soft_time_limit(mocks):
 
 
 def test_zip_and_send_should_set_to_error_after_max_retries_if_celery_hits_soft_time_limit(mocks):
-    mocks.file_exists_on_s3.side_effect = SoftTimeLimitExceeded
+    mocks.was_sent.side_effect = SoftTimeLimitExceeded
     mocks.zip_and_send_retry.side_effect = MaxRetriesExceededError
 
     filenames = ['2017-01-01/TEST1.PDF']
@@ -240,3 +375,130 @@ def test_zip_and_send_should_set_to_error_after_max_retries_if_celery_hits_soft_
         args=(['1', '2', '3'],),
         queue='notify-internal-tasks'
     )
+
+
+@pytest.fixture
+def streaming(mocker, mocks):
+    mocker.patch.dict(current_app.config, {'ZIP_STREAMING_ENABLED': True})
+    mocks.get_encoded_letter_pdfs_from_s3 = mocker.patch('app.celery.tasks.get_encoded_letter_pdfs_from_s3')
+    mocks.stream_zip = mocker.patch('app.celery.tasks.ftp_client.stream_zip', return_value=2)
+    yield mocks
+
+
+def test_zip_and_send_should_stream_zip_when_streaming_enabled(streaming):
+    filenames = ['2017-01-01/TEST1.PDF']
+
+    zip_and_send_letter_pdfs(filenames, 'foo.zip')
+
+    streaming.get_encoded_letter_pdfs_from_s3.assert_called_once_with(filenames)
+    streaming.stream_zip.assert_called_once_with(
+        streaming.get_encoded_letter_pdfs_from_s3.return_value, 'foo.zip', (2017, 1, 1, 0, 0, 0)
+    )
+    assert not streaming.get_zip_of_letter_pdfs_from_s3.called
+    assert not streaming.send_zip.called
+    streaming.send_task.assert_called_once_with(
+        name='update-letter-notifications-to-sent',
+        args=(['1', '2', '3'],),
+        queue='notify-internal-tasks'
+    )
+
+
+def test_zip_and_send_should_retry_without_checking_remote_file_if_streaming_fails(streaming):
+    streaming.stream_zip.side_effect = FtpException
+
+    filenames = ['2017-01-01/TEST1.PDF']
+    with pytest.raises(Retry):
+        zip_and_send_letter_pdfs(filenames, 'foo.zip')
+
+    assert not streaming.file_exists_with_correct_size.called
+    streaming.zip_and_send_retry.assert_called_once_with(queue='process-ftp-tasks')
+
+
+def test_zip_and_send_should_reuse_zip_from_a_failed_attempt(mocks):
+    filenames = ['2017-01-01/TEST1.PDF']
+    mocks.send_zip.side_effect = [FtpException('Failed to sFTP file'), None]
+    mocks.file_exists_with_correct_size.side_effect = FtpException('Zip file foo.zip not uploaded')
+
+    with pytest.raises(Retry):
+        zip_and_send_letter_pdfs(filenames, 'foo.zip')
+    zip_and_send_letter_pdfs(filenames, 'foo.zip')
+
+    mocks.get_zip_of_letter_pdfs_from_s3.assert_called_once_with(filenames, stop=None)
+    assert mocks.send_zip.call_args_list == [call(b'\x00\x01', 'foo.zip'), call(b'\x00\x01', 'foo.zip')]
+    assert zip_checkpoints.load('foo.zip', filenames) is None
+
+
+def test_zip_and_send_should_not_checkpoint_zip_sent_first_time(mocker, mocks):
+    save_checkpoint = mocker.patch('app.celery.tasks.zip_checkpoints.save')
+
+    zip_and_send_letter_pdfs(['2017-01-01/TEST1.PDF'], 'foo.zip')
+
+    assert not save_checkpoint.called
+
+
+def test_zip_and_send_should_checkpoint_zip_if_it_times_out_sending_it(mocks):
+    filenames = ['2017-01-01/TEST1.PDF']
+    mocks.send_zip.side_effect = SoftTimeLimitExceeded
+
+    with pytest.raises(Retry):
+        zip_and_send_letter_pdfs(filenames, 'foo.zip')
+
+    assert zip_checkpoints.load('foo.zip', filenames) == b'\x00\x01'
+    zip_checkpoints.delete('foo.zip')
+
+
+def test_zip_and_send_should_record_stage_metrics(notify_ftp, mocker, mocks):
+    statsd_client = mocker.patch.object(notify_ftp, 'statsd_client')
+
+    zip_and_send_letter_pdfs(['2017-01-01/TEST1.PDF'], 'foo.zip')
+
+    assert call('zip-and-send.zips-sent-check.not-sent') in statsd_client.incr.call_args_list
+    assert call(
+        'zip-and-send.update-notifications.update-letter-notifications-to-sent.objects', 3
+    ) in statsd_client.incr.call_args_list
+
+
+def test_zip_and_send_should_send_index_build_for_the_zips_day(mocks):
+    zip_and_send_letter_pdfs(['2017-01-01/TEST1.PDF'], 'foo.zip')
+
+    mocks.send_zips_sent_index_build.assert_called_once_with('2017-01-01')
+
+
+def test_zip_and_send_should_not_send_index_build_if_zip_not_sent(mocks):
+    mocks.send_zip.side_effect = FtpException('Failed to sFTP file')
+    mocks.file_exists_with_correct_size.side_effect = FtpException('Zip file foo.zip not uploaded')
+
+    with pytest.raises(Retry):
+        zip_and_send_letter_pdfs(['2017-01-01/TEST1.PDF'], 'foo.zip')
+
+    assert not mocks.send_zips_sent_index_build.called
+
+
+@pytest.fixture
+def index_builds(mocker, client):
+    mocker.patch.dict('app.celery.tasks.zips_sent_index_builds_due', clear=True)
+    mocker.patch.dict(current_app.config, {'ZIPS_SENT_INDEX_BUILD_DELAY': 300})
+    yield mocker.patch('app.notify_celery.send_task')
+
+
+def test_send_zips_sent_index_build_sends_delayed_build(index_builds):
+    send_zips_sent_index_build('2017-01-01')
+
+    index_builds.assert_called_once_with(
+        name='build-zips-sent-index', args=('2017-01-01',), queue='process-ftp-tasks', countdown=300
+    )
+
+
+def test_send_zips_sent_index_build_only_sends_one_build_a_day_until_it_is_due(mocker, index_builds):
+    now = mocker.patch('app.celery.tasks.time.time', return_value=1000)
+
+    send_zips_sent_index_build('2017-01-01')
+    send_zips_sent_index_build('2017-01-02')
+    now.return_value = 1299
+    send_zips_sent_index_build('2017-01-01')
+    now.return_value = 1300
+    send_zips_sent_index_build('2017-01-01')
+
+    assert [build[1]['args'] for build in index_builds.call_args_list] == [
+        ('2017-01-01',), ('2017-01-02',), ('2017-01-01',),
+    ]
@@ -0,0 +1,175 @@
+import threading
+import time
+from unittest.mock import MagicMock, call
+
+import pytest
+from botocore.exceptions import ClientError
+from celery.exceptions import SoftTimeLimitExceeded
+
+from app.celery.tasks import (
+    build_zips_sent_index,
+    zip_and_send_letter_pdfs_batch,
+)
+from app.sftp.ftp_client import FtpException
+
+ZIPS = [
+    [['2017-01-01/TEST1.PDF'], 'foo.zip'],
+    [['2017-01-01/TEST2.PDF', '2017-01-01/TEST3.PDF'], 'bar.zip'],
+    [['2017-01-01/TEST4.PDF'], 'baz.zip'],
+]
+
+
+@pytest.fixture
+def mocks(mocker, client):
+    ftp_session = MagicMock()
+
+    class ZipAndSendLetterPDFsBatchMocks:
+        get_zip_of_letter_pdfs_from_s3 = mocker.patch(
+            'app.celery.tasks.get_zip_of_letter_pdfs_from_s3',
+            side_effect=lambda filenames, stop=None: ','.join(filenames).encode()
+        )
+        session = mocker.patch(
+            'app.celery.tasks.ftp_client.session',
+            return_value=MagicMock(__enter__=MagicMock(return_value=ftp_session))
+        )
+        send_zip = ftp_session.send_zip
+        upload_to_s3 = mocker.patch('app.celery.tasks.upload_to_s3')
+        was_sent = mocker.patch('app.celery.tasks.zips_sent_ledger.was_sent', return_value=False)
+        record_sent = mocker.patch('app.celery.tasks.zips_sent_ledger.record_sent')
+        send_task = mocker.patch('app.notify_celery.send_task')
+        send_zips_sent_index_build = mocker.patch('app.celery.tasks.send_zips_sent_index_build')
+        save_checkpoint = mocker.patch('app.celery.tasks.zip_checkpoints.save')
+        get_notification_references_from_s3_filenames = mocker.patch(
+            'app.celery.tasks.get_notification_references_from_s3_filenames',
+            side_effect=lambda filenames: [filename.split('/')[1] for filename in filenames]
+        )
+
+    yield ZipAndSendLetterPDFsBatchMocks
+
+
+def test_batch_sends_each_zip_over_one_session(mocks):
+    zip_and_send_letter_pdfs_batch(ZIPS)
+
+    mocks.session.assert_called_once_with()
+    assert mocks.send_zip.call_args_list == [
+        call(b'2017-01-01/TEST1.PDF', 'foo.zip'),
+        call(b'2017-01-01/TEST2.PDF,2017-01-01/TEST3.PDF', 'bar.zip'),
+        call(b'2017-01-01/TEST4.PDF', 'baz.zip'),
+    ]
+    assert [upload[1]['filename'] for upload in mocks.upload_to_s3.call_args_list] == [
+        '2017-01-01/zips_sent/foo.zip.TXT',
+        '2017-01-01/zips_sent/bar.zip.TXT',
+        '2017-01-01/zips_sent/baz.zip.TXT',
+    ]
+    assert mocks.record_sent.call_args_list == [
+        call('2017-01-01', 'foo.zip'), call('2017-01-01', 'bar.zip'), call('2017-01-01', 'baz.zip'),
+    ]
+
+
+def test_batch_updates_notifications_for_each_zip(mocks):
+    zip_and_send_letter_pdfs_batch(ZIPS)
+
+    assert [task[2]['args'] for task in mocks.send_task.mock_calls] == [
+        (['TEST1.PDF'],),
+        (['TEST2.PDF', 'TEST3.PDF'],),
+        (['TEST4.PDF'],),
+    ]
+    assert all(task[2]['name'] == 'update-letter-notifications-to-sent' for task in mocks.send_task.mock_calls)
+
+
+def test_batch_skips_zips_already_sent(mocks):
+    mocks.was_sent.side_effect = lambda folder_date, upload_filename: upload_filename == 'bar.zip'
+
+    zip_and_send_letter_pdfs_batch(ZIPS)
+
+    assert [send[0][1] for send in mocks.send_zip.call_args_list] == ['foo.zip', 'baz.zip']
+    assert len(mocks.get_zip_of_letter_pdfs_from_s3.call_args_list) == 2
+    assert len(mocks.send_task.mock_calls) == 2
+
+
+def test_batch_sends_index_build_for_the_day_of_each_zip_it_sent(mocks):
+    mocks.send_zip.side_effect = [None, None, FtpException('Failed to sFTP file')]
+
+    zip_and_send_letter_pdfs_batch([ZIPS[0], [['2017-01-02/TEST5.PDF'], 'qux.zip'], ZIPS[1]])
+
+    assert mocks.send_zips_sent_index_build.call_args_list == [call('2017-01-01'), call('2017-01-02')]
+
+
+def test_build_zips_sent_index_rebuilds_the_days_index(notify_ftp, mocker, client):
+    rebuild = mocker.patch('app.celery.tasks.zips_sent_index.rebuild', return_value=3)
+    statsd_client = mocker.patch.object(notify_ftp, 'statsd_client')
+
+    build_zips_sent_index('2017-01-01')
+
+    rebuild.assert_called_once_with('2017-01-01')
+    statsd_client.incr.assert_any_call('zip-and-send.zips-sent-index.success.objects', 3)
+
+
+@pytest.mark.parametrize('exception', [FtpException('Failed to sFTP file'), SoftTimeLimitExceeded()])
+def test_batch_hands_failed_and_remaining_zips_to_individual_tasks(mocks, exception):
+    mocks.send_zip.side_effect = [None, exception]
+
+    zip_and_send_letter_pdfs_batch(ZIPS)
+
+    assert mocks.send_task.call_args_list[1:] == [
+        call(name='zip-and-send-letter-pdfs', args=(ZIPS[1][0], 'bar.zip'), queue='process-ftp-tasks'),
+        call(name='zip-and-send-letter-pdfs', args=(ZIPS[2][0], 'baz.zip'), queue='process-ftp-tasks'),
+    ]
+    assert mocks.send_task.call_args_list[0][1]['name'] == 'update-letter-notifications-to-sent'
+    mocks.save_checkpoint.assert_called_once_with('bar.zip', ZIPS[1][0], b'2017-01-01/TEST2.PDF,2017-01-01/TEST3.PDF')
+
+
+def test_batch_hands_zips_over_without_waiting_for_the_next_zip_to_be_built(mocks):
+    next_zip_started = threading.Event()
+    next_zip_can_finish = threading.Event()
+    stops = []
+
+    def get_zip_of_letter_pdfs_from_s3(filenames, stop=None):
+        if filenames == ZIPS[1][0]:
+            stops.append(stop)
+            next_zip_started.set()
+            next_zip_can_finish.wait(5)
+        return b'\x00\x01'
+
+    def send_zip(zip_data, upload_filename):
+        next_zip_started.wait(5)
+        raise FtpException('Failed to sFTP file')
+
+    mocks.get_zip_of_letter_pdfs_from_s3.side_effect = get_zip_of_letter_pdfs_from_s3
+    mocks.send_zip.side_effect = send_zip
+
+    start = time.monotonic()
+    zip_and_send_letter_pdfs_batch(ZIPS)
+    elapsed = time.monotonic() - start
+    next_zip_can_finish.set()
+
+    assert elapsed < 2
+    assert stops[0].is_set()
+    assert [task[1]['args'][1] for task in mocks.send_task.call_args_list] == ['foo.zip', 'bar.zip', 'baz.zip']
+
+
+def test_batch_hands_zips_to_individual_tasks_if_letters_cant_be_downloaded(mocks):
+    mocks.get_zip_of_letter_pdfs_from_s3.side_effect = ClientError({}, 'operation')
+
+    zip_and_send_letter_pdfs_batch(ZIPS)
+
+    assert not mocks.send_zip.called
+    assert [task[1]['args'][1] for task in mocks.send_task.call_args_list] == ['foo.zip', 'bar.zip', 'baz.zip']
+    assert all(task[1]['name'] == 'zip-and-send-letter-pdfs' for task in mocks.send_task.call_args_list)
+
+
+def test_batch_hands_zips_to_individual_tasks_if_local_disk_is_full(mocks):
+    mocks.get_zip_of_letter_pdfs_from_s3.side_effect = OSError(28, 'No space left on device')
+
+    zip_and_send_letter_pdfs_batch(ZIPS)
+
+    assert not mocks.send_zip.called
+    assert [task[1]['args'][1] for task in mocks.send_task.call_args_list] == ['foo.zip', 'bar.zip', 'baz.zip']
+
+
+def test_batch_hands_zips_to_individual_tasks_if_it_cant_connect(mocks):
+    mocks.session.side_effect = FtpException('Failed to sFTP file')
+
+    zip_and_send_letter_pdfs_batch(ZIPS)
+
+    assert [task[1]['args'][1] for task in mocks.send_task.call_args_list] == ['foo.zip', 'bar.zip', 'baz.zip']
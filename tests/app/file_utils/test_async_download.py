@@ -0,0 +1,150 @@
+import threading
+
+import pytest
+from botocore.exceptions import ClientError
+
+from app.files.async_download import AdaptiveConcurrencyLimit, AsyncDownloader
+
+
+def throttling_error():
+    return ClientError({'Error': {'Code': 'SlowDown'}}, 'GetObject')
+
+
+def test_adaptive_limit_grows_while_throughput_improves():
+    limit = AdaptiveConcurrencyLimit(initial=4, minimum=2, maximum=64)
+    limit.round_start = 0
+
+    for _ in range(4):
+        limit.record_download(100, now=1)
+    assert limit.limit == 5
+
+    # the next round moves more bytes in the same time
+    for _ in range(5):
+        limit.record_download(100, now=2)
+    assert limit.limit == 7
+
+
+def test_adaptive_limit_holds_when_throughput_stops_improving():
+    limit = AdaptiveConcurrencyLimit(initial=4, minimum=2, maximum=64)
+    limit.round_start = 0
+    for _ in range(4):
+        limit.record_download(100, now=1)
+
+    for _ in range(5):
+        limit.record_download(10, now=2)
+
+    assert limit.limit == 5
+
+
+def test_adaptive_limit_never_exceeds_maximum():
+    limit = AdaptiveConcurrencyLimit(initial=60, minimum=2, maximum=64)
+    limit.round_start = 0
+
+    for _ in range(60):
+        limit.record_download(100, now=1)
+
+    assert limit.limit == 64
+
+
+def test_adaptive_limit_halves_on_throttling_but_not_below_minimum():
+    limit = AdaptiveConcurrencyLimit(initial=10, minimum=3, maximum=64)
+
+    limit.record_throttling(now=1)
+    assert limit.limit == 5
+    limit.record_throttling(now=2)
+    assert limit.limit == 3
+
+
+def test_async_downloader_downloads_every_file():
+    download = AsyncDownloader(
+        download=lambda filename: filename.encode(),
+        window=3, window_bytes=100, initial_concurrency=2, min_concurrency=1, max_concurrency=4,
+    )
+
+    assert list(download(['a', 'b', 'c', 'd', 'e'])) == [
+        ('a', b'a'), ('b', b'b'), ('c', b'c'), ('d', b'd'), ('e', b'e')
+    ]
+
+
+def test_async_downloader_limits_files_held_to_window():
+    lock = threading.Lock()
+    started = []
+
+    def fake_download(filename):
+        with lock:
+            started.append(filename)
+        return b'\x00'
+
+    download = AsyncDownloader(
+        fake_download, window=2, window_bytes=100, initial_concurrency=4, min_concurrency=1, max_concurrency=4
+    )
+    files = download(['a', 'b', 'c', 'd', 'e'])
+    next(files)
+
+    assert len(started) <= 3
+    assert len(list(files)) == 4
+
+
+def test_async_downloader_hands_over_files_in_order():
+    finish_first = threading.Event()
+
+    def fake_download(filename):
+        if filename == 'a':
+            finish_first.wait()
+        elif filename == 'c':
+            finish_first.set()
+        return filename.encode()
+
+    download = AsyncDownloader(fake_download, window=4, window_bytes=100, initial_concurrency=4, min_concurrency=1,
+                               max_concurrency=4)
+
+    assert list(download(['a', 'b', 'c', 'd'])) == [('a', b'a'), ('b', b'b'), ('c', b'c'), ('d', b'd')]
+
+
+def test_async_downloader_limits_bytes_held_to_window():
+    lock = threading.Lock()
+    started = []
+
+    def fake_download(filename):
+        with lock:
+            started.append(filename)
+        return b'\x00' * 10
+
+    download = AsyncDownloader(fake_download, window=10, window_bytes=20, initial_concurrency=1, min_concurrency=1,
+                               max_concurrency=1)
+    files = download(['a', 'b', 'c', 'd', 'e'])
+    next(files)
+
+    # the first file has been handed over, and no more start while two downloaded files fill the window's bytes
+    assert len(started) <= 3
+    assert len(list(files)) == 4
+
+
+def test_async_downloader_retries_throttled_downloads(mocker):
+    mocker.patch('app.files.async_download.THROTTLING_BACKOFF_SECONDS', 0)
+    attempts = []
+
+    def fake_download(filename):
+        attempts.append(filename)
+        if len(attempts) == 1:
+            raise throttling_error()
+        return b'\x00'
+
+    download = AsyncDownloader(
+        fake_download, window=2, window_bytes=100, initial_concurrency=1, min_concurrency=1, max_concurrency=1
+    )
+
+    assert list(download(['a'])) == [('a', b'\x00')]
+    assert attempts == ['a', 'a']
+
+
+def test_async_downloader_reraises_other_errors():
+    def fake_download(filename):
+        raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+
+    download = AsyncDownloader(
+        fake_download, window=2, window_bytes=100, initial_concurrency=1, min_concurrency=1, max_concurrency=1
+    )
+
+    with pytest.raises(ClientError):
+        list(download(['a', 'b', 'c']))
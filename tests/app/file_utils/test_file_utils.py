@@ -1,18 +1,22 @@
+import threading
+import time
 from io import BytesIO
 from unittest.mock import call
-from zipfile import ZipFile
+from zipfile import ZIP_DEFLATED, ZipFile
 
-import boto3
 import pytest
-from botocore.exceptions import ClientError
+from celery.exceptions import SoftTimeLimitExceeded
 from flask import current_app
-from moto import mock_s3
 
+from app.celery.soft_time_limits import deadline_of_task
 from app.files.file_utils import (
     _get_file_from_s3_in_memory,
-    file_exists_on_s3,
+    encode_letter_pdfs,
+    get_letter_pdfs_from_s3,
     get_notification_references_from_s3_filenames,
+    get_size_of_zip_of_letter_pdfs_from_s3,
     get_zip_of_letter_pdfs_from_s3,
+    upload_to_s3,
 )
 
 FOO_SUBFOLDER = '/tmp/dvla-file-storage/foo'
@@ -48,36 +52,224 @@ def test_get_zip_of_letter_pdfs_from_s3(notify_ftp, mocker):
     assert zipfile.read('TEST2.PDF') == b'\x00\x01'
 
 
-@mock_s3
-def test_get_file_from_s3_in_memory_should_return_file_contents_on_successful_s3_download():
-    bucket_name = 'bucket'
-    filename = 'foo.txt'
+def test_get_zip_of_letter_pdfs_from_s3_makes_the_same_zip_every_time(notify_ftp, mocker):
+    mocker.patch('app.files.file_utils._get_file_from_s3_in_memory', return_value=b'\x00\x01')
+    filenames = ['2017-01-01/TEST1.PDF', '2017-01-01/TEST2.PDF']
 
-    # use moto to mock out s3
-    conn = boto3.resource('s3', region_name='eu-west-1')
-    conn.create_bucket(Bucket=bucket_name, CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
-    s3 = boto3.client('s3', region_name='eu-west-1')
-    s3.put_object(Bucket=bucket_name, Key=filename, Body=b'\x00')
+    zip_data = bytes(get_zip_of_letter_pdfs_from_s3(filenames))
+    mocker.patch('app.files.zip_writer.time.time', return_value=time.time() + 3600)
 
-    ret = _get_file_from_s3_in_memory(bucket_name, filename)
+    assert bytes(get_zip_of_letter_pdfs_from_s3(filenames)) == zip_data
+    assert {info.date_time for info in ZipFile(BytesIO(zip_data)).infolist()} == {(2017, 1, 1, 0, 0, 0)}
 
-    assert ret == b'\x00'
+
+def test_get_zip_of_letter_pdfs_from_s3_zips_letters_outside_a_dated_folder_as_of_1980(notify_ftp, mocker):
+    mocker.patch('app.files.file_utils._get_file_from_s3_in_memory', return_value=b'\x00\x01')
+
+    zip_data = get_zip_of_letter_pdfs_from_s3(['not-a-date/TEST1.PDF', 'not-a-date/TEST2.PDF'])
+
+    zipfile = ZipFile(BytesIO(zip_data))
+    assert zipfile.read('TEST2.PDF') == b'\x00\x01'
+    assert {info.date_time for info in zipfile.infolist()} == {(1980, 1, 1, 0, 0, 0)}
+
+
+def test_get_zip_of_letter_pdfs_from_s3_stops_zipping_when_told_to(notify_ftp, mocker):
+    stop = threading.Event()
+    downloaded = []
+
+    def download(bucket_name, filename):
+        downloaded.append(filename)
+        stop.set()
+        return b'\x00\x01'
+
+    mocker.patch.dict(current_app.config, {'S3_DOWNLOAD_CONCURRENCY': 1, 'LETTER_PDF_DOWNLOAD_WINDOW': 1})
+    mocker.patch('app.files.file_utils._get_file_from_s3_in_memory', side_effect=download)
+
+    assert get_zip_of_letter_pdfs_from_s3(['2017-01-01/TEST{}.PDF'.format(i) for i in range(10)], stop=stop) is None
+    assert len(downloaded) < 10
+
+
+def test_get_zip_of_letter_pdfs_from_s3_stops_zipping_once_tasks_soft_time_limit_has_passed(notify_ftp, mocker):
+    mocker.patch('app.files.file_utils._get_file_from_s3_in_memory', return_value=b'\x00\x01')
+
+    with deadline_of_task(time.monotonic() - 1), pytest.raises(SoftTimeLimitExceeded):
+        get_zip_of_letter_pdfs_from_s3(['2017-01-01/TEST1.PDF', '2017-01-01/TEST2.PDF'])
+
+
+def test_get_zip_of_letter_pdfs_from_s3_records_zip_assembly(notify_ftp, mocker):
+    statsd_client = mocker.patch.object(notify_ftp, 'statsd_client')
+    mocker.patch('app.files.file_utils._get_file_from_s3_in_memory', return_value=b'\x00\x01')
+
+    zip_data = get_zip_of_letter_pdfs_from_s3(['2017-01-01/TEST1.PDF', '2017-01-01/TEST2.PDF'])
+
+    statsd_client.incr.assert_any_call('zip-and-send.zip-assembly.success')
+    statsd_client.incr.assert_any_call('zip-and-send.zip-assembly.success.objects', 2)
+    statsd_client.incr.assert_any_call('zip-and-send.zip-assembly.success.bytes', len(zip_data))
 
 
-@pytest.mark.parametrize('filename, expected', [('foo.txt', True), ('bar.txt', False)])
-@mock_s3
-def test_file_exists_on_s3(filename, expected):
-    conn = boto3.resource('s3', region_name='eu-west-1')
-    conn.create_bucket(Bucket='bucket', CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
-    s3 = boto3.client('s3', region_name='eu-west-1')
+def test_get_zip_of_letter_pdfs_from_s3_records_zip_assembly_failing(notify_ftp, mocker):
+    statsd_client = mocker.patch.object(notify_ftp, 'statsd_client')
+    mocker.patch('app.files.file_utils._get_file_from_s3_in_memory', side_effect=OSError)
 
+    with pytest.raises(OSError):
+        get_zip_of_letter_pdfs_from_s3(['2017-01-01/TEST1.PDF', '2017-01-01/TEST2.PDF'])
+
+    statsd_client.incr.assert_any_call('zip-and-send.zip-assembly.failure')
+    assert 'zip-and-send.zip-assembly.success' not in [incr.args[0] for incr in statsd_client.incr.call_args_list]
+
+
+def test_get_zip_of_letter_pdfs_from_s3_compresses_letters(notify_ftp, mocker):
+    mocker.patch.dict(current_app.config, {'ZIP_COMPRESSION_LEVEL': 6})
+    mocker.patch('app.files.file_utils._get_file_from_s3_in_memory', return_value=b'%PDF-1.4 ' * 1000)
+
+    zip_data = get_zip_of_letter_pdfs_from_s3(['2017-01-01/TEST1.PDF', '2017-01-01/TEST2.PDF'])
+
+    zipfile = ZipFile(BytesIO(zip_data))
+    assert [info.compress_type for info in zipfile.infolist()] == [ZIP_DEFLATED, ZIP_DEFLATED]
+    assert zipfile.read('TEST2.PDF') == b'%PDF-1.4 ' * 1000
+    assert len(zip_data) < 2000
+
+
+def test_encode_letter_pdfs_compresses_letters_in_order(notify_ftp, mocker):
+    statsd_client = mocker.patch.object(notify_ftp, 'statsd_client')
+    letter_pdfs = [('TEST{}.PDF'.format(i), b'%PDF-1.4 ' * 100 * (i + 1)) for i in range(10)]
+
+    members = list(encode_letter_pdfs(
+        (letter_pdf for letter_pdf in letter_pdfs), compression_level=6, concurrency=3
+    ))
+
+    assert [pdf_filename for pdf_filename, _ in members] == [pdf_filename for pdf_filename, _ in letter_pdfs]
+    assert all(member.compress_type == ZIP_DEFLATED for _, member in members)
+    assert [member.file_size for _, member in members] == [len(pdf_data) for _, pdf_data in letter_pdfs]
+    statsd_client.incr.assert_any_call('zip-and-send.compression.success.objects', 10)
+    statsd_client.incr.assert_any_call(
+        'zip-and-send.compression.success.bytes', sum(len(pdf_data) for _, pdf_data in letter_pdfs)
+    )
+
+
+def test_encode_letter_pdfs_stops_reading_letters_when_abandoned(notify_ftp, mocker):
+    statsd_client = mocker.patch.object(notify_ftp, 'statsd_client')
+    letters_read = []
+
+    def letter_pdfs():
+        for i in range(10):
+            letters_read.append(i)
+            yield 'TEST{}.PDF'.format(i), b'%PDF-1.4 ' * 100
+
+    members = encode_letter_pdfs(letter_pdfs(), compression_level=6, concurrency=2)
+    next(members)
+    members.close()
+
+    # the letter handed over and the two being compressed after it
+    assert letters_read == [0, 1, 2]
+    statsd_client.incr.assert_any_call('zip-and-send.compression.abandoned')
+
+
+def test_get_letter_pdfs_from_s3_limits_downloads_to_window(notify_ftp, mocker):
+    mocker.patch.dict(current_app.config, {'LETTER_PDF_DOWNLOAD_WINDOW': 2})
+    mocked = mocker.patch('app.files.file_utils._get_file_from_s3_in_memory', return_value=b'\x00\x01')
+    filenames = ['2017-01-01/TEST{}.PDF'.format(i) for i in range(5)]
+
+    letter_pdfs = get_letter_pdfs_from_s3(filenames)
+    first_letter = next(letter_pdfs)
+
+    # one letter has been handed over and two more are in the window - the rest haven't been requested yet
+    assert mocked.call_count <= 3
+    assert [first_letter] + list(letter_pdfs) == [
+        ('TEST{}.PDF'.format(i), b'\x00\x01') for i in range(5)
+    ]
+    assert mocked.call_count == 5
+
+
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+def test_get_letter_pdfs_from_s3_hands_over_letters_in_order(notify_ftp, mocker, engine):
+    mocker.patch.dict(current_app.config, {'S3_DOWNLOAD_ENGINE': engine, 'S3_DOWNLOAD_CONCURRENCY': 4})
+    first_letter_can_finish = threading.Event()
+
+    def fake_download(bucket_name, filename):
+        if filename.endswith('TEST0.PDF'):
+            first_letter_can_finish.wait()
+        elif filename.endswith('TEST3.PDF'):
+            first_letter_can_finish.set()
+        return filename.encode()
+
+    mocker.patch('app.files.file_utils._get_file_from_s3_in_memory', side_effect=fake_download)
+    filenames = ['2017-01-01/TEST{}.PDF'.format(i) for i in range(6)]
+
+    assert list(get_letter_pdfs_from_s3(filenames)) == [
+        (filename.split('/')[1], filename.encode()) for filename in filenames
+    ]
+
+
+def test_get_letter_pdfs_from_s3_reports_pdf_cache_use_once_letters_are_done_with(notify_ftp, mocker):
+    mocker.patch('app.files.file_utils._get_file_from_s3_in_memory', return_value=b'\x00\x01')
+    report = mocker.patch('app.files.file_utils.pdf_cache.report')
+
+    letter_pdfs = get_letter_pdfs_from_s3(['2017-01-01/TEST1.PDF', '2017-01-01/TEST2.PDF'])
+    next(letter_pdfs)
+    assert not report.called
+    letter_pdfs.close()
+
+    report.assert_called_once_with()
+
+
+def test_get_letter_pdfs_from_s3_limits_downloads_to_window_bytes(notify_ftp, mocker):
+    mocker.patch.dict(current_app.config, {'LETTER_PDF_DOWNLOAD_WINDOW_BYTES': 4, 'S3_DOWNLOAD_CONCURRENCY': 1})
+    mocked = mocker.patch('app.files.file_utils._get_file_from_s3_in_memory', return_value=b'\x00\x01')
+    filenames = ['2017-01-01/TEST{}.PDF'.format(i) for i in range(5)]
+
+    letter_pdfs = get_letter_pdfs_from_s3(filenames)
+    next(letter_pdfs)
+
+    # no more downloads start while the letters downloaded ahead take up the window's 4 bytes
+    assert mocked.call_count <= 3
+    assert len(list(letter_pdfs)) == 4
+
+
+def test_get_letter_pdfs_from_s3_with_asyncio_engine(notify_ftp, mocker):
+    mocker.patch.dict(current_app.config, {'S3_DOWNLOAD_ENGINE': 'asyncio'})
+    mocked = mocker.patch('app.files.file_utils._get_file_from_s3_in_memory', return_value=b'\x00\x01')
+    filenames = ['2017-01-01/TEST1.PDF', '2017-01-01/TEST2.PDF']
+
+    letter_pdfs = list(get_letter_pdfs_from_s3(filenames))
+
+    assert letter_pdfs == [('TEST1.PDF', b'\x00\x01'), ('TEST2.PDF', b'\x00\x01')]
+    bucket_name = current_app.config['LETTERS_PDF_BUCKET_NAME']
+    assert sorted(mocked.call_args_list) == [call(bucket_name, filename) for filename in filenames]
+
+
+def test_get_size_of_zip_of_letter_pdfs_from_s3_matches_zip(mocker, s3):
+    mocker.patch.dict(current_app.config, {'LETTERS_PDF_BUCKET_NAME': 'bucket'})
+    filenames = ['2017-01-01/TEST1.PDF', '2017-01-01/TEST2.PDF', '2017-01-01/TEST3.PDF']
+    for i, filename in enumerate(filenames):
+        s3.put_object(Bucket='bucket', Key=filename, Body=b'\x00' * 100 * i)
+
+    assert get_size_of_zip_of_letter_pdfs_from_s3(filenames) == len(get_zip_of_letter_pdfs_from_s3(filenames))
+
+
+def test_get_file_from_s3_in_memory_should_return_file_contents_on_successful_s3_download(s3):
     s3.put_object(Bucket='bucket', Key='foo.txt', Body=b'\x00')
 
-    assert file_exists_on_s3('bucket', filename) is expected
+    ret = _get_file_from_s3_in_memory('bucket', 'foo.txt')
+
+    assert ret == b'\x00'
+
+
+def test_upload_to_s3(s3):
+    upload_to_s3('bucket', '2017-01-01/zips_sent/foo.zip.TXT', b'["2017-01-01/TEST1.PDF"]')
+
+    response = s3.get_object(Bucket='bucket', Key='2017-01-01/zips_sent/foo.zip.TXT')
+    assert response['Body'].read() == b'["2017-01-01/TEST1.PDF"]'
+    assert response['ServerSideEncryption'] == 'AES256'
+
+
+def test_get_letter_pdfs_from_s3_stops_downloading_when_abandoned(notify_ftp, mocker):
+    mocker.patch.dict(current_app.config, {'LETTER_PDF_DOWNLOAD_WINDOW_BYTES': 2, 'S3_DOWNLOAD_CONCURRENCY': 1})
+    mocked = mocker.patch('app.files.file_utils._get_file_from_s3_in_memory', return_value=b'\x00\x01')
+    filenames = ['2017-01-01/TEST{}.PDF'.format(i) for i in range(5)]
 
+    letter_pdfs = get_letter_pdfs_from_s3(filenames)
+    next(letter_pdfs)
+    letter_pdfs.close()
 
-@mock_s3
-def test_file_exists_on_s3_reraises_on_unexpected_error():
-    with pytest.raises(ClientError):
-        # throws a NoSuchBucket
-        file_exists_on_s3('bucket', 'foo.txt')
+    assert mocked.call_count < 5
@@ -0,0 +1,132 @@
+import os
+from unittest.mock import call, patch
+
+import pytest
+from botocore.exceptions import ClientError
+
+from app import s3_client
+from app.files.pdf_cache import PdfCache, _cache_filename
+
+
+@pytest.fixture
+def pdf_cache(s3, tmp_path):
+    pdf_cache = PdfCache(s3_client)
+    pdf_cache.init_app(_app(tmp_path, max_bytes=1024))
+    yield pdf_cache
+
+
+def _app(local_file_storage_path, max_bytes):
+    class App:
+        config = {'LOCAL_FILE_STORAGE_PATH': str(local_file_storage_path), 'PDF_CACHE_MAX_BYTES': max_bytes}
+    return App
+
+
+def _cached_files(pdf_cache):
+    return sorted(os.listdir(pdf_cache.directory))
+
+
+def test_get_downloads_letter_on_a_miss(s3, pdf_cache):
+    s3.put_object(Bucket='bucket', Key='2017-01-01/TEST1.PDF', Body=b'\x00\x01')
+
+    assert pdf_cache.get('bucket', '2017-01-01/TEST1.PDF') == b'\x00\x01'
+
+    assert (pdf_cache.hits, pdf_cache.misses) == (0, 1)
+    assert len(_cached_files(pdf_cache)) == 1
+
+
+def test_get_uses_cached_letter_if_unchanged(s3, pdf_cache):
+    s3.put_object(Bucket='bucket', Key='2017-01-01/TEST1.PDF', Body=b'\x00\x01')
+    pdf_cache.get('bucket', '2017-01-01/TEST1.PDF')
+
+    with patch.object(s3_client, 'get_object_data', wraps=s3_client.get_object_data) as get_object_data:
+        assert pdf_cache.get('bucket', '2017-01-01/TEST1.PDF') == b'\x00\x01'
+
+    get_object_data.assert_called_once_with(
+        'bucket', '2017-01-01/TEST1.PDF', IfNoneMatch=s3.head_object(
+            Bucket='bucket', Key='2017-01-01/TEST1.PDF'
+        )['ETag']
+    )
+    assert (pdf_cache.hits, pdf_cache.misses) == (1, 1)
+
+
+def test_get_downloads_letter_again_if_changed(s3, pdf_cache):
+    s3.put_object(Bucket='bucket', Key='2017-01-01/TEST1.PDF', Body=b'\x00\x01')
+    pdf_cache.get('bucket', '2017-01-01/TEST1.PDF')
+    s3.put_object(Bucket='bucket', Key='2017-01-01/TEST1.PDF', Body=b'\x00\x02')
+
+    assert pdf_cache.get('bucket', '2017-01-01/TEST1.PDF') == b'\x00\x02'
+    assert pdf_cache.get('bucket', '2017-01-01/TEST1.PDF') == b'\x00\x02'
+
+    assert (pdf_cache.hits, pdf_cache.misses) == (1, 2)
+    assert len(_cached_files(pdf_cache)) == 1
+
+
+def test_get_keeps_letters_from_different_buckets_apart(s3, pdf_cache):
+    s3.create_bucket(Bucket='another-bucket', CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+    s3.put_object(Bucket='bucket', Key='2017-01-01/TEST1.PDF', Body=b'\x00\x01')
+    s3.put_object(Bucket='another-bucket', Key='2017-01-01/TEST1.PDF', Body=b'\x00\x02')
+
+    assert pdf_cache.get('bucket', '2017-01-01/TEST1.PDF') == b'\x00\x01'
+    assert pdf_cache.get('another-bucket', '2017-01-01/TEST1.PDF') == b'\x00\x02'
+
+    assert len(_cached_files(pdf_cache)) == 2
+
+
+def test_report_sends_hits_and_misses_since_last_report(notify_ftp, mocker, s3, pdf_cache):
+    statsd_client = mocker.patch.object(notify_ftp, 'statsd_client')
+    s3.put_object(Bucket='bucket', Key='2017-01-01/TEST1.PDF', Body=b'\x00\x01')
+    pdf_cache.get('bucket', '2017-01-01/TEST1.PDF')
+    pdf_cache.get('bucket', '2017-01-01/TEST1.PDF')
+
+    pdf_cache.report()
+    pdf_cache.report()
+
+    assert statsd_client.incr.call_args_list == [
+        call('zip-and-send.pdf-cache.hit.objects', 1), call('zip-and-send.pdf-cache.miss.objects', 1),
+    ]
+    assert (pdf_cache.hits, pdf_cache.misses) == (0, 0)
+
+
+def test_init_app_resets_hits_and_misses(s3, pdf_cache, tmp_path):
+    s3.put_object(Bucket='bucket', Key='2017-01-01/TEST1.PDF', Body=b'\x00\x01')
+    pdf_cache.get('bucket', '2017-01-01/TEST1.PDF')
+
+    pdf_cache.init_app(_app(tmp_path, max_bytes=1024))
+
+    assert (pdf_cache.hits, pdf_cache.misses) == (0, 0)
+
+
+def test_get_reraises_errors_from_s3(pdf_cache):
+    with pytest.raises(ClientError):
+        pdf_cache.get('bucket', '2017-01-01/MISSING.PDF')
+
+    assert (pdf_cache.hits, pdf_cache.misses) == (0, 0)
+
+
+def test_get_evicts_least_recently_used_letters_over_the_size_cap(s3, pdf_cache):
+    for i in range(3):
+        s3.put_object(Bucket='bucket', Key='TEST{}.PDF'.format(i), Body=os.urandom(300))
+        pdf_cache.get('bucket', 'TEST{}.PDF'.format(i))
+        os.utime(os.path.join(pdf_cache.directory, _cache_filename('bucket', 'TEST{}.PDF'.format(i))), (i, i))
+    # using TEST0 again leaves TEST1 and then TEST2 as the least recently used
+    pdf_cache.get('bucket', 'TEST0.PDF')
+
+    s3.put_object(Bucket='bucket', Key='TEST3.PDF', Body=os.urandom(300))
+    pdf_cache.get('bucket', 'TEST3.PDF')
+
+    assert _cached_files(pdf_cache) == sorted(
+        _cache_filename('bucket', key) for key in ['TEST0.PDF', 'TEST3.PDF']
+    )
+    assert pdf_cache.size == sum(
+        os.path.getsize(os.path.join(pdf_cache.directory, filename)) for filename in _cached_files(pdf_cache)
+    )
+
+
+def test_get_does_not_cache_when_turned_off(s3, tmp_path):
+    pdf_cache = PdfCache(s3_client)
+    pdf_cache.init_app(_app(tmp_path, max_bytes=0))
+    s3.put_object(Bucket='bucket', Key='2017-01-01/TEST1.PDF', Body=b'\x00\x01')
+
+    assert pdf_cache.get('bucket', '2017-01-01/TEST1.PDF') == b'\x00\x01'
+
+    assert not os.path.exists(pdf_cache.directory)
@@ -0,0 +1,108 @@
+import os
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+from botocore.exceptions import ClientError
+from celery.concurrency.thread import TaskPool as ThreadTaskPool
+
+from app import init_worker
+from app.files.s3_client import S3Client
+
+
+@pytest.fixture
+def ranged_s3_client(s3):
+    s3_client = S3Client()
+    s3_client.init_app(SimpleNamespace(config={
+        'AWS_REGION': 'eu-west-1',
+        'S3_DOWNLOAD_CONCURRENCY': 2,
+        'S3_RANGED_GET_THRESHOLD': 100,
+        'S3_RANGED_GET_PART_SIZE': 30,
+        'S3_RANGED_GET_CONCURRENCY': 3,
+    }))
+    yield s3_client
+
+
+@pytest.mark.parametrize('pool_cls, expected_connections', [
+    ('prefork', 5),
+    ('threads', 11),
+    (ThreadTaskPool, 11),
+])
+def test_init_worker_sizes_connection_pool_for_tasks_sharing_the_client(s3, mocker, pool_cls, expected_connections):
+    s3_client = mocker.patch('app.s3_client', S3Client())
+    application = SimpleNamespace(config={
+        'AWS_REGION': 'eu-west-1',
+        'S3_DOWNLOAD_CONCURRENCY': 2,
+        'S3_RANGED_GET_CONCURRENCY': 3,
+    })
+    s3_client.init_app(application)
+
+    init_worker(application, SimpleNamespace(pool_cls=pool_cls, concurrency=4))
+
+    assert s3_client.client.meta.config.max_pool_connections == expected_connections
+
+
+def _ranges_requested(get_object):
+    return [get_object_call[1].get('Range') for get_object_call in get_object.call_args_list]
+
+
+@pytest.mark.parametrize('size, expected_ranges', [
+    (1, ['bytes=0-99']),
+    (100, ['bytes=0-99']),
+    (101, ['bytes=0-99', 'bytes=100-100']),
+    (175, ['bytes=0-99', 'bytes=100-129', 'bytes=130-159', 'bytes=160-174']),
+])
+def test_get_object_data_downloads_objects_over_threshold_in_ranges(s3, ranged_s3_client, size, expected_ranges):
+    contents = os.urandom(size)
+    s3.put_object(Bucket='bucket', Key='foo.pdf', Body=contents)
+
+    with patch.object(ranged_s3_client.client, 'get_object', wraps=ranged_s3_client.client.get_object) as get_object:
+        etag, data = ranged_s3_client.get_object_data('bucket', 'foo.pdf')
+
+    assert data == contents
+    assert etag == s3.head_object(Bucket='bucket', Key='foo.pdf')['ETag']
+    assert sorted(_ranges_requested(get_object)) == sorted(expected_ranges)
+    assert all(
+        get_object_call[1]['IfMatch'] == etag for get_object_call in get_object.call_args_list[1:]
+    )
+
+
+def test_get_object_data_downloads_empty_objects(s3, ranged_s3_client):
+    s3.put_object(Bucket='bucket', Key='foo.pdf', Body=b'')
+
+    assert ranged_s3_client.get_object_data('bucket', 'foo.pdf')[1] == b''
+
+
+def test_get_object_data_passes_conditions_to_first_get(s3, ranged_s3_client):
+    s3.put_object(Bucket='bucket', Key='foo.pdf', Body=b'\x00' * 150)
+    etag = s3.head_object(Bucket='bucket', Key='foo.pdf')['ETag']
+
+    with pytest.raises(ClientError) as e:
+        ranged_s3_client.get_object_data('bucket', 'foo.pdf', IfNoneMatch=etag)
+
+    assert e.value.response['Error']['Code'] == '304'
+
+
+def test_get_object_data_fails_if_object_changes_between_parts(s3, ranged_s3_client):
+    s3.put_object(Bucket='bucket', Key='foo.pdf', Body=b'\x00' * 150)
+    get_part = ranged_s3_client._get_part
+
+    def change_object_then_get_part(bucket_name, key, etag, data, start):
+        s3.put_object(Bucket='bucket', Key='foo.pdf', Body=b'\x01' * 150)
+        return get_part(bucket_name, key, etag, data, start)
+
+    with patch.object(ranged_s3_client, '_get_part', side_effect=change_object_then_get_part):
+        with pytest.raises(ClientError) as e:
+            ranged_s3_client.get_object_data('bucket', 'foo.pdf')
+
+    assert e.value.response['Error']['Code'] == 'PreconditionFailed'
+
+
+def test_get_object_data_downloads_in_one_get_when_ranges_turned_off(s3, ranged_s3_client):
+    ranged_s3_client.ranged_get_threshold = 0
+    s3.put_object(Bucket='bucket', Key='foo.pdf', Body=b'\x00' * 150)
+
+    with patch.object(ranged_s3_client.client, 'get_object', wraps=ranged_s3_client.client.get_object) as get_object:
+        assert ranged_s3_client.get_object_data('bucket', 'foo.pdf')[1] == b'\x00' * 150
+
+    assert _ranges_requested(get_object) == [None]
@@ -0,0 +1,78 @@
+import os
+import time
+
+import pytest
+
+from app.files.zip_checkpoints import ZipCheckpoints
+
+LETTERS = ['2017-01-01/TEST1.PDF', '2017-01-01/TEST2.PDF']
+
+
+@pytest.fixture
+def zip_checkpoints(notify_ftp, tmp_path):
+    class App:
+        config = {'LOCAL_FILE_STORAGE_PATH': str(tmp_path), 'ZIP_CHECKPOINT_TTL': 60}
+
+    zip_checkpoints = ZipCheckpoints()
+    zip_checkpoints.init_app(App)
+    yield zip_checkpoints
+
+
+def test_load_returns_saved_zip(zip_checkpoints):
+    zip_checkpoints.save('foo.zip', LETTERS, b'\x00\x01')
+
+    assert zip_checkpoints.load('foo.zip', LETTERS) == b'\x00\x01'
+
+
+def test_load_returns_none_if_nothing_saved(zip_checkpoints):
+    assert zip_checkpoints.load('foo.zip', LETTERS) is None
+
+
+def test_load_returns_none_for_different_letters(zip_checkpoints):
+    zip_checkpoints.save('foo.zip', LETTERS, b'\x00\x01')
+
+    assert zip_checkpoints.load('foo.zip', LETTERS[:1]) is None
+
+
+def test_load_discards_checkpoint_that_does_not_match_its_sidecar(zip_checkpoints):
+    zip_checkpoints.save('foo.zip', LETTERS, b'\x00\x01')
+    with open(os.path.join(zip_checkpoints.directory, 'foo.zip'), 'wb') as zip_file:
+        zip_file.write(b'\x00\x02')
+
+    assert zip_checkpoints.load('foo.zip', LETTERS) is None
+    assert os.listdir(zip_checkpoints.directory) == []
+
+
+def test_load_returns_none_if_sidecar_missing(zip_checkpoints):
+    zip_checkpoints.save('foo.zip', LETTERS, b'\x00\x01')
+    os.remove(os.path.join(zip_checkpoints.directory, 'foo.zip.json'))
+
+    assert zip_checkpoints.load('foo.zip', LETTERS) is None
+
+
+def test_size_returns_size_of_saved_zip(zip_checkpoints):
+    zip_checkpoints.save('foo.zip', LETTERS, b'\x00\x01')
+
+    assert zip_checkpoints.size('foo.zip', LETTERS) == 2
+    assert zip_checkpoints.size('foo.zip', LETTERS[:1]) is None
+    assert zip_checkpoints.size('bar.zip', LETTERS) is None
+
+
+def test_delete(zip_checkpoints):
+    zip_checkpoints.save('foo.zip', LETTERS, b'\x00\x01')
+
+    zip_checkpoints.delete('foo.zip')
+    zip_checkpoints.delete('bar.zip')
+
+    assert os.listdir(zip_checkpoints.directory) == []
+
+
+def test_save_collects_expired_checkpoints(zip_checkpoints):
+    zip_checkpoints.save('foo.zip', LETTERS, b'\x00\x01')
+    expired = time.time() - 61
+    for filename in ['foo.zip', 'foo.zip.json']:
+        os.utime(os.path.join(zip_checkpoints.directory, filename), (expired, expired))
+
+    zip_checkpoints.save('bar.zip', LETTERS, b'\x00\x02')
+
+    assert sorted(os.listdir(zip_checkpoints.directory)) == ['bar.zip', 'bar.zip.json']
@@ -0,0 +1,144 @@
+from io import BytesIO
+from unittest.mock import Mock
+from zipfile import ZIP_DEFLATED, ZIP_STORED, LargeZipFile, ZipFile
+
+import pytest
+
+from app.files.in_memory_zip import InMemoryZip
+from app.files.zip_writer import ZipWriter, encode_member, stored_zip_size
+
+
+def test_zip_writer_writes_readable_archive():
+    buffer = BytesIO()
+    writer = ZipWriter(buffer, date_time=(2017, 1, 1, 17, 0, 0))
+    writer.write('TEST1.PDF', b'\x00\x01')
+    writer.write('TEST2.PDF', b'\x02')
+
+    size = writer.close()
+
+    assert size == len(buffer.getvalue())
+    zipfile = ZipFile(buffer)
+    assert zipfile.testzip() is None
+    assert zipfile.namelist() == ['TEST1.PDF', 'TEST2.PDF']
+    assert zipfile.read('TEST1.PDF') == b'\x00\x01'
+    assert zipfile.read('TEST2.PDF') == b'\x02'
+    assert {info.create_system for info in zipfile.infolist()} == {0}
+    assert {info.date_time for info in zipfile.infolist()} == {(2017, 1, 1, 17, 0, 0)}
+
+
+def test_zip_writer_only_writes_forwards():
+    fileobj = Mock(spec=['write'])
+    writer = ZipWriter(fileobj)
+    writer.write('TEST1.PDF', b'\x00\x01')
+    writer.close()
+
+    written = b''.join(call.args[0] for call in fileobj.write.call_args_list)
+    assert ZipFile(BytesIO(written)).read('TEST1.PDF') == b'\x00\x01'
+
+
+def test_zip_writer_close_is_idempotent():
+    buffer = BytesIO()
+    writer = ZipWriter(buffer)
+    writer.write('TEST1.PDF', b'\x00')
+
+    assert writer.close() == writer.close() == len(buffer.getvalue())
+
+
+def test_zip_writer_refuses_writes_after_close():
+    writer = ZipWriter(BytesIO())
+    writer.close()
+
+    with pytest.raises(ValueError):
+        writer.write('TEST1.PDF', b'\x00')
+
+
+def test_zip_writer_refuses_archives_that_need_zip64(mocker):
+    mocker.patch('app.files.zip_writer.ZIP_FILECOUNT_LIMIT', 1)
+    writer = ZipWriter(BytesIO())
+    writer.write('TEST1.PDF', b'\x00')
+
+    with pytest.raises(LargeZipFile):
+        writer.write('TEST2.PDF', b'\x00')
+
+
+def test_zip_writer_writes_deflated_members():
+    buffer = BytesIO()
+    writer = ZipWriter(buffer)
+    writer.write_member('TEST1.PDF', *encode_member(b'%PDF-1.4 ' * 1000, 6))
+    writer.write_member('TEST2.PDF', *encode_member(b'\x02', 6))
+    writer.close()
+
+    zipfile = ZipFile(buffer)
+    assert zipfile.testzip() is None
+    assert [info.compress_type for info in zipfile.infolist()] == [ZIP_DEFLATED, ZIP_STORED]
+    assert zipfile.read('TEST1.PDF') == b'%PDF-1.4 ' * 1000
+    assert zipfile.read('TEST2.PDF') == b'\x02'
+    assert len(buffer.getvalue()) < 1000
+
+
+@pytest.mark.parametrize('file_contents, compression_level, expected_compress_type', [
+    (b'%PDF-1.4 ' * 1000, 0, ZIP_STORED),
+    (b'%PDF-1.4 ' * 1000, 1, ZIP_DEFLATED),
+    (b'%PDF-1.4 ' * 1000, 9, ZIP_DEFLATED),
+    # deflating doesn't make it any smaller
+    (bytes(range(256)), 9, ZIP_STORED),
+    (b'', 9, ZIP_STORED),
+])
+def test_encode_member(file_contents, compression_level, expected_compress_type):
+    member = encode_member(file_contents, compression_level)
+
+    assert member.compress_type == expected_compress_type
+    assert member.file_size == len(file_contents)
+    if expected_compress_type == ZIP_STORED:
+        assert member.data == file_contents
+    else:
+        assert len(member.data) < len(file_contents)
+
+
+@pytest.mark.parametrize('members', [
+    [],
+    [('TEST1.PDF', b'\x00\x01')],
+    [('TEST1.PDF', b'\x00' * 1000), ('NOTIFY.REF.D.2.C.20171206184702.PDF', b''), ('LETTRE-\xe9.PDF', b'\x01')],
+])
+def test_stored_zip_size_matches_zip_writer(members):
+    zip_writer = ZipWriter(BytesIO())
+    for filename_in_zip, file_contents in members:
+        zip_writer.write(filename_in_zip, file_contents)
+
+    assert stored_zip_size(
+        (filename_in_zip, len(file_contents)) for filename_in_zip, file_contents in members
+    ) == zip_writer.close()
+
+
+def test_in_memory_zip_read_returns_view_of_buffer():
+    imz = InMemoryZip().append('TEST1.PDF', b'\x00\x01')
+
+    zip_data = imz.read()
+
+    assert isinstance(zip_data, memoryview)
+    assert zip_data.readonly
+    assert ZipFile(BytesIO(zip_data)).read('TEST1.PDF') == b'\x00\x01'
+
+
+def test_in_memory_zip_stays_in_memory_within_budget(tmp_path):
+    imz = InMemoryZip(memory_budget=1024, spill_directory=str(tmp_path)).append('TEST1.PDF', b'\x00\x01')
+
+    zip_data = imz.read()
+
+    assert not imz.in_memory_zip.spilled
+    assert ZipFile(BytesIO(zip_data)).read('TEST1.PDF') == b'\x00\x01'
+
+
+def test_in_memory_zip_spills_to_disk_over_budget(tmp_path):
+    imz = InMemoryZip(memory_budget=100, spill_directory=str(tmp_path / 'spill'))
+    imz.append('TEST1.PDF', b'\x00' * 60).append('TEST2.PDF', b'\x01' * 60)
+
+    zip_data = imz.read()
+
+    assert imz.in_memory_zip.spilled
+    assert zip_data.readonly
+    zipfile = ZipFile(BytesIO(zip_data))
+    assert zipfile.read('TEST1.PDF') == b'\x00' * 60
+    assert zipfile.read('TEST2.PDF') == b'\x01' * 60
+    # the spill file is anonymous, so nothing is left behind on disk
+    assert list((tmp_path / 'spill').iterdir()) == []
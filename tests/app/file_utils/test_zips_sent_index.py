@@ -0,0 +1,98 @@
+import gzip
+import json
+from unittest.mock import patch
+
+import pytest
+from flask import current_app
+
+from app import s3_client
+from app.files.zips_sent_index import (
+    INDEX_BUCKETS,
+    ZipsSentIndex,
+    get_index_bucket,
+    get_zips_sent_index_filename,
+)
+
+
+@pytest.fixture
+def letters_pdf_bucket(s3):
+    bucket_name = current_app.config['LETTERS_PDF_BUCKET_NAME']
+    s3.create_bucket(Bucket=bucket_name, CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+    yield bucket_name
+
+
+@pytest.fixture
+def index(notify_ftp, letters_pdf_bucket):
+    index = ZipsSentIndex(s3_client)
+    index.init_app(notify_ftp)
+    yield index
+
+
+def _record_zip_sent(bucket_name, upload_filename, references, folder_date='2017-01-01'):
+    s3_client.client.put_object(
+        Bucket=bucket_name,
+        Key='{}/zips_sent/{}.TXT'.format(folder_date, upload_filename),
+        Body=json.dumps(['{}/NOTIFY.{}.D.2.C.PDF'.format(folder_date, reference) for reference in references]).encode(),
+    )
+
+
+def _index_filenames(bucket_name):
+    return [
+        obj['Key']
+        for obj in s3_client.client.list_objects_v2(
+            Bucket=bucket_name, Prefix='2017-01-01/zips_sent_index/'
+        ).get('Contents', [])
+    ]
+
+
+def test_rebuild_indexes_the_days_zips_sent_records(index, letters_pdf_bucket):
+    _record_zip_sent(letters_pdf_bucket, 'foo.zip', ['REF1', 'REF2'])
+    _record_zip_sent(letters_pdf_bucket, 'bar.zip', ['REF3'])
+    _record_zip_sent(letters_pdf_bucket, 'baz.zip', ['REF4'], folder_date='2017-01-02')
+
+    assert index.rebuild('2017-01-01') == 2
+
+    assert len(_index_filenames(letters_pdf_bucket)) == INDEX_BUCKETS
+    response = s3_client.client.get_object(
+        Bucket=letters_pdf_bucket, Key=get_zips_sent_index_filename('2017-01-01', get_index_bucket('REF3'))
+    )
+    assert json.loads(gzip.decompress(response['Body'].read()))['bar.zip'] == ['REF3']
+
+
+def test_lookup_finds_zip_each_reference_was_sent_in(index, letters_pdf_bucket):
+    _record_zip_sent(letters_pdf_bucket, 'foo.zip', ['REF1', 'REF2'])
+    _record_zip_sent(letters_pdf_bucket, 'bar.zip', ['REF3'])
+    index.rebuild('2017-01-01')
+
+    assert index.lookup('2017-01-01', ['REF1', 'REF2', 'REF3']) == {
+        'REF1': 'foo.zip', 'REF2': 'foo.zip', 'REF3': 'bar.zip',
+    }
+
+
+def test_lookup_reads_a_single_object_for_an_indexed_reference(index, letters_pdf_bucket):
+    _record_zip_sent(letters_pdf_bucket, 'foo.zip', ['REF{}'.format(i) for i in range(100)])
+    index.rebuild('2017-01-01')
+
+    with patch.object(s3_client.client, 'get_object', wraps=s3_client.client.get_object) as get_object, \
+            patch.object(s3_client.client, 'get_paginator') as get_paginator:
+        assert index.lookup('2017-01-01', ['REF50']) == {'REF50': 'foo.zip'}
+
+    get_object.assert_called_once_with(
+        Bucket=index.bucket_name, Key=get_zips_sent_index_filename('2017-01-01', get_index_bucket('REF50'))
+    )
+    assert not get_paginator.called
+
+
+def test_lookup_reads_zips_sent_records_for_references_sent_since_the_index_was_built(index, letters_pdf_bucket):
+    _record_zip_sent(letters_pdf_bucket, 'foo.zip', ['REF1'])
+    index.rebuild('2017-01-01')
+    _record_zip_sent(letters_pdf_bucket, 'bar.zip', ['REF2'])
+
+    assert index.lookup('2017-01-01', ['REF1', 'REF2', 'REF3']) == {'REF1': 'foo.zip', 'REF2': 'bar.zip', 'REF3': None}
+
+
+def test_lookup_reads_zips_sent_records_for_days_without_an_index(index, letters_pdf_bucket):
+    _record_zip_sent(letters_pdf_bucket, 'foo.zip', ['REF1'])
+
+    assert index.lookup('2017-01-01', ['REF1']) == {'REF1': 'foo.zip'}
+    assert _index_filenames(letters_pdf_bucket) == []
@@ -0,0 +1,65 @@
+from unittest.mock import patch
+
+import pytest
+from flask import current_app
+
+from app import s3_client
+from app.files.zips_sent_ledger import ZipsSentLedger
+
+
+@pytest.fixture
+def letters_pdf_bucket(s3):
+    bucket_name = current_app.config['LETTERS_PDF_BUCKET_NAME']
+    s3.create_bucket(Bucket=bucket_name, CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+    s3.put_object(Bucket=bucket_name, Key='2017-01-01/zips_sent/foo.zip.TXT', Body=b'[]')
+    s3.put_object(Bucket=bucket_name, Key='2017-01-02/zips_sent/bar.zip.TXT', Body=b'[]')
+    yield bucket_name
+
+
+@pytest.fixture
+def ledger(notify_ftp, letters_pdf_bucket):
+    ledger = ZipsSentLedger(s3_client)
+    ledger.init_app(notify_ftp)
+    yield ledger
+
+
+@pytest.mark.parametrize('folder_date, upload_filename, expected', [
+    ('2017-01-01', 'foo.zip', True),
+    ('2017-01-01', 'bar.zip', False),
+    ('2017-01-02', 'bar.zip', True),
+    ('2017-01-03', 'foo.zip', False),
+])
+def test_was_sent(ledger, folder_date, upload_filename, expected):
+    assert ledger.was_sent(folder_date, upload_filename) is expected
+
+
+def test_was_sent_lists_each_day_once(ledger):
+    with patch.object(s3_client.client, 'get_paginator', wraps=s3_client.client.get_paginator) as get_paginator:
+        assert ledger.was_sent('2017-01-01', 'foo.zip') is True
+        assert ledger.was_sent('2017-01-01', 'bar.zip') is False
+        assert ledger.was_sent('2017-01-01', 'baz.zip') is False
+
+    assert get_paginator.call_count == 1
+
+
+def test_was_sent_lists_again_once_the_ttl_has_passed(ledger, letters_pdf_bucket):
+    ledger.ttl = 0
+    assert ledger.was_sent('2017-01-01', 'bar.zip') is False
+
+    s3_client.client.put_object(Bucket=letters_pdf_bucket, Key='2017-01-01/zips_sent/bar.zip.TXT', Body=b'[]')
+
+    assert ledger.was_sent('2017-01-01', 'bar.zip') is True
+
+
+def test_record_sent_adds_to_the_days_listing(ledger):
+    assert ledger.was_sent('2017-01-01', 'bar.zip') is False
+
+    ledger.record_sent('2017-01-01', 'bar.zip')
+
+    assert ledger.was_sent('2017-01-01', 'bar.zip') is True
+
+
+def test_record_sent_does_not_list_the_day(ledger):
+    ledger.record_sent('2017-01-03', 'foo.zip')
+
+    assert ledger.days == {}
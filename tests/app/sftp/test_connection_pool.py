@@ -0,0 +1,131 @@
+import threading
+from unittest.mock import Mock
+
+import pytest
+
+from app.sftp.connection_pool import SftpConnectionPool
+
+
+def new_connection(active=True):
+    sftp = Mock()
+    sftp.sftp_client.get_channel.return_value.get_transport.return_value.is_active.return_value = active
+    return sftp
+
+
+def transport(sftp):
+    return sftp.sftp_client.get_channel.return_value.get_transport.return_value
+
+
+@pytest.fixture
+def pool():
+    connect = Mock(side_effect=lambda: new_connection())
+    yield SftpConnectionPool(connect, max_size=2, idle_timeout=300, keepalive_interval=30)
+
+
+def test_pool_opens_connection_with_keepalive(pool):
+    with pool.connection() as sftp:
+        pass
+
+    assert pool.connect.call_count == 1
+    transport(sftp).set_keepalive.assert_called_once_with(30)
+
+
+def test_pool_reuses_healthy_connection(pool):
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        pass
+
+    assert first is second
+    assert pool.connect.call_count == 1
+    # the reused connection is put back in its home directory
+    second.chdir.assert_called_once_with(None)
+
+
+def test_pool_replaces_dropped_connection(pool):
+    with pool.connection() as first:
+        pass
+    transport(first).is_active.return_value = False
+
+    with pool.connection() as second:
+        pass
+
+    assert first is not second
+    first.close.assert_called_once()
+    assert pool.connect.call_count == 2
+
+
+def test_pool_replaces_connection_that_fails_health_check(pool):
+    with pool.connection() as first:
+        pass
+    first.normalize.side_effect = IOError
+
+    with pool.connection() as second:
+        pass
+
+    assert first is not second
+    first.close.assert_called_once()
+
+
+def test_pool_closes_connections_idle_for_too_long(mocker, pool):
+    monotonic = mocker.patch('app.sftp.connection_pool.time.monotonic', return_value=1000)
+    with pool.connection() as first:
+        pass
+
+    monotonic.return_value = 1301
+    with pool.connection() as second:
+        pass
+
+    assert first is not second
+    first.close.assert_called_once()
+
+
+def test_pool_discards_connection_if_exception_raised(pool):
+    with pytest.raises(IOError):
+        with pool.connection() as first:
+            raise IOError
+
+    with pool.connection() as second:
+        pass
+
+    assert first is not second
+    first.close.assert_called_once()
+    assert pool.connections_in_use == 0
+
+
+def test_pool_frees_slot_if_connecting_fails(pool):
+    pool.connect.side_effect = IOError
+
+    with pytest.raises(IOError):
+        with pool.connection():
+            pass
+
+    assert pool.connections_in_use == 0
+
+
+def test_pool_waits_for_connection_when_all_are_in_use(pool):
+    got_third_connection = threading.Event()
+
+    def use_third_connection():
+        with pool.connection():
+            got_third_connection.set()
+
+    with pool.connection() as first, pool.connection():
+        waiting = threading.Thread(target=use_third_connection)
+        waiting.start()
+        assert not got_third_connection.wait(0.1)
+
+    waiting.join(1)
+    assert got_third_connection.is_set()
+    assert pool.connect.call_count == 2
+    assert first in [sftp for sftp, _ in pool.idle_connections]
+
+
+def test_close_all_closes_idle_connections(pool):
+    with pool.connection() as sftp:
+        pass
+
+    pool.close_all()
+
+    sftp.close.assert_called_once()
+    assert not pool.idle_connections
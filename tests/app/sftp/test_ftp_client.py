@@ -1,10 +1,24 @@
-from unittest.mock import Mock
+import socket
+import time
+from io import BytesIO
+from types import SimpleNamespace
+from unittest.mock import MagicMock, Mock, call
+from zipfile import ZipFile
 
 import pytest
+from celery.exceptions import SoftTimeLimitExceeded
+from flask import current_app
 
+from app.celery.soft_time_limits import deadline_of_task
+from app.files.zip_writer import ZipWriter, encode_member
 from app.sftp.ftp_client import (
+    FtpClient,
     FtpException,
+    FtpSession,
+    RemoteDirectoryCache,
     check_file_exist_and_is_right_size,
+    is_complete_zip,
+    stream_zip,
     upload_zip,
 )
 
@@ -22,11 +36,9 @@ def mocks(client):
 
 def test_upload_zip_success(mocks):
     mock_zip_sftp = Mock(
-        pwd='~/notify',
-        exists=Mock(return_value=False),
-        listdir=Mock(return_value=[mocks.mock_remote_filename]),
+        getcwd=Mock(return_value='~/notify'),
         open=Mock(return_value=mocks.mock_remote_file),
-        lstat=Mock(return_value=mocks.mock_lstat),
+        lstat=Mock(side_effect=[FileNotFoundError, mocks.mock_lstat]),
     )
 
     upload_zip(mock_zip_sftp, mocks.mock_data, mocks.mock_remote_filename)
@@ -39,9 +51,7 @@ def test_upload_zip_success(mocks):
 
 def test_send_zip_doesnt_overwrite_if_file_exists_with_same_size(mocks):
     mock_zip_sftp = Mock(
-        pwd='~/notify',
-        exists=Mock(return_value=True),
-        listdir=Mock(return_value=[mocks.mock_remote_filename]),
+        getcwd=Mock(return_value='~/notify'),
         open=Mock(return_value=mocks.mock_remote_file),
         lstat=Mock(return_value=mocks.mock_lstat),
     )
@@ -53,9 +63,7 @@ def test_send_zip_doesnt_overwrite_if_file_exists_with_same_size(mocks):
 
 def test_send_zip_overwrites_if_file_exists_with_different_size(mocks):
     mock_zip_sftp = Mock(
-        pwd='~/notify',
-        exists=Mock(return_value=True),
-        listdir=Mock(return_value=[mocks.mock_remote_filename]),
+        getcwd=Mock(return_value='~/notify'),
         open=Mock(return_value=mocks.mock_remote_file),
         # first time it's called, there's the old file, then we overwrite and put in the new file instead
         lstat=Mock(side_effect=[mocks.mock_bad_lstat, mocks.mock_lstat]),
@@ -68,10 +76,9 @@ def test_send_zip_overwrites_if_file_exists_with_different_size(mocks):
 
 def test_send_zip_errors_if_file_wasnt_put_on(mocks):
     mock_zip_sftp = Mock(
-        pwd='~/notify',
-        exists=Mock(return_value=False),
-        listdir=Mock(return_value=[]),
+        getcwd=Mock(return_value='~/notify'),
         open=Mock(return_value=mocks.mock_remote_file),
+        lstat=Mock(side_effect=FileNotFoundError),
     )
 
     with pytest.raises(FtpException):
@@ -80,11 +87,9 @@ def test_send_zip_errors_if_file_wasnt_put_on(mocks):
 
 def test_send_zip_errors_if_remote_file_size_is_different(mocks):
     mock_zip_sftp = Mock(
-        pwd='~/notify',
-        exists=Mock(return_value=False),
-        listdir=Mock(return_value=[mocks.mock_remote_filename]),
+        getcwd=Mock(return_value='~/notify'),
         open=Mock(return_value=mocks.mock_remote_file),
-        lstat=Mock(return_value=mocks.mock_bad_lstat),
+        lstat=Mock(side_effect=[FileNotFoundError, mocks.mock_bad_lstat]),
     )
 
     with pytest.raises(FtpException):
@@ -95,9 +100,7 @@ def test_file_exists_with_correct_size(mocks):
     zip_data = b'some data'
     remote_filename = "a-file-that-worked-but-still-threw-exception.zip"
     mock_sftp = Mock(
-        pwd='~/notify',
-        exists=Mock(return_value=False),
-        listdir=Mock(return_value=[remote_filename]),
+        getcwd=Mock(return_value='~/notify'),
         lstat=Mock(return_value=Mock(st_size=len(zip_data))),
     )
 
@@ -109,25 +112,22 @@ def test_file_exists_with_correct_size_throws_exception_when_file_does_not_exist
     zip_data = b'some data'
     remote_filename = "file_does_not_exist_remotely.zip"
     mock_sftp = Mock(
-        pwd='~/notify',
-        exists=Mock(return_value=False),
-        listdir=Mock(return_value=["any-file-but-the-right-one"]),
+        getcwd=Mock(return_value='~/notify'),
+        lstat=Mock(side_effect=FileNotFoundError),
     )
 
     with pytest.raises(expected_exception=FtpException) as e:
         check_file_exist_and_is_right_size(mock_sftp, remote_filename, len(zip_data))
 
     assert str(e.value) == "Zip file file_does_not_exist_remotely.zip not uploaded"
-    mock_sftp.listdir.assert_called_once_with()
+    mock_sftp.lstat.assert_called_once_with('~/notify/file_does_not_exist_remotely.zip')
 
 
 def test_file_exists_with_correct_size_throws_exception_file_exists_with_wrong_size(mocks):
     zip_data = b'some data'
     remote_filename = "file_does_not_exist_remotely.zip"
     mock_sftp = Mock(
-        pwd='~/notify',
-        exists=Mock(return_value=False),
-        listdir=Mock(return_value=[remote_filename]),
+        getcwd=Mock(return_value='~/notify'),
         lstat=Mock(return_value=Mock(st_size=1))
     )
 
@@ -139,3 +139,377 @@ def test_file_exists_with_correct_size_throws_exception_file_exists_with_wrong_s
         "is 1, expected 9"
     )
     mock_sftp.lstat.assert_called_once_with('~/notify/file_does_not_exist_remotely.zip')
+
+
+def test_stream_zip_writes_letters_into_remote_file(mocks):
+    written = BytesIO()
+    mocks.mock_remote_file.__enter__.return_value.write.side_effect = written.write
+    mock_zip_sftp = Mock(
+        getcwd=Mock(return_value='~/notify'),
+        open=Mock(return_value=mocks.mock_remote_file),
+        lstat=Mock(side_effect=lambda path: Mock(st_size=len(written.getvalue()))),
+    )
+
+    zip_data_len = stream_zip(
+        mock_zip_sftp,
+        iter([('TEST1.PDF', encode_member(b'\x00\x01')), ('TEST2.PDF', encode_member(b'\x02' * 100, 6))]),
+        mocks.mock_remote_filename,
+        (2017, 1, 1, 0, 0, 0),
+    )
+
+    mock_zip_sftp.chdir.assert_called_once_with('notify')
+    mock_zip_sftp.open.assert_called_once_with('~/notify/' + mocks.mock_remote_filename, mode='w')
+    mocks.mock_remote_file.__enter__.return_value.set_pipelined.assert_called_once()
+    assert zip_data_len == len(written.getvalue())
+    assert ZipFile(written).read('TEST2.PDF') == b'\x02' * 100
+    assert {info.date_time for info in ZipFile(written).infolist()} == {(2017, 1, 1, 0, 0, 0)}
+
+
+def test_upload_zip_writes_in_chunks(mocker, mocks):
+    mocker.patch('app.sftp.ftp_client.UPLOAD_CHUNK_SIZE', 2)
+    mock_zip_sftp = Mock(
+        getcwd=Mock(return_value='~/notify'),
+        open=Mock(return_value=mocks.mock_remote_file),
+        lstat=Mock(side_effect=[FileNotFoundError, Mock(st_size=5)]),
+    )
+
+    upload_zip(mock_zip_sftp, b'\x00\x01\x02\x03\x04', mocks.mock_remote_filename)
+
+    writes = mocks.mock_remote_file.__enter__.return_value.write.call_args_list
+    assert [bytes(call.args[0]) for call in writes] == [b'\x00\x01', b'\x02\x03', b'\x04']
+
+
+class FakeRemoteFile:
+    def __init__(self, contents):
+        self.contents = contents
+        self.position = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def set_pipelined(self):
+        pass
+
+    def seek(self, offset):
+        self.position = offset
+
+    def write(self, data):
+        # like a real file, writing past the end leaves a hole of zeros
+        self.contents.extend(bytes(max(self.position - len(self.contents), 0)))
+        self.contents[self.position:self.position + len(data)] = data
+        self.position += len(data)
+
+
+def test_upload_zip_writes_ranges_in_parallel_over_several_channels(mocker, mocks):
+    mocker.patch.dict(current_app.config, {'FTP_UPLOAD_CHANNELS': 3, 'FTP_UPLOAD_CHUNK_SIZE': 4})
+    remote_contents = bytearray()
+    channels = []
+
+    def open_channel(transport):
+        channel = MagicMock()
+        channel.__enter__.return_value.open.side_effect = lambda path, mode: FakeRemoteFile(remote_contents)
+        channels.append(channel)
+        return channel
+
+    mocker.patch('paramiko.SFTPClient.from_transport', side_effect=open_channel)
+    zip_data = bytes(range(30))
+    mock_zip_sftp = Mock(
+        getcwd=Mock(return_value='~/notify'),
+        open=Mock(side_effect=lambda path, mode: FakeRemoteFile(remote_contents)),
+        lstat=Mock(side_effect=[FileNotFoundError, Mock(st_size=len(zip_data))]),
+    )
+
+    upload_zip(mock_zip_sftp, zip_data, mocks.mock_remote_filename)
+
+    # the file is created first and its last range written once the channels have written the rest
+    assert mock_zip_sftp.open.call_args_list == [
+        call('~/notify/' + mocks.mock_remote_filename, mode='w'),
+        call('~/notify/' + mocks.mock_remote_filename, mode='r+'),
+    ]
+    assert len(channels) == 3
+    for channel in channels:
+        channel.__enter__.return_value.open.assert_called_once_with(
+            '~/notify/' + mocks.mock_remote_filename, mode='r+'
+        )
+    assert bytes(remote_contents) == zip_data
+
+
+def test_upload_zip_stops_writing_in_parallel_once_tasks_soft_time_limit_has_passed(mocker, mocks):
+    mocker.patch.dict(current_app.config, {'FTP_UPLOAD_CHANNELS': 3, 'FTP_UPLOAD_CHUNK_SIZE': 4})
+    remote_contents = bytearray()
+    channel = MagicMock()
+    channel.__enter__.return_value.open.side_effect = lambda path, mode: FakeRemoteFile(remote_contents)
+    mocker.patch('paramiko.SFTPClient.from_transport', return_value=channel)
+    mock_zip_sftp = Mock(
+        getcwd=Mock(return_value='~/notify'),
+        open=Mock(side_effect=lambda path, mode: FakeRemoteFile(remote_contents)),
+        lstat=Mock(side_effect=FileNotFoundError),
+    )
+
+    with deadline_of_task(time.monotonic() - 1), pytest.raises(SoftTimeLimitExceeded):
+        upload_zip(mock_zip_sftp, bytes(range(30)), mocks.mock_remote_filename)
+
+    assert remote_contents == bytearray()
+
+
+def test_upload_zip_uses_one_channel_for_zips_smaller_than_a_chunk(mocker, mocks):
+    mocker.patch.dict(current_app.config, {'FTP_UPLOAD_CHANNELS': 3, 'FTP_UPLOAD_CHUNK_SIZE': 4})
+    from_transport = mocker.patch('paramiko.SFTPClient.from_transport')
+    mock_zip_sftp = Mock(
+        getcwd=Mock(return_value='~/notify'),
+        open=Mock(return_value=mocks.mock_remote_file),
+        lstat=Mock(side_effect=[FileNotFoundError, mocks.mock_lstat]),
+    )
+
+    upload_zip(mock_zip_sftp, mocks.mock_data, mocks.mock_remote_filename)
+
+    assert not from_transport.called
+    mocks.mock_remote_file.__enter__.return_value.write.assert_called_once()
+
+
+class FakeReadableRemoteFile(FakeRemoteFile):
+    def readv(self, chunks):
+        return (bytes(self.contents[offset:offset + length]) for offset, length in chunks)
+
+    def read(self, size):
+        data = bytes(self.contents[self.position:self.position + size])
+        self.position += len(data)
+        return data
+
+
+@pytest.fixture
+def partially_uploaded(mocker, mocks):
+    mocker.patch.dict(current_app.config, {'FTP_UPLOAD_CHUNK_SIZE': 8})
+    mocker.patch('app.sftp.ftp_client.RESUME_SAMPLE_SIZE', 2)
+    zip_data = bytes(range(30))
+    remote_contents = bytearray(zip_data[:20])
+    mock_zip_sftp = Mock(
+        getcwd=Mock(return_value='~/notify'),
+        open=Mock(side_effect=lambda path, mode: FakeReadableRemoteFile(remote_contents)),
+        lstat=Mock(side_effect=lambda path: Mock(st_size=len(remote_contents))),
+    )
+    yield zip_data, remote_contents, mock_zip_sftp
+
+
+def test_upload_zip_resumes_partial_upload_if_prefix_matches(partially_uploaded, mocks):
+    zip_data, remote_contents, mock_zip_sftp = partially_uploaded
+
+    upload_zip(mock_zip_sftp, zip_data, mocks.mock_remote_filename)
+
+    assert mock_zip_sftp.open.call_args_list == [
+        call('~/notify/' + mocks.mock_remote_filename, mode='r'),
+        call('~/notify/' + mocks.mock_remote_filename, mode='r+'),
+    ]
+    assert bytes(remote_contents) == zip_data
+
+
+@pytest.mark.parametrize('corrupt_offset', [
+    0,  # the start of the file, where a different build of the zip would differ
+    7,  # the end of the first range
+    19,  # the end of the partial upload
+])
+def test_upload_zip_overwrites_partial_upload_if_prefix_differs(partially_uploaded, mocks, corrupt_offset):
+    zip_data, remote_contents, mock_zip_sftp = partially_uploaded
+    remote_contents[corrupt_offset] = 255
+
+    upload_zip(mock_zip_sftp, zip_data, mocks.mock_remote_filename)
+
+    assert mock_zip_sftp.open.call_args_list[-1] == call('~/notify/' + mocks.mock_remote_filename, mode='w')
+
+
+def test_upload_zip_resumes_partial_upload_in_parallel(mocker, partially_uploaded, mocks):
+    mocker.patch.dict(current_app.config, {'FTP_UPLOAD_CHANNELS': 2})
+    zip_data, remote_contents, mock_zip_sftp = partially_uploaded
+    channel = MagicMock()
+    channel.__enter__.return_value.open.side_effect = lambda path, mode: FakeRemoteFile(remote_contents)
+    mocker.patch('paramiko.SFTPClient.from_transport', return_value=channel)
+
+    upload_zip(mock_zip_sftp, zip_data, mocks.mock_remote_filename)
+
+    # the partial file is read from, and not truncated
+    assert mock_zip_sftp.open.call_args_list == [
+        call('~/notify/' + mocks.mock_remote_filename, mode='r'),
+        call('~/notify/' + mocks.mock_remote_filename, mode='r+'),
+    ]
+    assert bytes(remote_contents) == zip_data
+
+
+class FailingRemoteFile(FakeRemoteFile):
+    def seek(self, offset):
+        if offset == 0:
+            raise IOError('channel closed')
+        super().seek(offset)
+
+
+def test_upload_zip_in_parallel_never_leaves_a_full_size_file_if_a_channel_fails(mocker, mocks):
+    mocker.patch.dict(current_app.config, {'FTP_UPLOAD_CHANNELS': 2, 'FTP_UPLOAD_CHUNK_SIZE': 4})
+    remote_contents = bytearray()
+    channel = MagicMock()
+    # whichever channel takes the first range fails, while the other one writes every other range it can
+    channel.__enter__.return_value.open.side_effect = lambda path, mode: FailingRemoteFile(remote_contents)
+    mocker.patch('paramiko.SFTPClient.from_transport', return_value=channel)
+    zip_data = bytes(range(1, 31))
+    mock_zip_sftp = Mock(
+        getcwd=Mock(return_value='~/notify'),
+        open=Mock(side_effect=lambda path, mode: FakeRemoteFile(remote_contents)),
+        lstat=Mock(side_effect=FileNotFoundError),
+    )
+
+    with pytest.raises(IOError):
+        upload_zip(mock_zip_sftp, zip_data, mocks.mock_remote_filename)
+
+    assert bytes(remote_contents) == bytes(4) + zip_data[4:28]
+    assert mock_zip_sftp.open.call_args_list == [call('~/notify/' + mocks.mock_remote_filename, mode='w')]
+
+
+def _zip_of(*letters):
+    zip_data = BytesIO()
+    zip_writer = ZipWriter(zip_data)
+    for i, letter in enumerate(letters):
+        zip_writer.write('TEST{}.PDF'.format(i), letter)
+    zip_writer.close()
+    return zip_data.getvalue()
+
+
+@pytest.mark.parametrize('remote_contents, expected', [
+    (_zip_of(b'\x00\x01' * 100, b'\x02'), True),
+    (_zip_of(), True),
+    (_zip_of(b'\x00\x01' * 100, b'\x02')[:-1], False),
+    (_zip_of(b'\x00\x01' * 100, b'\x02')[:150], False),
+    (_zip_of(b'\x00\x01' * 100, b'\x02') + b'\x00', False),
+    (b'PK', False),
+])
+def test_is_complete_zip(remote_contents, expected):
+    mock_zip_sftp = Mock(
+        getcwd=Mock(return_value='~/notify'),
+        open=Mock(return_value=FakeReadableRemoteFile(bytearray(remote_contents))),
+    )
+
+    assert is_complete_zip(mock_zip_sftp, 'foo.zip', len(remote_contents)) is expected
+
+
+def test_check_file_exist_and_is_right_size_makes_one_round_trip(mocks):
+    mock_sftp = Mock(
+        getcwd=Mock(return_value='~/notify'),
+        lstat=Mock(return_value=Mock(st_size=9)),
+    )
+
+    check_file_exist_and_is_right_size(mock_sftp, mocks.mock_remote_filename, 9)
+
+    assert mock_sftp.method_calls == [call.getcwd(), call.lstat('~/notify/' + mocks.mock_remote_filename)]
+
+
+def test_upload_zip_checks_remote_directory_cache_before_uploading(mocks):
+    mock_zip_sftp = Mock(
+        getcwd=Mock(return_value='~/notify'),
+        listdir_attr=Mock(return_value=[Mock(filename=mocks.mock_remote_filename, st_size=1)]),
+    )
+    remote_directory = RemoteDirectoryCache(mock_zip_sftp, ttl=60)
+
+    upload_zip(mock_zip_sftp, mocks.mock_data, mocks.mock_remote_filename, remote_directory)
+
+    assert not mock_zip_sftp.lstat.called
+    assert not mock_zip_sftp.open.called
+
+
+def test_upload_zip_records_uploaded_file_in_remote_directory_cache(mocks):
+    mock_zip_sftp = Mock(
+        getcwd=Mock(return_value='~/notify'),
+        listdir_attr=Mock(return_value=[Mock(filename='another.zip', st_size=1)]),
+        open=Mock(return_value=mocks.mock_remote_file),
+        lstat=Mock(return_value=mocks.mock_lstat),
+    )
+    remote_directory = RemoteDirectoryCache(mock_zip_sftp, ttl=60)
+
+    upload_zip(mock_zip_sftp, mocks.mock_data, mocks.mock_remote_filename, remote_directory)
+
+    mock_zip_sftp.open.assert_called_once_with('~/notify/' + mocks.mock_remote_filename, mode='w')
+    assert remote_directory.size(mocks.mock_remote_filename) == 1
+    mock_zip_sftp.listdir_attr.assert_called_once_with()
+
+
+def test_remote_directory_cache_answers_many_checks_from_one_listing(mocks):
+    mock_sftp = Mock(listdir_attr=Mock(return_value=[
+        Mock(filename='a.zip', st_size=1), Mock(filename='b.zip', st_size=2),
+    ]))
+    remote_directory = RemoteDirectoryCache(mock_sftp, ttl=60)
+
+    check_file_exist_and_is_right_size(mock_sftp, 'a.zip', 1, remote_directory)
+    check_file_exist_and_is_right_size(mock_sftp, 'b.zip', 2, remote_directory)
+    with pytest.raises(FtpException):
+        check_file_exist_and_is_right_size(mock_sftp, 'c.zip', 3, remote_directory)
+
+    mock_sftp.listdir_attr.assert_called_once_with()
+    assert not mock_sftp.lstat.called
+
+
+def test_remote_directory_cache_lists_again_once_expired(mocker, mocks):
+    monotonic = mocker.patch('app.sftp.ftp_client.time.monotonic', return_value=1000)
+    mock_sftp = Mock(listdir_attr=Mock(side_effect=[
+        [],
+        [Mock(filename='a.zip', st_size=1)],
+    ]))
+    remote_directory = RemoteDirectoryCache(mock_sftp, ttl=60)
+
+    assert remote_directory.size('a.zip') is None
+    monotonic.return_value = 1061
+    assert remote_directory.size('a.zip') == 1
+
+
+def test_ftp_session_sends_several_zips_checking_one_listing(mocks):
+    mock_sftp = Mock(
+        getcwd=Mock(return_value='~/notify'),
+        listdir_attr=Mock(return_value=[Mock(filename='a.zip', st_size=1)]),
+        open=Mock(return_value=mocks.mock_remote_file),
+        lstat=Mock(return_value=mocks.mock_lstat),
+    )
+    ftp_session = FtpSession(mock_sftp, directory_cache_ttl=60)
+
+    ftp_session.send_zip(b'\x00', 'a.zip')
+    ftp_session.send_zip(b'\x00', 'b.zip')
+    ftp_session.send_zip(b'\x00', 'c.zip')
+
+    mock_sftp.listdir_attr.assert_called_once_with()
+    assert mock_sftp.open.call_args_list == [
+        call('~/notify/b.zip', mode='w'),
+        call('~/notify/c.zip', mode='w'),
+    ]
+    # each upload starts from the home directory
+    assert mock_sftp.chdir.call_args_list == [call(None), call('notify')] * 3
+
+
+@pytest.mark.parametrize('seconds_since_warm_up, expected_host', [
+    (299, '10.0.0.1'),
+    (301, 'sftp.example.com'),
+])
+def test_ftp_client_connects_to_address_resolved_while_warming_up(client, mocker, seconds_since_warm_up, expected_host):
+    getaddrinfo = mocker.patch('app.sftp.ftp_client.socket.getaddrinfo', return_value=[
+        (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('10.0.0.1', 22)),
+    ])
+    connection = mocker.patch('pysftp.Connection')
+    mocker.patch('app.sftp.ftp_client.time', monotonic=Mock(side_effect=[1000, 1000 + seconds_since_warm_up]))
+    ftp_client = FtpClient()
+    ftp_client.init_app(SimpleNamespace(config={
+        'FTP_HOST': 'sftp.example.com', 'FTP_PORT': 22, 'FTP_HOST_RESOLUTION_TTL': 300, 'FTP_POOL_SIZE': 1,
+    }))
+
+    ftp_client.warm_up()
+    ftp_client._connect()
+
+    getaddrinfo.assert_called_once_with('sftp.example.com', 22, family=socket.AF_INET, type=socket.SOCK_STREAM)
+    assert connection.call_args[0] == (expected_host,)
+
+
+def test_ftp_client_resolves_host_when_connecting_if_not_warmed_up(client, mocker):
+    connection = mocker.patch('pysftp.Connection')
+    ftp_client = FtpClient()
+    ftp_client.init_app(SimpleNamespace(config={
+        'FTP_HOST': 'sftp.example.com', 'FTP_PORT': 22, 'FTP_HOST_RESOLUTION_TTL': 300, 'FTP_POOL_SIZE': 1,
+    }))
+
+    ftp_client._connect()
+
+    assert connection.call_args[0] == ('sftp.example.com',)
@@ -0,0 +1,100 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+from flask import current_app
+
+from app.admission import AdmissionController
+
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def admission_controller(client):
+    admission_controller = AdmissionController()
+    admission_controller.init_app(SimpleNamespace(config={
+        'MAX_IN_FLIGHT_ZIP_BYTES': 100 * MB,
+        'LETTER_PDF_DOWNLOAD_WINDOW_BYTES': 10 * MB,
+        'ZIP_MEMORY_BUDGET_BYTES': 30 * MB,
+        'ZIP_STREAMING_ENABLED': False,
+    }))
+    yield admission_controller
+
+
+def _admit_in_thread(admission_controller, zips, release):
+    admitted = threading.Event()
+    app = current_app._get_current_object()
+
+    def run_task():
+        with app.app_context(), admission_controller.admit(zips):
+            admitted.set()
+            release.wait()
+
+    thread = threading.Thread(target=run_task, daemon=True)
+    thread.start()
+    return thread, admitted
+
+
+@pytest.mark.parametrize('streaming, expected_bytes_per_zip', [(False, 40 * MB), (True, 10 * MB)])
+def test_admission_controller_reserves_window_and_zip_memory_budget(client, streaming, expected_bytes_per_zip):
+    admission_controller = AdmissionController()
+    admission_controller.init_app(SimpleNamespace(config={
+        'MAX_IN_FLIGHT_ZIP_BYTES': 100 * MB,
+        'LETTER_PDF_DOWNLOAD_WINDOW_BYTES': 10 * MB,
+        'ZIP_MEMORY_BUDGET_BYTES': 30 * MB,
+        'ZIP_STREAMING_ENABLED': streaming,
+    }))
+
+    with admission_controller.admit(zips=2):
+        assert admission_controller.in_flight_bytes == 2 * expected_bytes_per_zip
+
+    assert admission_controller.in_flight_bytes == 0
+
+
+def test_admission_controller_holds_tasks_back_until_there_is_room(admission_controller):
+    release_first, release_second = threading.Event(), threading.Event()
+    first, first_admitted = _admit_in_thread(admission_controller, 1, release_first)
+    second, second_admitted = _admit_in_thread(admission_controller, 1, release_second)
+    assert first_admitted.wait(1) and second_admitted.wait(1)
+
+    # the first two tasks hold 80MB, so there isn't room for another 40MB
+    third, third_admitted = _admit_in_thread(admission_controller, 1, threading.Event())
+    assert not third_admitted.wait(0.1)
+
+    release_first.set()
+    assert third_admitted.wait(1)
+    assert admission_controller.in_flight_bytes == 80 * MB
+    assert admission_controller.tasks == 2
+
+
+def test_admission_controller_admits_task_bigger_than_limit_on_its_own(admission_controller):
+    release_small = threading.Event()
+    small, small_admitted = _admit_in_thread(admission_controller, 1, release_small)
+    assert small_admitted.wait(1)
+
+    big, big_admitted = _admit_in_thread(admission_controller, 3, threading.Event())
+    assert not big_admitted.wait(0.1)
+
+    release_small.set()
+    assert big_admitted.wait(1)
+    assert admission_controller.in_flight_bytes == 120 * MB
+
+
+def test_admission_controller_releases_room_if_task_raises(admission_controller):
+    with pytest.raises(ValueError), admission_controller.admit():
+        raise ValueError()
+
+    assert admission_controller.in_flight_bytes == 0
+    assert admission_controller.tasks == 0
+
+
+def test_admission_controller_without_limit_admits_everything(client):
+    admission_controller = AdmissionController()
+    admission_controller.init_app(SimpleNamespace(config={
+        'MAX_IN_FLIGHT_ZIP_BYTES': 0,
+        'LETTER_PDF_DOWNLOAD_WINDOW_BYTES': 10 * MB,
+        'ZIP_MEMORY_BUDGET_BYTES': 30 * MB,
+    }))
+
+    with admission_controller.admit(zips=100), admission_controller.admit(zips=100):
+        assert admission_controller.in_flight_bytes == 0
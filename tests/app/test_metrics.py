@@ -0,0 +1,154 @@
+from unittest.mock import call
+
+import pytest
+import sentry_sdk
+
+from app.metrics import SlowestDownloads, Stage, stage_timer, timed_downloads
+
+
+@pytest.fixture
+def statsd_client(notify_ftp, mocker):
+    yield mocker.patch.object(notify_ftp, 'statsd_client')
+
+
+@pytest.fixture
+def sentry_transaction():
+    with sentry_sdk.Hub(sentry_sdk.Client(traces_sample_rate=1.0)) as hub:
+        transaction = hub.start_transaction(name='zip-and-send-letter-pdfs')
+        # make it the current span without finishing it at the end, which would try to send it
+        hub.scope.span = transaction
+        yield transaction
+
+
+def _spans(transaction):
+    return [span for span in transaction._span_recorder.spans if span is not transaction]
+
+
+def test_stage_timer_records_successful_stage(statsd_client, mocker):
+    mocker.patch('app.metrics.time.monotonic', side_effect=[10, 12.5])
+
+    with stage_timer('upload'):
+        pass
+
+    statsd_client.incr.assert_called_once_with('zip-and-send.upload.success')
+    statsd_client.timing.assert_called_once_with('zip-and-send.upload.success.elapsed-time', 2.5)
+    assert not statsd_client.gauge.called
+
+
+def test_stage_timer_records_failed_stage(statsd_client):
+    with pytest.raises(ValueError), stage_timer('upload'):
+        raise ValueError()
+
+    statsd_client.incr.assert_called_once_with('zip-and-send.upload.failure')
+
+
+def test_stage_timer_records_outcome_bytes_and_objects(statsd_client, mocker):
+    mocker.patch('app.metrics.time.monotonic', side_effect=[10, 12])
+
+    with stage_timer('zip-assembly') as stage:
+        stage.outcome = 'resumed'
+        stage.bytes = 1000
+        stage.objects = 3
+
+    assert statsd_client.incr.call_args_list == [
+        call('zip-and-send.zip-assembly.resumed'),
+        call('zip-and-send.zip-assembly.resumed.objects', 3),
+        call('zip-and-send.zip-assembly.resumed.bytes', 1000),
+    ]
+    statsd_client.gauge.assert_called_once_with('zip-and-send.zip-assembly.resumed.bytes-per-second', 500)
+
+
+def test_stage_adds_up_time_spent_in_several_blocks(statsd_client, mocker):
+    mocker.patch('app.metrics.time.monotonic', side_effect=[10, 11, 20, 22])
+    stage = Stage('zip-assembly')
+
+    with stage.timing():
+        pass
+    with stage.timing():
+        pass
+    stage.record()
+
+    statsd_client.timing.assert_called_once_with('zip-and-send.zip-assembly.success.elapsed-time', 3)
+
+
+def test_timed_downloads_records_letters_downloaded(statsd_client):
+    letter_pdfs = (letter_pdf for letter_pdf in [('TEST1.PDF', b'\x00\x01'), ('TEST2.PDF', b'\x00')])
+
+    assert list(timed_downloads(letter_pdfs)) == [('TEST1.PDF', b'\x00\x01'), ('TEST2.PDF', b'\x00')]
+
+    assert statsd_client.incr.call_args_list == [
+        call('zip-and-send.download.success'),
+        call('zip-and-send.download.success.objects', 2),
+        call('zip-and-send.download.success.bytes', 3),
+    ]
+
+
+def test_timed_downloads_records_abandoned_downloads(statsd_client):
+    closed = []
+
+    def letter_pdfs():
+        try:
+            yield 'TEST1.PDF', b'\x00'
+            yield 'TEST2.PDF', b'\x00'
+        finally:
+            closed.append(True)
+
+    downloads = timed_downloads(letter_pdfs())
+    next(downloads)
+    downloads.close()
+
+    assert closed == [True]
+    assert statsd_client.incr.call_args_list[0] == call('zip-and-send.download.abandoned')
+
+
+def test_timed_downloads_records_failed_downloads(statsd_client):
+    def letter_pdfs():
+        yield 'TEST1.PDF', b'\x00'
+        raise ValueError()
+
+    with pytest.raises(ValueError):
+        list(timed_downloads(letter_pdfs()))
+
+    assert statsd_client.incr.call_args_list[0] == call('zip-and-send.download.failure')
+
+
+def test_stage_timer_adds_nested_spans_to_transaction(statsd_client, sentry_transaction):
+    with stage_timer('upload') as upload:
+        upload.bytes = 1000
+        with stage_timer('verify'):
+            pass
+
+    upload_span, verify_span = _spans(sentry_transaction)
+    assert upload_span.op == 'zip-and-send.upload'
+    assert upload_span.parent_span_id == sentry_transaction.span_id
+    assert upload_span._tags == {'outcome': 'success'}
+    assert upload_span._data['bytes'] == 1000
+    assert upload_span.timestamp is not None
+    assert verify_span.op == 'zip-and-send.verify'
+    assert verify_span.parent_span_id == upload_span.span_id
+
+
+def test_stage_timer_marks_failed_span(statsd_client, sentry_transaction):
+    with pytest.raises(ValueError), stage_timer('upload'):
+        raise ValueError()
+
+    [upload_span] = _spans(sentry_transaction)
+    assert upload_span._tags == {'outcome': 'failure'}
+    assert upload_span.status == 'internal_error'
+
+
+def test_timed_downloads_adds_slowest_downloads_to_download_span(statsd_client, sentry_transaction, mocker):
+    # each download's start and end time - TEST2.PDF is the quickest
+    mocker.patch('app.metrics.time.time', side_effect=[100, 103, 103, 104, 104, 106])
+    download = SlowestDownloads(lambda filename: filename.encode(), keep=2)
+
+    letter_pdfs = ((filename, download(filename)) for filename in ['TEST1.PDF', 'TEST2.PDF', 'TEST3.PDF'])
+    assert len(list(timed_downloads(letter_pdfs, download))) == 3
+
+    download_span, *s3_get_spans = _spans(sentry_transaction)
+    assert download_span.op == 'zip-and-send.download'
+    assert (download_span._data['objects'], download_span._data['bytes']) == (3, 27)
+    assert [span.description for span in s3_get_spans] == ['TEST1.PDF', 'TEST3.PDF']
+    assert all(span.parent_span_id == download_span.span_id for span in s3_get_spans)
+    assert s3_get_spans[0]._data['bytes'] == 9
+    assert (s3_get_spans[0].timestamp - s3_get_spans[0].start_timestamp).total_seconds() == 3
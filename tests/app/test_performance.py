@@ -0,0 +1,86 @@
+import os
+import pstats
+import tracemalloc
+
+import pytest
+
+from app.performance import TaskProfiler, get_upload_filenames
+
+FILENAMES_TO_ZIP = ['2017-12-06/NOTIFY.REF1.D.2.C.20171206184702.PDF']
+
+
+def test_task_profiler_writes_profile_and_allocations_for_selected_upload_filename(tmp_path):
+    task_profiler = TaskProfiler(
+        str(tmp_path), {'zip-and-send-letter-pdfs'}, upload_filenames={'NOTIFY.20171206184702.ZIP'}
+    )
+    args = (FILENAMES_TO_ZIP, 'NOTIFY.20171206184702.ZIP')
+
+    task_profiler.start('task-id', 'zip-and-send-letter-pdfs', args, {})
+    allocated = [bytearray(1000) for _ in range(100)]
+    task_profiler.stop('task-id', 'zip-and-send-letter-pdfs', args, {})
+
+    assert allocated
+    assert task_profiler.profiles == {}
+    filenames = sorted(os.listdir(tmp_path))
+    assert len(filenames) == 2
+    assert filenames[0].endswith('-zip-and-send-letter-pdfs-NOTIFY.20171206184702.ZIP.allocations.txt')
+    assert filenames[1].endswith('-zip-and-send-letter-pdfs-NOTIFY.20171206184702.ZIP.prof')
+
+    pstats.Stats(str(tmp_path / filenames[1]))
+    report = (tmp_path / filenames[0]).read_text()
+    assert report.startswith('zip-and-send-letter-pdfs task-id for NOTIFY.20171206184702.ZIP\npeak traced memory: ')
+    assert 'test_performance.py' in report
+
+
+def test_task_profiler_traces_allocations_until_last_of_tasks_profiled_at_once_stops(tmp_path):
+    task_profiler = TaskProfiler(str(tmp_path), {'zip-and-send-letter-pdfs'}, sample_rate=1)
+    first_args = (FILENAMES_TO_ZIP, 'NOTIFY.20171206184702.ZIP')
+    second_args = (FILENAMES_TO_ZIP, 'NOTIFY.20171206184703.ZIP')
+
+    task_profiler.start('first-task-id', 'zip-and-send-letter-pdfs', first_args, {})
+    task_profiler.start('second-task-id', 'zip-and-send-letter-pdfs', second_args, {})
+    task_profiler.stop('first-task-id', 'zip-and-send-letter-pdfs', first_args, {})
+
+    assert tracemalloc.is_tracing()
+    assert list(task_profiler.profiles) == ['second-task-id']
+
+    task_profiler.stop('second-task-id', 'zip-and-send-letter-pdfs', second_args, {})
+
+    assert not tracemalloc.is_tracing()
+    assert len(os.listdir(tmp_path)) == 4
+
+
+@pytest.mark.parametrize('task_name, upload_filename, sample_rate', [
+    ('zip-and-send-letter-pdfs', 'NOTIFY.20171206184702.ZIP', 0),
+    ('zip-and-send-letter-pdfs-batch', 'NOTIFY.20171206184703.ZIP', 1),
+])
+def test_task_profiler_skips_tasks_not_selected(tmp_path, task_name, upload_filename, sample_rate):
+    task_profiler = TaskProfiler(
+        str(tmp_path), {'zip-and-send-letter-pdfs'}, sample_rate, upload_filenames={'NOTIFY.20171206184703.ZIP'}
+    )
+    args = (FILENAMES_TO_ZIP, upload_filename)
+
+    task_profiler.start('task-id', task_name, args, {})
+    task_profiler.stop('task-id', task_name, args, {})
+
+    assert task_profiler.profiles == {}
+    assert os.listdir(tmp_path) == []
+
+
+def test_task_profiler_samples_tasks(tmp_path, mocker):
+    mocker.patch('app.performance.random.random', side_effect=[0.2, 0.05])
+    task_profiler = TaskProfiler(str(tmp_path), {'zip-and-send-letter-pdfs'}, sample_rate=0.1)
+
+    assert not task_profiler.should_profile('zip-and-send-letter-pdfs', (FILENAMES_TO_ZIP, 'A.ZIP'), {})
+    assert task_profiler.should_profile('zip-and-send-letter-pdfs', (FILENAMES_TO_ZIP, 'A.ZIP'), {})
+
+
+@pytest.mark.parametrize('task_name, args, kwargs, expected_upload_filenames', [
+    ('zip-and-send-letter-pdfs', (FILENAMES_TO_ZIP, 'A.ZIP'), {}, ['A.ZIP']),
+    ('zip-and-send-letter-pdfs', (), {'filenames_to_zip': FILENAMES_TO_ZIP, 'upload_filename': 'A.ZIP'}, ['A.ZIP']),
+    ('zip-and-send-letter-pdfs-batch', ([[FILENAMES_TO_ZIP, 'A.ZIP'], [FILENAMES_TO_ZIP, 'B.ZIP']],), {},
+     ['A.ZIP', 'B.ZIP']),
+    ('some-other-task', ('A.ZIP',), {}, []),
+])
+def test_get_upload_filenames(task_name, args, kwargs, expected_upload_filenames):
+    assert get_upload_filenames(task_name, args, kwargs) == expected_upload_filenames
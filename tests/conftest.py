@@ -3,8 +3,9 @@ import shutil
 
 import pytest
 from flask import Flask, current_app
+from moto import mock_s3
 
-from app import create_app
+from app import create_app, s3_client
 
 
 @pytest.fixture(scope='session', autouse=True)
@@ -26,3 +27,14 @@ def client(notify_ftp):
         yield client
         if os.path.exists(current_app.config['LOCAL_FILE_STORAGE_PATH']):
             shutil.rmtree(current_app.config['LOCAL_FILE_STORAGE_PATH'], ignore_errors=False)
+
+
+@pytest.fixture(scope='function')
+def s3(notify_ftp):
+    # the shared S3 client picks up credentials when it is created, so recreate it inside moto's mock
+    with mock_s3():
+        s3_client.init_app(notify_ftp)
+        s3_client.client.create_bucket(
+            Bucket='bucket', CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'}
+        )
+        yield s3_client.client